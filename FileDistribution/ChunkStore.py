@@ -0,0 +1,351 @@
+import errno
+import hashlib
+import json
+import logging
+import os
+import os.path
+import random
+import shutil
+import tempfile
+import threading
+import unittest
+
+logger = logging.getLogger('ChunkStore')
+
+chunks_directory_name = 'chunks'
+manifests_directory_name = 'manifests'
+
+read_size = 1024 * 1024
+
+# Random values for each byte, used by the rolling hash; these must never change, since chunk boundaries depend on them
+gear_table = [random.Random(i).getrandbits(32) for i in range(256)]
+
+def sharded_relative_path(directory_name, sha1sum):
+	return os.path.join(directory_name, sha1sum[0:2], sha1sum[2:4], sha1sum)
+
+def chunk_relative_path(sha1sum):
+	return sharded_relative_path(chunks_directory_name, sha1sum)
+
+def manifest_relative_path(sha1sum):
+	return sharded_relative_path(manifests_directory_name, sha1sum)
+
+def find_chunk_boundary(data, min_size, max_size, mask, offset=0):
+	""" Locate the end of the first chunk in the bytearray data, starting at offset
+		A chunk ends where a rolling hash over the most recent bytes has all the bits in mask cleared.
+		The hash only depends on the last 32 bytes, so hashing starts just before the minimum chunk size
+		Returns the position of the end of the chunk within data
+		"""
+
+	if len(data) - offset <= min_size:
+		return len(data)
+
+	end = min(len(data), offset + max_size)
+	gear = gear_table
+	hash = 0
+	for position in xrange(offset + max(0, min_size - 32), offset + min_size):
+		hash = ((hash << 1) + gear[data[position]]) & 0xffffffff
+	for position in xrange(offset + min_size, end):
+		hash = ((hash << 1) + gear[data[position]]) & 0xffffffff
+		if not (hash & mask):
+			return position + 1
+	return end
+
+def split_into_chunks(file, average_chunk_size):
+	""" Split a file's contents into content-defined chunks
+		Since chunk boundaries depend only on nearby content, inserting or removing data
+		in a file only changes the chunks around the modification
+		average_chunk_size must be a power of two
+		"""
+
+	min_size = average_chunk_size // 4
+	max_size = average_chunk_size * 4
+	mask = average_chunk_size - 1
+
+	# Chunks are located by their position within the buffer; consumed data is only dropped when the buffer is
+	#  refilled, rather than copying the rest of the buffer after every chunk
+	buffer = bytearray()
+	position = 0
+	end_of_file = False
+	while True:
+		if not end_of_file and len(buffer) - position < max_size:
+			del buffer[:position]
+			position = 0
+			while not end_of_file and len(buffer) < max_size:
+				data = file.read(read_size)
+				if not data:
+					end_of_file = True
+				buffer += data
+
+		if position == len(buffer):
+			return
+
+		end = find_chunk_boundary(buffer, min_size, max_size, mask, position)
+		yield str(buffer[position:end])
+		position = end
+
+class ChunkedFileReader(object):
+	""" Read a file from the chunk store as a stream, by concatenating its chunks """
+
+	def __init__(self, root_path, sha1sum):
+		self.root_path = root_path
+		with open(os.path.join(root_path, manifest_relative_path(sha1sum))) as manifest_file:
+			self.manifest = json.load(manifest_file)
+		self.chunk_index = 0
+		self.chunk_file = None
+
+	def read(self, size=-1):
+		result = []
+		while size != 0 and self.chunk_index < len(self.manifest):
+			if not self.chunk_file:
+				chunk_sha1sum, chunk_size = self.manifest[self.chunk_index]
+				self.chunk_file = open(os.path.join(self.root_path, chunk_relative_path(chunk_sha1sum)), 'rb')
+
+			data = self.chunk_file.read(size)
+			if data:
+				result.append(data)
+				if size > 0:
+					size -= len(data)
+			else:
+				self.chunk_file.close()
+				self.chunk_file = None
+				self.chunk_index += 1
+
+		return ''.join(result)
+
+	def close(self):
+		if self.chunk_file:
+			self.chunk_file.close()
+			self.chunk_file = None
+		self.chunk_index = len(self.manifest)
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, type, value, traceback):
+		self.close()
+
+class ChunkStore(object):
+	""" Content-addressed storage of file contents as deduplicated, reference-counted chunks
+
+		Each file is described by a manifest, which lists the file's chunks in order. Manifests
+		and chunks are both stored under their SHA1 hashes. Chunks are reference counted in memory;
+		the counts are rebuilt from the manifests on startup
+		"""
+
+	def __init__(self, root_path, discard, average_chunk_size):
+		""" discard will be called with the full path of each chunk file that is no longer referenced """
+		self.root_path = root_path
+		self.chunks_path = os.path.join(root_path, chunks_directory_name)
+		self.manifests_path = os.path.join(root_path, manifests_directory_name)
+		self.discard = discard
+		self.average_chunk_size = average_chunk_size
+		self.lock = threading.RLock()
+		self.chunk_refs = {}
+
+		for path in [self.chunks_path, self.manifests_path]:
+			if not os.path.exists(path):
+				os.mkdir(path)
+
+		self.load()
+
+	def list_sharded_files(self, path, remove_stray_files=False):
+		""" List all files in a sharded directory tree
+			Files which do not belong there, such as leftover temporary files, are skipped or removed
+			"""
+		filenames = []
+		for root, dirs, files in os.walk(path):
+			relative_root = os.path.relpath(root, path)
+			for filename in files:
+				if os.path.join(filename[0:2], filename[2:4]) == relative_root:
+					filenames.append(filename)
+				elif remove_stray_files:
+					os.remove(os.path.join(root, filename))
+		return filenames
+
+	def list_manifests(self):
+		""" List the SHA1 of every file which is stored in the chunk store """
+		return self.list_sharded_files(self.manifests_path)
+
+	def load(self):
+		""" Count references to chunks from all manifests, and remove chunks which are not referenced """
+		with self.lock:
+			self.chunk_refs = {}
+			for sha1sum in self.list_sharded_files(self.manifests_path, remove_stray_files=True):
+				for (chunk_sha1sum, chunk_size) in self.read_manifest(sha1sum):
+					self.chunk_refs[chunk_sha1sum] = self.chunk_refs.get(chunk_sha1sum, 0) + 1
+
+			for chunk_sha1sum in self.list_sharded_files(self.chunks_path, remove_stray_files=True):
+				if not chunk_sha1sum in self.chunk_refs:
+					os.remove(os.path.join(self.root_path, chunk_relative_path(chunk_sha1sum)))
+
+	def store_file(self, filename):
+		""" Split a file into chunks, and add any chunks that are not yet in the store
+			Returns the file's manifest. The manifest holds references to its chunks until it is
+			either committed with commit_manifest(), or released with release_manifest()
+			"""
+
+		with open(filename, 'rb') as file:
+			return self.store_stream(file)
+
+	def store_stream(self, file):
+		""" Split the contents of an open file into chunks, like store_file """
+
+		manifest = []
+		try:
+			for chunk in split_into_chunks(file, self.average_chunk_size):
+				chunk_sha1sum = hashlib.sha1(chunk).hexdigest()
+				self.add_chunk(chunk_sha1sum, chunk)
+				manifest.append([chunk_sha1sum, len(chunk)])
+		except:
+			self.release_manifest(manifest)
+			raise
+		return manifest
+
+	def add_chunk(self, chunk_sha1sum, data):
+		with self.lock:
+			if chunk_sha1sum in self.chunk_refs:
+				self.chunk_refs[chunk_sha1sum] += 1
+				return
+
+		# The chunk is written outside the lock, so another thread may add the same chunk meanwhile
+		temp_file_handle, temp_filename = tempfile.mkstemp(dir=self.chunks_path)
+		with os.fdopen(temp_file_handle, 'wb') as temp_file:
+			temp_file.write(data)
+
+		with self.lock:
+			if chunk_sha1sum in self.chunk_refs:
+				os.remove(temp_filename)
+				self.chunk_refs[chunk_sha1sum] += 1
+			else:
+				full_path_filename = os.path.join(self.root_path, chunk_relative_path(chunk_sha1sum))
+				directory = os.path.dirname(full_path_filename)
+				if not os.path.exists(directory):
+					os.makedirs(directory)
+				os.rename(temp_filename, full_path_filename)
+				self.chunk_refs[chunk_sha1sum] = 1
+
+	def commit_manifest(self, sha1sum, manifest):
+		full_path_filename = os.path.join(self.root_path, manifest_relative_path(sha1sum))
+		directory = os.path.dirname(full_path_filename)
+		if not os.path.exists(directory):
+			os.makedirs(directory)
+		temp_file_handle, temp_filename = tempfile.mkstemp(dir=self.manifests_path)
+		with os.fdopen(temp_file_handle, 'w') as temp_file:
+			json.dump(manifest, temp_file)
+		os.rename(temp_filename, full_path_filename)
+
+	def release_manifest(self, manifest):
+		with self.lock:
+			for (chunk_sha1sum, chunk_size) in manifest:
+				self.chunk_refs[chunk_sha1sum] -= 1
+				if self.chunk_refs[chunk_sha1sum] == 0:
+					del self.chunk_refs[chunk_sha1sum]
+					self.discard(os.path.join(self.root_path, chunk_relative_path(chunk_sha1sum)))
+
+	def read_manifest(self, sha1sum):
+		with open(os.path.join(self.root_path, manifest_relative_path(sha1sum))) as manifest_file:
+			return json.load(manifest_file)
+
+	def remove(self, sha1sum):
+		""" Remove a file's manifest, and release its references to chunks
+			Removing a file which has already been removed has no effect
+			"""
+		with self.lock:
+			try:
+				manifest = self.read_manifest(sha1sum)
+			except IOError, e:
+				if e.errno == errno.ENOENT:
+					return
+				raise
+			os.remove(os.path.join(self.root_path, manifest_relative_path(sha1sum)))
+			self.release_manifest(manifest)
+
+	def stored_size(self):
+		""" Total size of all chunks in the store """
+		with self.lock:
+			size = 0
+			for chunk_sha1sum in self.chunk_refs.keys():
+				size += os.stat(os.path.join(self.root_path, chunk_relative_path(chunk_sha1sum))).st_size
+			return size
+
+	def open(self, sha1sum):
+		return ChunkedFileReader(self.root_path, sha1sum)
+
+class ChunkStoreUnitTest(unittest.TestCase):
+
+	root_path = 'unittest'
+	average_chunk_size = 1024
+
+	def setUp(self):
+		os.mkdir(self.root_path)
+
+	def write_file(self, filename, contents):
+		with open(os.path.join(self.root_path, filename), 'wb') as file:
+			file.write(contents)
+		return os.path.join(self.root_path, filename)
+
+	def test_chunking(self):
+
+		class Contents(object):
+			def __init__(self, data):
+				self.data = data
+			def read(self, size):
+				result = self.data[:size]
+				self.data = self.data[size:]
+				return result
+
+		rng = random.Random(1)
+		data = ''.join([chr(rng.getrandbits(8)) for i in range(64 * 1024)])
+		modified_data = data[:30000] + 'inserted data' + data[30000:]
+
+		chunks = list(split_into_chunks(Contents(data), self.average_chunk_size))
+		modified_chunks = list(split_into_chunks(Contents(modified_data), self.average_chunk_size))
+
+		# Chunks should cover the file's contents, and respect size limits
+		self.assertEquals(''.join(chunks), data)
+		for chunk in chunks[:-1]:
+			self.assertTrue(len(chunk) >= self.average_chunk_size // 4)
+			self.assertTrue(len(chunk) <= self.average_chunk_size * 4)
+
+		# An insertion should only change the chunks around it
+		self.assertTrue(len(set(modified_chunks) - set(chunks)) <= 2)
+		self.assertTrue(len(set(chunks) - set(modified_chunks)) <= 2)
+
+	def test_store(self):
+
+		discarded = []
+		chunk_store = ChunkStore(self.root_path, discarded.append, self.average_chunk_size)
+
+		rng = random.Random(2)
+		data = ''.join([chr(rng.getrandbits(8)) for i in range(16 * 1024)])
+		data1_sha1sum = hashlib.sha1(data).hexdigest()
+		data2_sha1sum = hashlib.sha1(data + 'appended').hexdigest()
+
+		manifest1 = chunk_store.store_file(self.write_file('file1', data))
+		chunk_store.commit_manifest(data1_sha1sum, manifest1)
+		manifest2 = chunk_store.store_file(self.write_file('file2', data + 'appended'))
+		chunk_store.commit_manifest(data2_sha1sum, manifest2)
+
+		# Files should read back as their original contents
+		with chunk_store.open(data1_sha1sum) as reader:
+			self.assertEquals(reader.read(), data)
+		with chunk_store.open(data2_sha1sum) as reader:
+			self.assertEquals(reader.read(100) + reader.read(), data + 'appended')
+
+		# Reference counts should be rebuilt from the manifests
+		chunk_refs = dict(chunk_store.chunk_refs)
+		chunk_store = ChunkStore(self.root_path, discarded.append, self.average_chunk_size)
+		self.assertEquals(chunk_store.chunk_refs, chunk_refs)
+
+		# Chunks should be discarded once no manifest refers to them
+		chunk_store.remove(data2_sha1sum)
+		self.assertEquals(len(discarded), len(set([chunk_sha1sum for (chunk_sha1sum, chunk_size) in manifest2]) - set([chunk_sha1sum for (chunk_sha1sum, chunk_size) in manifest1])))
+		chunk_store.remove(data1_sha1sum)
+		self.assertEquals(chunk_store.chunk_refs, {})
+		chunk_store.remove(data1_sha1sum)
+
+	def tearDown(self):
+		shutil.rmtree(self.root_path)
+
+if __name__ == '__main__':
+	unittest.main()
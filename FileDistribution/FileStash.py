@@ -1,12 +1,17 @@
 
+import bisect
+import collections
 import datetime
 import dateutil
 import dateutil.parser
-import json
+import errno
+import hashlib
 import logging
 import os
 import os.path
+import Queue
 import shutil
+import tempfile
 import thread
 import threading
 import traceback
@@ -15,12 +20,67 @@ import unittest
 
 from fabric.api import local
 
+from ChunkStore import ChunkStore, ChunkedFileReader, chunks_directory_name, manifests_directory_name, manifest_relative_path
+from FileStashJournal import FileStashJournal
 from Observable import Observable
+from timestamps import datetime_to_microseconds, microseconds_to_datetime
+
+import eviction_policies
 
 logger = logging.getLogger('FileStash')
 
+hash_block_size = 1024 * 1024
+
+def parse_timestamp(timestamp):
+	""" Parse a timestamp as written by StashedFile.to_json(), i.e. 'YYYY-MM-DD HH:MM:SS[.ffffff]'
+		Slicing out the fields is much faster than dateutil's general-purpose parser, or strptime()
+		"""
+	try:
+		microsecond = 0
+		if len(timestamp) == 26 and timestamp[19] == '.':
+			microsecond = int(timestamp[20:26])
+		elif len(timestamp) != 19:
+			raise ValueError
+		return datetime.datetime(int(timestamp[0:4]), int(timestamp[5:7]), int(timestamp[8:10]), int(timestamp[11:13]), int(timestamp[14:16]), int(timestamp[17:19]), microsecond)
+	except ValueError:
+		return dateutil.parser.parse(timestamp)
+
+def sha1_of_file(filename):
+	""" Compute the SHA1 hash of a file's contents, without launching any external processes """
+	sha1 = hashlib.sha1()
+	with open(filename, 'rb') as file:
+		while True:
+			data = file.read(hash_block_size)
+			if not data:
+				break
+			sha1.update(data)
+	return sha1.hexdigest()
+
+flat_layout = 'flat'
+sharded_layout = 'sharded'
+chunked_layout = 'chunked'
+layouts = [flat_layout, sharded_layout]
+
+def blob_relative_path(sha1sum, layout):
+	""" Locate a blob within the stash directory tree
+		The flat layout keeps all blobs in the stash root, while the sharded layout
+		spreads them across directories named after the first hash bytes, e.g. ab/cd/abcd...
+		Blobs in the chunk store are represented by their manifests
+		"""
+	if layout == sharded_layout:
+		return os.path.join(sha1sum[0:2], sha1sum[2:4], sha1sum)
+	elif layout == chunked_layout:
+		return manifest_relative_path(sha1sum)
+	else:
+		return sha1sum
+
+def is_shard_directory_name(name):
+	return len(name) == 2 and all(c in '0123456789abcdef' for c in name)
+
 class RefCount(object):
 
+	__slots__ = ('reference_count', )
+
 	def __init__(self):
 		self.reference_count = 0
 
@@ -37,24 +97,85 @@ class RefCount(object):
 
 class PhysicalFile(RefCount):
 
-	def __init__(self, sha1sum):
+	__slots__ = ('sha1sum', 'layout', 'size', 'lock_count')
+
+	def __init__(self, sha1sum, layout=flat_layout, size=0):
 		super(PhysicalFile, self).__init__()
 		self.sha1sum = sha1sum
+		self.layout = layout
+		self.size = size
+		self.lock_count = 0
 
 		if len(sha1sum) != 40:
 			raise Exception(sha1sum + " is not a valid SHA1 hash value")
 
+	def relative_path(self):
+		return blob_relative_path(self.sha1sum, self.layout)
+
+	def resolve_layout(self, root_path):
+		""" Determine which layout the blob is stored in, if this is not yet known """
+		if self.layout is None:
+			for layout in layouts + [chunked_layout]:
+				if os.path.exists(os.path.join(root_path, blob_relative_path(self.sha1sum, layout))):
+					self.layout = layout
+					return
+
 class StashedFile(RefCount):
+	""" An entry in the file stash index
+		There can be hundreds of thousands of these, so they are kept compact: attributes are stored in slots,
+		timestamps are stored as integers, and paths are derived on demand
+		"""
+
+	__slots__ = ('file_id', 'root_path', 'original_filename', 'physical_file', 'timestamp_microseconds', 'size', 'last_distribution_time_microseconds', 'distribution_count')
 
 	def __init__(self, file_id, root_path, filename, physical_file, timestamp, size):
 		super(StashedFile, self).__init__()
 		self.file_id = file_id
 		self.root_path = root_path
-		self.full_path_filename = os.path.join(root_path, physical_file.sha1sum)
 		self.original_filename = filename
 		self.physical_file = physical_file
-		self.timestamp = timestamp
+		self.timestamp_microseconds = datetime_to_microseconds(timestamp)
 		self.size = size
+		self.last_distribution_time_microseconds = self.timestamp_microseconds
+		self.distribution_count = 0
+
+	@property
+	def timestamp(self):
+		return microseconds_to_datetime(self.timestamp_microseconds)
+
+	@property
+	def last_distribution_time(self):
+		return microseconds_to_datetime(self.last_distribution_time_microseconds)
+
+	@last_distribution_time.setter
+	def last_distribution_time(self, time):
+		self.last_distribution_time_microseconds = datetime_to_microseconds(time)
+
+	@property
+	def is_chunked(self):
+		self.physical_file.resolve_layout(self.root_path)
+		return self.physical_file.layout == chunked_layout
+
+	@property
+	def full_path_filename(self):
+		""" The path of the file's contents; files that are stored as chunks have no such path (see manifest_path) """
+		if self.is_chunked:
+			raise Exception("File " + self.file_id + " is stored as chunks, and cannot be accessed by path")
+		return os.path.join(self.root_path, self.physical_file.relative_path())
+
+	@property
+	def manifest_path(self):
+		""" The path of the manifest of a file that is stored as chunks, or None for other files """
+		if not self.is_chunked:
+			return None
+		return os.path.join(self.root_path, manifest_relative_path(self.physical_file.sha1sum))
+
+	def open(self):
+		""" Open the file's contents for reading, regardless of how the contents are stored """
+		if self.is_chunked:
+			return ChunkedFileReader(self.root_path, self.physical_file.sha1sum)
+		else:
+			return open(self.full_path_filename, 'rb')
 
 	def to_json(self):
 		return { 'file_id' : self.file_id,
@@ -62,8 +183,48 @@ class StashedFile(RefCount):
 			'sha1sum' : self.physical_file.sha1sum,
 			'timestamp' : str(self.timestamp),
 			'size' : str(self.size),
+			'last_distribution_time' : str(self.last_distribution_time),
+			'distribution_count' : self.distribution_count,
 			'is_deletable' : self.ref_count() == 0 }
 
+class FileStashIngest(object):
+	""" A file that is being streamed into the stash
+		The contents are hashed while they are written to a temporary file inside the stash,
+		so that the file does not need to be read back again when it is committed
+		"""
+
+	def __init__(self, file_stash, temp_filename):
+		self.file_stash = file_stash
+		self.temp_filename = temp_filename
+		self.file = open(temp_filename, 'wb')
+		self.sha1 = hashlib.sha1()
+		self.size = 0
+
+	def write(self, data):
+		self.file.write(data)
+		self.sha1.update(data)
+		self.size += len(data)
+
+	def seek(self, offset, whence=0):
+		# Form parsers rewind their output stream once all data has been written;
+		#  the ingest is write-only, so there is nothing to rewind
+		self.file.flush()
+
+	def sha1sum(self):
+		return self.sha1.hexdigest()
+
+	def close(self):
+		if not self.file.closed:
+			self.file.close()
+
+	def commit(self, filename, timestamp):
+		return self.file_stash.commit_ingest(self, filename, timestamp)
+
+	def abort(self):
+		self.close()
+		if os.path.exists(self.temp_filename):
+			os.remove(self.temp_filename)
+
 class FileStash(Observable):
 
 	class Error(Exception):
@@ -75,17 +236,76 @@ class FileStash(Observable):
 	class FileCannotBeRemovedError(Error):
 		pass
 
-	index_filename = 'index.json'
+	ingest_directory_name = 'ingest'
+	trash_directory_name = 'trash'
+	reconciliation_batch_size = 1000
+	index_population_batch_size = 1000
+	layout_migration_batch_size = 100
+	layout_migration_retry_interval_seconds = 60
+	chunking_retry_interval_seconds = 60
 
-	def __init__(self, root_path, max_file_age_days, max_file_age_check_interval_seconds):
+	def __init__(self, root_path, max_file_age_days, max_file_age_check_interval_seconds, journal_sync_interval_seconds=1, journal_compaction_threshold=10000, trust_index=False, layout=flat_layout, max_size_bytes=None, eviction_policy='lru', chunk_files=False, average_chunk_size=65536):
 		super(FileStash, self).__init__()
 		if not os.path.exists(root_path):
 			raise Exception("Stash directory " + root_path + " does not exist")
 
 		self.index_lock = threading.RLock()
 		self.root_path = root_path
+		self.ingest_path = os.path.join(root_path, self.ingest_directory_name)
+		self.journal = FileStashJournal(root_path, journal_sync_interval_seconds)
+		if not layout in layouts:
+			raise Exception("Unknown file stash layout: " + layout)
+		self.layout = layout
+		self.max_size_bytes = max_size_bytes
+		self.eviction_policy = eviction_policies.get(eviction_policy)
+		self.eviction_grace_period_seconds = eviction_policies.grace_period(eviction_policy)
+		# The times at which files were added since startup, in order, for as long as they are within the grace period
+		self.recently_added_files = collections.OrderedDict()
+		self.chunk_files = chunk_files
 		self.unique_id = 0
-		self.build_index()
+		# Entries of a trusted index which have been loaded, but not yet added to the index (see load_index)
+		self.unpopulated_entries = {}
+		self.reconciliation_progress = { 'state' : 'not_started', 'checked_files' : 0, 'total_files' : 0, 'missing_files_removed' : 0, 'orphan_files_removed' : 0 }
+
+		self.trash_path = os.path.join(root_path, self.trash_directory_name)
+		self.trash_id = 0
+		self.trash_lock = threading.Lock()
+		self.deletion_queue = Queue.Queue()
+		if os.path.exists(self.trash_path):
+			for filename in os.listdir(self.trash_path):
+				self.deletion_queue.put(os.path.join(self.trash_path, filename))
+		else:
+			os.mkdir(self.trash_path)
+		deletion_thread = threading.Thread(target=self.deletion_thread)
+		deletion_thread.daemon = True
+		deletion_thread.start()
+
+		# The chunk store is only needed by stashes which store files as chunks, or have done so before
+		if chunk_files or os.path.exists(os.path.join(root_path, manifests_directory_name)):
+			self.chunk_store = ChunkStore(root_path, self.discard_blob, average_chunk_size)
+		else:
+			self.chunk_store = None
+		self.chunking_queue = Queue.Queue()
+		if chunk_files:
+			chunking_thread = threading.Thread(target=self.chunking_thread)
+			chunking_thread.daemon = True
+			chunking_thread.start()
+
+		shutil.rmtree(self.ingest_path, True)
+		if trust_index:
+			self.load_index()
+		else:
+			self.build_index()
+			self.reconciliation_progress['state'] = 'completed'
+			self.evict_files_if_full()
+		os.mkdir(self.ingest_path)
+
+		maintenance_thread = threading.Thread(target=(lambda self, trust_index: self.startup_maintenance_thread(trust_index)), args=(self, trust_index))
+		maintenance_thread.daemon = True
+		maintenance_thread.start()
+
+		if journal_sync_interval_seconds:
+			self.journal.start_maintenance_thread(journal_compaction_threshold, self.compact_index)
 		
 		if max_file_age_days:
 			cleanup_thread = threading.Thread(target=(lambda self, max_file_age_days, max_file_age_check_interval_seconds: self.remove_old_files_thread(max_file_age_days, max_file_age_check_interval_seconds)), args=(self, max_file_age_days, max_file_age_check_interval_seconds))
@@ -96,48 +316,67 @@ class FileStash(Observable):
 
 		while True:
 			time.sleep(max_file_age_check_interval_seconds)
-			files = self.list()
 			now = datetime.datetime.utcnow()
 			max_timedelta = datetime.timedelta(days=max_file_age_days)
-			for file in files:
-				age = now - file.timestamp
-				if age > max_timedelta:
-					try:
-						stashed_file = self.remove(file.file_id)
-					except Exception, e:
-						logger.error("Exception: " + e.message)
-						logger.error(traceback.format_exc())
+			try:
+				files = self.list_older_than(now - max_timedelta)
+				removed_files, failures = self.remove_many([file.file_id for file in files])
+				if failures:
+					logger.info(str(len(failures)) + " old files could not be removed since they are in use")
+			except Exception, e:
+				logger.error("Exception: " + e.message)
+				logger.error(traceback.format_exc())
+
+	def deletion_thread(self):
+		""" Delete discarded blobs, without holding the index lock """
+
+		while True:
+			filename = self.deletion_queue.get()
+			try:
+				os.remove(filename)
+			except OSError, e:
+				if e.errno != errno.ENOENT:
+					logger.error("Exception: " + str(e))
+					logger.error(traceback.format_exc())
+			finally:
+				self.deletion_queue.task_done()
+
+	def wait_for_deletions(self):
+		""" Wait until all discarded blobs have been deleted """
+		self.deletion_queue.join()
+
+	def index_contents(self):
+		with self.index_lock:
+			self.populate_entries()
+			return dict((id, stashed_file.to_json()) for (id, stashed_file) in self.stashed_files.iteritems())
 
 	def save_index(self):
+		""" Write a snapshot of the full index, replacing any previous snapshot and journal """
 		with self.index_lock:
-			filename = os.path.join(self.root_path, self.index_filename)
-			with open(filename, 'w') as index_file:
-				json.dump(self.stashed_files, index_file, default = lambda file: file.to_json())
-			
+			self.journal.reset(self.index_contents())
+
+	def compact_index(self):
+		""" Fold the journal into a new snapshot
+			Only the journal rotation needs to happen under the index lock; the snapshot
+			is written while other operations continue appending to a fresh journal
+			"""
+		with self.index_lock:
+			self.journal.rotate()
+			index = self.index_contents()
+		self.journal.write_snapshot(index)
+
 	def build_index(self):
 		""" Create an index for all the files in the stash directory tree """
 
 		with self.index_lock:
 		
-			# Load index file
-			old_index_filename = os.path.join(self.root_path, self.index_filename)
-			old_index = {}
-			try:
-				with open(old_index_filename) as old_index_file:
-					old_index = json.load(old_index_file)
-			except IOError as e:
-				pass
+			# Load index snapshot and replay journal
+			old_index = self.journal.load()
 
-			# Locate all on-disk files in file stash directory; remove directories
-			on_disk_files = {}
-			for root, dirs, filenames in os.walk(self.root_path):
-
-				for dir in dirs:
-					shutil.rmtree(os.path.join(root, dir))
-			
-				for filename in filenames:
-					if filename != self.index_filename:
-						on_disk_files[filename] = True;
+			# Locate all on-disk files in file stash directory; remove anything else
+			on_disk_files, stray_paths = self.scan_directory_tree()
+			for path in stray_paths:
+				self.remove_stray_path(path)
 
 			# Remove index entries if the corresponding file is missing on-disk
 			for id, entry in old_index.items():
@@ -149,54 +388,380 @@ class FileStash(Observable):
 			for entry in old_index.values():
 				referenced_files[entry['sha1sum']] = True
 				
-			for file in on_disk_files.keys():
+			for file, layout in on_disk_files.items():
 				if not file in referenced_files:
-					os.remove(os.path.join(self.root_path, file))
+					self.remove_orphan_blob(file, layout)
+					del on_disk_files[file]
 					
 			# Add all remaining index entries to stash
-			self.physical_files = {}
-			self.stashed_files = {}
-			for file in old_index.values():
-				self.add_to_index(file['original_filename'], file['sha1sum'], dateutil.parser.parse(file['timestamp']), int(file['size']))
+			self.populate_index(old_index, on_disk_files)
 				
 			
 		self.save_index()
 
-	def add_to_index(self, filename, sha1sum, timestamp, size):
+	def load_index(self):
+		""" Load the persisted index, without examining the stash directory tree
+			The loaded entries are added to the index in the background, by populate_loaded_index(), so that the
+			stash serves requests right away; requests which need an entry, or the whole index, before then add
+			what they need themselves. The index is reconciled against the directory tree afterward, by reconcile_index()
+			"""
+
+		index = self.journal.load()
+		with self.index_lock:
+			self.populate_index({}, {})
+			self.unpopulated_entries = index
+			self.unique_id = max([int(id) + 1 for id in index.keys()] + [0])
+
+	def populate_loaded_index(self):
+		""" Add the loaded entries to the index in batches, so that other requests are served in between """
+		while True:
+			with self.index_lock:
+				self.populate_entries(self.index_population_batch_size)
+				if not self.unpopulated_entries:
+					return
+
+	def populate_entries(self, max_entries=None):
+		""" Add loaded entries to the index, all of them unless max_entries is given; must be called with the index lock held
+			Operations which examine or change more than one entry need all of them, since entries share blobs
+			"""
+		num_entries = 0
+		while self.unpopulated_entries and (max_entries is None or num_entries < max_entries):
+			id, file = self.unpopulated_entries.popitem()
+			self.add_loaded_entry(id, file, None)
+			num_entries += 1
+
+	def populate_entry(self, id):
+		""" Add a single loaded entry to the index, if it has not been added yet; must be called with the index lock held """
+		file = self.unpopulated_entries.pop(id, None)
+		if file:
+			self.add_loaded_entry(id, file, None)
+
+	def add_loaded_entry(self, id, file, layout):
+		stashed_file = self.add_to_index(file['original_filename'], file['sha1sum'], parse_timestamp(file['timestamp']), int(file['size']), id, layout)
+		# Indexes written by earlier versions have no distribution statistics
+		if 'distribution_count' in file:
+			stashed_file.distribution_count = int(file['distribution_count'])
+			stashed_file.last_distribution_time = parse_timestamp(file['last_distribution_time'])
+
+	def populate_index(self, index, file_layouts):
+		""" Fill the index with the given entries
+			Blobs whose layout is not given in file_layouts are located the first time their path is needed
+			"""
+		with self.index_lock:
+			self.physical_files = {}
+			self.stashed_files = {}
+			self.total_size = 0
+			self.timestamp_order = []
+			self.timestamp_order_is_sorted = True
+			for id, file in index.iteritems():
+				self.add_loaded_entry(id, file, file_layouts.get(file['sha1sum']))
+			self.unique_id = max([int(id) + 1 for id in self.stashed_files.keys()] + [0])
+
+	def scan_directory_tree(self):
+		""" Locate all blobs in the stash directory tree, in any layout
+			Returns a map from each blob's SHA1 to its layout, and a list of paths that do not belong in the stash
+			"""
+
+		on_disk_files = {}
+		stray_paths = []
+
+		def add_file(filename, layout, full_path_filename):
+			if filename in on_disk_files:
+				stray_paths.append(full_path_filename)
+			else:
+				on_disk_files[filename] = layout
+
+		# Blobs in the chunk store are listed first, so that they take precedence over any duplicates
+		for sha1sum in (self.chunk_store.list_manifests() if self.chunk_store else []):
+			add_file(sha1sum, chunked_layout, os.path.join(self.root_path, manifest_relative_path(sha1sum)))
+
+		for filename in os.listdir(self.root_path):
+			full_path_filename = os.path.join(self.root_path, filename)
+			if filename in [self.ingest_directory_name, self.trash_directory_name, chunks_directory_name, manifests_directory_name] or filename.startswith(FileStashJournal.snapshot_filename) or filename.startswith(FileStashJournal.journal_filename):
+				continue
+			elif not os.path.isdir(full_path_filename):
+				add_file(filename, flat_layout, full_path_filename)
+			elif not is_shard_directory_name(filename):
+				stray_paths.append(full_path_filename)
+			else:
+				for subdirectory_name in os.listdir(full_path_filename):
+					subdirectory_path = os.path.join(full_path_filename, subdirectory_name)
+					if not is_shard_directory_name(subdirectory_name) or not os.path.isdir(subdirectory_path):
+						stray_paths.append(subdirectory_path)
+					else:
+						for blob_name in os.listdir(subdirectory_path):
+							blob_path = os.path.join(subdirectory_path, blob_name)
+							if blob_relative_path(blob_name, sharded_layout) != os.path.join(filename, subdirectory_name, blob_name) or os.path.isdir(blob_path):
+								stray_paths.append(blob_path)
+							else:
+								add_file(blob_name, sharded_layout, blob_path)
+		return on_disk_files, stray_paths
+
+	def remove_stray_path(self, path):
+		if os.path.isdir(path):
+			shutil.rmtree(path, True)
+		else:
+			os.remove(path)
+
+	def remove_orphan_blob(self, sha1sum, layout):
+		""" Remove a blob which is not referenced by any index entry """
+		if layout == chunked_layout:
+			self.chunk_store.remove(sha1sum)
+		else:
+			os.remove(os.path.join(self.root_path, blob_relative_path(sha1sum, layout)))
+
+	def startup_maintenance_thread(self, trust_index):
+		if trust_index:
+			self.populate_loaded_index()
+			self.evict_files_if_full()
+			self.reconcile_index()
+		self.migrate_layout()
+		if self.chunk_files:
+			with self.index_lock:
+				for physical_file in self.physical_files.values():
+					if physical_file.layout != chunked_layout:
+						self.chunking_queue.put(physical_file.sha1sum)
+
+	def blob_exists(self, physical_file):
+		""" Check whether a blob is present on disk, as a file or as a manifest in the chunk store """
+		physical_file.resolve_layout(self.root_path)
+		return os.path.exists(os.path.join(self.root_path, physical_file.relative_path()))
+
+	def chunking_thread(self):
+		""" Move newly stashed blobs into the chunk store, one at a time, in the background """
+
+		while True:
+			sha1sum = self.chunking_queue.get()
+			try:
+				self.chunk_blob(sha1sum)
+			except Exception, e:
+				logger.error("Exception: " + str(e))
+				logger.error(traceback.format_exc())
+			finally:
+				self.chunking_queue.task_done()
+
+	def chunk_blob(self, sha1sum):
+		""" Split a blob into the chunk store, and replace the blob with its manifest
+			The index lock is not held while the blob is split, since that takes a while. Blobs of locked files
+			are left alone, since running tasks may be accessing them by path; they are retried later
+			"""
+
+		with self.index_lock:
+			physical_file = self.physical_files.get(sha1sum)
+			if not physical_file:
+				return
+			physical_file.resolve_layout(self.root_path)
+			if physical_file.layout is None or physical_file.layout == chunked_layout:
+				return
+			if physical_file.lock_count != 0:
+				self.retry_chunking(sha1sum)
+				return
+			# Opening the blob keeps its contents available, even if it is moved to another layout meanwhile
+			source_file = open(os.path.join(self.root_path, physical_file.relative_path()), 'rb')
+
+		try:
+			manifest = self.chunk_store.store_stream(source_file)
+		finally:
+			source_file.close()
+
+		with self.index_lock:
+			physical_file = self.physical_files.get(sha1sum)
+			if not physical_file or physical_file.layout == chunked_layout or physical_file.lock_count != 0:
+				# The file was removed, chunked by someone else or locked while it was being split
+				self.chunk_store.release_manifest(manifest)
+				if physical_file and physical_file.lock_count != 0:
+					self.retry_chunking(sha1sum)
+				return
+			blob_path = os.path.join(self.root_path, physical_file.relative_path())
+			self.chunk_store.commit_manifest(sha1sum, manifest)
+			physical_file.layout = chunked_layout
+			self.discard_blob(blob_path)
+
+	def retry_chunking(self, sha1sum):
+		timer = threading.Timer(self.chunking_retry_interval_seconds, self.chunking_queue.put, [sha1sum])
+		timer.daemon = True
+		timer.start()
+
+	def wait_for_chunking(self):
+		""" Wait until all blobs that are queued for chunking have been moved into the chunk store """
+		self.chunking_queue.join()
+
+	def reconcile_index(self):
+		""" Bring a trusted index in sync with the stash directory tree, without blocking other stash operations
+			Index entries whose files are missing on-disk are removed, and so are on-disk files which
+			are not referenced by any index entry. The work is done in small batches, each holding the
+			index lock only briefly
+			"""
+
+		try:
+			# Locate all on-disk files in file stash directory; remove anything else
+			on_disk_files, stray_paths = self.scan_directory_tree()
+			for path in stray_paths:
+				self.remove_stray_path(path)
+
+			with self.index_lock:
+				ids = self.stashed_files.keys()
+				self.reconciliation_progress['state'] = 'in_progress'
+				self.reconciliation_progress['total_files'] = len(ids) + len(on_disk_files)
+
+			# Remove index entries if the corresponding file is missing on-disk
+			#  Files added after the directory was listed are not in on_disk_files, so check those again before removing them
+			for batch_start in range(0, len(ids), self.reconciliation_batch_size):
+				with self.index_lock:
+					removed_files = []
+					for id in ids[batch_start:batch_start + self.reconciliation_batch_size]:
+						stashed_file = self.stashed_files.get(id)
+						if stashed_file:
+							physical_file = stashed_file.physical_file
+							if physical_file.sha1sum in on_disk_files:
+								if physical_file.layout is None:
+									physical_file.layout = on_disk_files[physical_file.sha1sum]
+							elif not self.blob_exists(physical_file):
+								self.remove_from_index(id)
+								removed_files.append(stashed_file)
+								self.reconciliation_progress['missing_files_removed'] += 1
+						self.reconciliation_progress['checked_files'] += 1
+					if removed_files:
+						self.journal.append_many([self.journal.remove_record(file.file_id) for file in removed_files])
+						self.notify(event_type='remove_many', stashed_files=removed_files)
+				logger.info("Reconciling file stash: " + str(self.reconciliation_progress['checked_files']) + " / " + str(self.reconciliation_progress['total_files']) + " checked")
+
+			# Remove files which are not referenced by any index entry
+			filenames = on_disk_files.keys()
+			for batch_start in range(0, len(filenames), self.reconciliation_batch_size):
+				with self.index_lock:
+					for filename in filenames[batch_start:batch_start + self.reconciliation_batch_size]:
+						if not filename in self.physical_files:
+							try:
+								self.remove_orphan_blob(filename, on_disk_files[filename])
+								self.reconciliation_progress['orphan_files_removed'] += 1
+							except OSError:
+								pass
+						self.reconciliation_progress['checked_files'] += 1
+				logger.info("Reconciling file stash: " + str(self.reconciliation_progress['checked_files']) + " / " + str(self.reconciliation_progress['total_files']) + " checked")
+
+			with self.index_lock:
+				self.reconciliation_progress['state'] = 'completed'
+			logger.info("File stash reconciliation completed; " + str(self.reconciliation_progress['missing_files_removed']) + " missing files and " + str(self.reconciliation_progress['orphan_files_removed']) + " orphan files removed")
+
+		except Exception, e:
+			with self.index_lock:
+				self.reconciliation_progress['state'] = 'failed'
+			logger.error("Exception: " + e.message)
+			logger.error(traceback.format_exc())
+
+	def get_reconciliation_progress(self):
+		with self.index_lock:
+			return dict(self.reconciliation_progress)
+
+	def migrate_layout(self):
+		""" Move all blobs which are stored in another layout than the stash's configured layout
+			Blobs are moved in small batches, each holding the index lock only briefly. Blobs belonging to
+			locked files are left alone, since running tasks may be accessing them by path; these are retried
+			until all blobs have been migrated
+			"""
+
+		try:
+			while True:
+				with self.index_lock:
+					sha1sums = self.physical_files.keys()
+
+				num_migrated = 0
+				num_remaining = 0
+				for batch_start in range(0, len(sha1sums), self.layout_migration_batch_size):
+					with self.index_lock:
+						for sha1sum in sha1sums[batch_start:batch_start + self.layout_migration_batch_size]:
+							physical_file = self.physical_files.get(sha1sum)
+							if not physical_file:
+								continue
+							physical_file.resolve_layout(self.root_path)
+							if physical_file.layout is None or physical_file.layout == self.layout or physical_file.layout == chunked_layout:
+								continue
+							elif physical_file.lock_count != 0:
+								num_remaining += 1
+							else:
+								self.move_blob(physical_file, self.layout)
+								num_migrated += 1
+
+				if num_migrated:
+					logger.info("Migrated " + str(num_migrated) + " files to " + self.layout + " layout; " + str(num_remaining) + " locked files remain")
+				if not num_remaining:
+					return
+				time.sleep(self.layout_migration_retry_interval_seconds)
+
+		except Exception, e:
+			logger.error("Exception: " + e.message)
+			logger.error(traceback.format_exc())
+
+	def move_blob(self, physical_file, layout):
+		with self.index_lock:
+			source = os.path.join(self.root_path, physical_file.relative_path())
+			destination = os.path.join(self.root_path, blob_relative_path(physical_file.sha1sum, layout))
+			self.create_blob_directory(destination)
+			os.rename(source, destination)
+			physical_file.layout = layout
+
+	def create_blob_directory(self, full_path_filename):
+		directory = os.path.dirname(full_path_filename)
+		if not os.path.exists(directory):
+			os.makedirs(directory)
+
+	def add_to_index(self, filename, sha1sum, timestamp, size, id=None, layout=None):
 		""" Add a new file to the index
 			The file should be present in the stash directory tree
+			A new id will be assigned unless one is given
+			If the file's layout is not given, it will be located the first time its path is needed
 			"""
 
 		def add_physical_file(self, sha1sum):
 			if not sha1sum in self.physical_files:
-				self.physical_files[sha1sum] = PhysicalFile(sha1sum)
+				self.physical_files[sha1sum] = PhysicalFile(sha1sum, layout, size)
+				self.total_size += size
 
 			self.physical_files[sha1sum].add_ref()
 			return self.physical_files[sha1sum]
 
-		def add_stashed_file(self, filename, physical_file, timestamp, size):
-			id = str(self.unique_id)
+		def add_stashed_file(self, filename, physical_file, timestamp, size, id):
+			if id is None:
+				id = str(self.unique_id)
+				self.unique_id += 1
+				self.add_to_recently_added_files(id)
 			stashed_file = StashedFile(id, self.root_path, filename, physical_file, timestamp, size)
 			self.stashed_files[id] = stashed_file
-			self.unique_id += 1
+			self.add_to_timestamp_order(stashed_file)
 			return self.stashed_files[id]
 
 		physical_file = add_physical_file(self, sha1sum)
-		stashed_file = add_stashed_file(self, filename, physical_file, timestamp, size)
-
-		self.notify(event_type='add', stashed_file=stashed_file)
+		stashed_file = add_stashed_file(self, filename, physical_file, timestamp, size, id)
 		return stashed_file
 
+	def add_to_recently_added_files(self, id):
+		now = time.time()
+		while self.recently_added_files and self.recently_added_files.itervalues().next() < now - self.eviction_grace_period_seconds:
+			self.recently_added_files.popitem(last=False)
+		if self.eviction_grace_period_seconds:
+			self.recently_added_files[id] = now
+
+	def is_within_grace_period(self, stashed_file):
+		added_time = self.recently_added_files.get(stashed_file.file_id)
+		return added_time is not None and time.time() - added_time < self.eviction_grace_period_seconds
+
 	def remove_from_index(self, id):
 		""" Remove a file from the index
 			The file will not be removed from the stash directory tree
 			"""
+		self.recently_added_files.pop(id, None)
 		
 		def remove_stashed_file(self, id):
+			self.remove_from_timestamp_order(self.stashed_files[id])
 			del self.stashed_files[id]
 			
 		def deref_physical_file(self, physical_file):
-			return physical_file.rem_ref()
+			ref_count = physical_file.rem_ref()
+			if ref_count == 0:
+				del self.physical_files[physical_file.sha1sum]
+				self.total_size -= physical_file.size
+			return ref_count
 
 		stashed_file = self.stashed_files.get(id)
 		if not stashed_file:
@@ -204,9 +769,31 @@ class FileStash(Observable):
 		else:
 			physical_file = stashed_file.physical_file
 			remove_stashed_file(self, id)
-			self.notify(event_type='remove', stashed_file=stashed_file)
 			return deref_physical_file(self, physical_file) == 0
 
+	def add_to_timestamp_order(self, stashed_file):
+		""" Keep track of files in timestamp order
+			Files are usually added in timestamp order, so new entries are appended, and
+			sorting is deferred until the order is needed; re-sorting an almost sorted
+			list is a linear-time operation
+			"""
+		key = (stashed_file.timestamp_microseconds, stashed_file.file_id)
+		if self.timestamp_order and key < self.timestamp_order[-1]:
+			self.timestamp_order_is_sorted = False
+		self.timestamp_order.append(key)
+
+	def remove_from_timestamp_order(self, stashed_file):
+		timestamp_order = self.sorted_timestamp_order()
+		key = (stashed_file.timestamp_microseconds, stashed_file.file_id)
+		del timestamp_order[bisect.bisect_left(timestamp_order, key)]
+
+	def sorted_timestamp_order(self):
+		with self.index_lock:
+			if not self.timestamp_order_is_sorted:
+				self.timestamp_order.sort()
+				self.timestamp_order_is_sorted = True
+			return self.timestamp_order
+
 	def add(self, original_path, filename, timestamp):
 		""" Add a file to the stash
 			If the file does not yet exist in the stash directory tree, the file will be moved
@@ -214,21 +801,101 @@ class FileStash(Observable):
 			Otherwise, the file is simply deleted from its original location
 			"""
 			
-		with self.index_lock:
+		original_file = os.path.join(original_path, filename)
+
+		sha1sum = sha1_of_file(original_file)
+		size = os.stat(original_file).st_size
+
+		return self.commit_file(original_file, filename, sha1sum, timestamp, size)
+
+	def add_many(self, files):
+		""" Add several files to the stash at once
+			files is a list of (original_path, filename, timestamp) tuples
+			The files are hashed first, and then added to the index in one go, with a single
+			journal write and a single notification
+			"""
+
+		entries = []
+		for (original_path, filename, timestamp) in files:
 			original_file = os.path.join(original_path, filename)
+			entries.append((original_file, filename, sha1_of_file(original_file), timestamp, os.stat(original_file).st_size))
 
-			sha1sum = local('sha1sum -b ' + original_file, capture = True)[:40]
-			size = os.stat(original_file).st_size
+		with self.index_lock:
+			stashed_files = self.commit_files(entries)
+			self.notify(event_type='add_many', stashed_files=stashed_files)
+			self.evict_files_if_full()
+			return stashed_files
+
+	def begin_ingest(self):
+		""" Start streaming a new file into the stash
+			Write the file's contents to the returned ingest object, and then either commit() or abort() it
+			"""
 
-			file = self.add_to_index(filename, sha1sum, timestamp, size)
+		temp_file_handle, temp_filename = tempfile.mkstemp(dir=self.ingest_path)
+		os.close(temp_file_handle)
+		return FileStashIngest(self, temp_filename)
 
-			if os.path.exists(file.full_path_filename):
-				os.remove(original_file)
-			else:
-				shutil.move(original_file, file.full_path_filename)
+	def commit_ingest(self, ingest, filename, timestamp):
+		""" Add a fully written ingest to the stash, under its content hash """
 
-			self.save_index()
-			return file
+		ingest.close()
+		return self.commit_file(ingest.temp_filename, filename, ingest.sha1sum(), timestamp, ingest.size)
+
+	def add_if_content_stashed(self, filename, sha1sum, size, timestamp):
+		""" Add a file to the stash without transferring its contents, if the stash already holds identical contents
+			Returns the new file, or None if the contents need to be uploaded
+			"""
+
+		with self.index_lock:
+			self.populate_entries()
+			physical_file = self.physical_files.get(sha1sum)
+			if not physical_file or physical_file.size != size:
+				return None
+
+			stashed_file = self.add_to_index(filename, sha1sum, timestamp, size)
+			self.journal.append_add(stashed_file)
+			self.notify(event_type='add', stashed_file=stashed_file)
+			return stashed_file
+
+	def commit_file(self, source_file, filename, sha1sum, timestamp, size):
+		""" Add a file with known hash and size to the stash
+			If the contents already exist in the stash, the source file is discarded;
+			otherwise it is moved into place
+			"""
+
+		entries = [(source_file, filename, sha1sum, timestamp, size)]
+		with self.index_lock:
+			stashed_file = self.commit_files(entries)[0]
+			self.notify(event_type='add', stashed_file=stashed_file)
+			self.evict_files_if_full()
+			return stashed_file
+
+	def commit_files(self, entries):
+		""" Add files with known hashes and sizes to the index and the stash directory tree
+			entries is a list of (source_file, filename, sha1sum, timestamp, size) tuples
+			If the stash stores files as chunks, new contents are split into the chunk store in the background
+			"""
+
+		with self.index_lock:
+			self.populate_entries()
+			stashed_files = []
+			for (source_file, filename, sha1sum, timestamp, size) in entries:
+				content_already_stashed = sha1sum in self.physical_files
+
+				file = self.add_to_index(filename, sha1sum, timestamp, size, layout=self.layout)
+
+				if content_already_stashed:
+					os.remove(source_file)
+				else:
+					self.create_blob_directory(file.full_path_filename)
+					shutil.move(source_file, file.full_path_filename)
+					if self.chunk_files:
+						self.chunking_queue.put(sha1sum)
+
+				stashed_files.append(file)
+
+			self.journal.append_many([self.journal.add_record(file) for file in stashed_files])
+			return stashed_files
 
 	def remove(self, id):
 		""" Remove a file from the stash
@@ -237,54 +904,179 @@ class FileStash(Observable):
 			"""
 
 		with self.index_lock:
-			file = self.get(id)
-			if not file:
-				raise self.FileDoesNotExistError("File with id " + str(id) + " does not exist in file stash")
-			full_path_filename = file.full_path_filename
-			if file.ref_count() != 0:
-				raise self.FileCannotBeRemovedError("File with id " + str(id) + " has nonzero refcount and cannot be removed")
-			else:
-				if self.remove_from_index(id):
-					os.remove(full_path_filename)
-				
-			self.save_index()
+			removed_files, failures = self.remove_files([id])
+			if failures:
+				raise failures[id]
+			self.notify(event_type='remove', stashed_file=removed_files[0])
+
+	def remove_many(self, ids):
+		""" Remove several files from the stash at once, with a single journal write and a single notification
+			Files which do not exist, or are locked, are skipped
+			Returns the removed files, and a map from the ids of skipped files to the corresponding errors
+			"""
 
-	def remove_all_unlocked_files(self):
 		with self.index_lock:
-			ids = self.stashed_files.keys()[:]
+			removed_files, failures = self.remove_files(ids)
+			if removed_files:
+				self.notify(event_type='remove_many', stashed_files=removed_files)
+			return removed_files, failures
+
+	def remove_files(self, ids):
+		with self.index_lock:
+			self.populate_entries()
+			removed_files = []
+			failures = {}
 			for id in ids:
-				try:
-					self.remove(id)
-				except self.Error:
-					pass
+				file = self.get(id)
+				if not file:
+					failures[id] = self.FileDoesNotExistError("File with id " + str(id) + " does not exist in file stash")
+				elif file.ref_count() != 0:
+					failures[id] = self.FileCannotBeRemovedError("File with id " + str(id) + " has nonzero refcount and cannot be removed")
+				else:
+					physical_file = file.physical_file
+					physical_file.resolve_layout(self.root_path)
+					if self.remove_from_index(id):
+						self.remove_blob(physical_file)
+					removed_files.append(file)
+
+			self.journal.append_many([self.journal.remove_record(file.file_id) for file in removed_files])
+			return removed_files, failures
+
+	def remove_blob(self, physical_file):
+		if physical_file.layout == chunked_layout:
+			self.chunk_store.remove(physical_file.sha1sum)
+		else:
+			self.discard_blob(os.path.join(self.root_path, physical_file.relative_path()))
+
+	def discard_blob(self, full_path_filename):
+		""" Remove a blob from the stash directory tree
+			The blob is moved into the trash directory, which is quick regardless of file size, and
+			then deleted in the background; this way, the index lock is not held while the file system
+			reclaims the space
+			"""
+
+		with self.trash_lock:
+			self.trash_id += 1
+			trash_filename = os.path.join(self.trash_path, os.path.basename(full_path_filename) + '.' + str(self.trash_id))
+			try:
+				os.rename(full_path_filename, trash_filename)
+			except OSError, e:
+				if e.errno == errno.ENOENT:
+					return
+				raise
+			self.deletion_queue.put(trash_filename)
+
+	def evict_files_if_full(self):
+		""" Remove files until the stash is within its size limit, in the order given by the eviction policy
+			Locked files are never evicted. Neither are files whose contents are shared with other
+			stashed files, since removing them would not free any space, nor files that were added within
+			the policy's grace period (see eviction_policies)
+			Returns the evicted files
+			"""
+
+		with self.index_lock:
+			self.populate_entries()
+			if not self.max_size_bytes or self.total_size <= self.max_size_bytes:
+				return []
+
+			candidates = [file for file in self.stashed_files.itervalues() if file.ref_count() == 0 and file.physical_file.ref_count() == 1 and not self.is_within_grace_period(file)]
+			candidates.sort(key=self.eviction_policy)
+
+			bytes_to_free = self.total_size - self.max_size_bytes
+			ids = []
+			for file in candidates:
+				if bytes_to_free <= 0:
+					break
+				ids.append(file.file_id)
+				bytes_to_free -= file.physical_file.size
+
+			evicted_files, failures = self.remove_many(ids)
+			logger.info("Evicted " + str(len(evicted_files)) + " files; file stash size is now " + str(self.total_size) + " bytes")
+			if self.total_size > self.max_size_bytes:
+				logger.warning("File stash size is " + str(self.total_size) + " bytes, which exceeds the limit of " + str(self.max_size_bytes) + " bytes, but no more files can be evicted")
+			return evicted_files
+
+	def record_distribution(self, stashed_file):
+		""" Update the access statistics used by eviction policies; they are persisted with the index """
+		with self.index_lock:
+			stashed_file.last_distribution_time = datetime.datetime.utcnow()
+			stashed_file.distribution_count += 1
+			if self.stashed_files.get(stashed_file.file_id) is stashed_file:
+				self.journal.append_add(stashed_file)
+
+	def remove_all_unlocked_files(self):
+		with self.index_lock:
+			self.populate_entries()
+			self.remove_many(self.stashed_files.keys())
 	
 	def list(self):
 		with self.index_lock:
+			self.populate_entries()
 			return self.stashed_files.values()[:]
+
+	def list_sorted(self):
+		""" List all files, oldest first """
+		with self.index_lock:
+			self.populate_entries()
+			return [self.stashed_files[id] for (timestamp, id) in self.sorted_timestamp_order()]
+
+	def list_older_than(self, timestamp):
+		""" List all files which were added before a given point in time, oldest first """
+		with self.index_lock:
+			self.populate_entries()
+			timestamp_order = self.sorted_timestamp_order()
+			end = bisect.bisect_left(timestamp_order, (datetime_to_microseconds(timestamp), ))
+			return [self.stashed_files[id] for (file_timestamp, id) in timestamp_order[:end]]
 	
 	def get(self, id):
 		""" Locate the index entry for a file, or return None if it does not exist """
 		with self.index_lock:
+			self.populate_entry(id)
 			return self.stashed_files.get(id)
 
 	def lock(self, id):
 		""" Protect a stashed file from deletion """
+		return self.lock_many([id])[0]
+
+	def lock_many(self, ids):
+		""" Protect several stashed files from deletion, with a single notification
+			Either all files are locked, or none of them are
+			"""
 		with self.index_lock:
-			stashed_file = self.get(id)
-			if not stashed_file:
-				raise self.FileDoesNotExistError("File with id " + str(id) + " does not exist in file stash")
-			else:
+			stashed_files = []
+			for id in ids:
+				stashed_file = self.get(id)
+				if not stashed_file:
+					raise self.FileDoesNotExistError("File with id " + str(id) + " does not exist in file stash")
+				stashed_files.append(stashed_file)
+
+			for stashed_file in stashed_files:
 				stashed_file.add_ref()
-				self.notify(event_type='change', stashed_file=stashed_file)
-				return stashed_file
+				stashed_file.physical_file.lock_count += 1
+
+			self.notify_change(stashed_files)
+			return stashed_files
 
 	def unlock(self, stashed_file):
 		""" Unprotect a stashed file from deletion
 			The marking is done using reference counts, so a file will only become deletable
 			when all lock() calls on it have been matched with unlock() calls """
+		self.unlock_many([stashed_file])
+
+	def unlock_many(self, stashed_files):
+		""" Unprotect several stashed files from deletion, with a single notification """
 		with self.index_lock:
-			stashed_file.rem_ref()
-			self.notify(event_type='change', stashed_file=stashed_file)
+			for stashed_file in stashed_files:
+				stashed_file.rem_ref()
+				stashed_file.physical_file.lock_count -= 1
+
+			self.notify_change(stashed_files)
+
+	def notify_change(self, stashed_files):
+		if len(stashed_files) == 1:
+			self.notify(event_type='change', stashed_file=stashed_files[0])
+		else:
+			self.notify(event_type='change_many', stashed_files=stashed_files)
 	
 
 class StashedFileUnitTest(unittest.TestCase):
@@ -324,8 +1116,11 @@ class FileStashUnitTest(unittest.TestCase):
 
 	def test(self):
 
-		def notification(event_type, stashed_file):
-			print event_type + " " + str(stashed_file.file_id)
+		def notification(event_type, stashed_file=None, stashed_files=None):
+			if stashed_file:
+				print event_type + " " + str(stashed_file.file_id)
+			else:
+				print event_type + " " + str([stashed_file.file_id for stashed_file in stashed_files])
 
 		# Add two files to initial stash
 		file_stash_init = FileStash('unittest/file_stash', None, None)
@@ -401,10 +1196,394 @@ class FileStashUnitTest(unittest.TestCase):
 		# At this point, only the first two files should remain in the stash
 		self.assertEquals(len(file_stash.stashed_files), 2)
 
+		# Replaying the journal should yield the same stash contents
+		self.assertEquals(sorted(file_stash.journal.load().keys()), sorted(file_stash.stashed_files.keys()))
+
+		# Compacting the journal should not change the stash contents either
+		file_stash.compact_index()
+		self.assertEquals(sorted(file_stash.journal.load().keys()), sorted(file_stash.stashed_files.keys()))
+
 		# Remove all files from stash
 		file_stash.remove_all_unlocked_files()
 		self.assertEquals(len(file_stash.stashed_files), 0)
 
+	def test_ingest(self):
+
+		file_stash = FileStash('unittest/file_stash', None, None)
+
+		# Stream a file into the stash in several pieces
+		ingest = file_stash.begin_ingest()
+		ingest.write('Hello ')
+		ingest.write('World 1\n')
+		file1 = ingest.commit(self.file1_name, datetime.datetime.utcnow())
+		self.assertEquals(file1.physical_file.sha1sum, self.file1_sha1sum)
+		self.assertEquals(file1.size, 14)
+		self.assertTrue(os.path.exists(file1.full_path_filename))
+
+		# Ingesting identical contents should reuse the existing physical file
+		ingest = file_stash.begin_ingest()
+		ingest.write('Hello World 1\n')
+		file4 = ingest.commit(self.file4_name, datetime.datetime.utcnow())
+		self.assertNotEquals(file1.file_id, file4.file_id)
+		self.assertEquals(file1.physical_file, file4.physical_file)
+
+		# Contents should be stored again after all earlier references to them have been removed
+		file_stash.remove(file1.file_id)
+		file_stash.remove(file4.file_id)
+		self.assertFalse(os.path.exists(file1.full_path_filename))
+		ingest = file_stash.begin_ingest()
+		ingest.write('Hello World 1\n')
+		file1 = ingest.commit(self.file1_name, datetime.datetime.utcnow())
+		ingest = file_stash.begin_ingest()
+		ingest.write('Hello World 1\n')
+		file4 = ingest.commit(self.file4_name, datetime.datetime.utcnow())
+		self.assertTrue(os.path.exists(file1.full_path_filename))
+
+		# Aborted ingests should not add anything to the stash
+		ingest = file_stash.begin_ingest()
+		ingest.write('Hello World 2\n')
+		ingest.abort()
+		self.assertEquals(len(file_stash.stashed_files), 2)
+
+		# Files whose contents are already stashed can be added by hash alone
+		file5 = file_stash.add_if_content_stashed(self.file5_name, self.file1_sha1sum, 14, datetime.datetime.utcnow())
+		self.assertEquals(file5.physical_file, file1.physical_file)
+		self.assertEquals(file_stash.add_if_content_stashed(self.file5_name, self.file1_sha1sum, 15, datetime.datetime.utcnow()), None)
+		self.assertEquals(file_stash.add_if_content_stashed(self.file2_name, self.file2_sha1sum, 14, datetime.datetime.utcnow()), None)
+		self.assertEquals(len(file_stash.stashed_files), 3)
+
+		# No temporary files should remain once the ingests have completed
+		self.assertEquals(os.listdir(file_stash.ingest_path), [])
+
+	def test_bulk_operations(self):
+
+		notifications = []
+		def notification(**kwargs):
+			notifications.append(kwargs)
+
+		file_stash = FileStash('unittest/file_stash', None, None)
+		file_stash.subscribe(notification)
+
+		local('echo "Hello World 1" > unittest/' + self.file1_name)
+		local('echo "Hello World 2" > unittest/' + self.file2_name)
+		local('echo "Hello World 3" > unittest/' + self.file3_name)
+		now = datetime.datetime.utcnow()
+		files = file_stash.add_many([('unittest', self.file1_name, now), ('unittest', self.file2_name, now), ('unittest', self.file3_name, now)])
+		self.assertEquals([file.physical_file.sha1sum for file in files], [self.file1_sha1sum, self.file2_sha1sum, self.file3_sha1sum])
+		self.assertEquals(len(notifications), 1)
+		self.assertEquals(notifications[-1]['event_type'], 'add_many')
+		self.assertEquals(notifications[-1]['stashed_files'], files)
+
+		# Locking several files should either lock all of them, or none of them
+		self.assertRaises(FileStash.FileDoesNotExistError, file_stash.lock_many, [files[0].file_id, '12345678'])
+		self.assertEquals(files[0].ref_count(), 0)
+		locked_files = file_stash.lock_many([files[0].file_id, files[1].file_id])
+		self.assertEquals(notifications[-1]['event_type'], 'change_many')
+
+		# Locked and nonexistent files should be skipped during removal
+		removed_files, failures = file_stash.remove_many([file.file_id for file in files] + ['12345678'])
+		self.assertEquals(removed_files, [files[2]])
+		self.assertTrue(isinstance(failures[files[0].file_id], FileStash.FileCannotBeRemovedError))
+		self.assertTrue(isinstance(failures['12345678'], FileStash.FileDoesNotExistError))
+		self.assertFalse(os.path.exists(files[2].full_path_filename))
+
+		file_stash.unlock_many(locked_files)
+		num_notifications = len(notifications)
+		file_stash.remove_all_unlocked_files()
+		self.assertEquals(len(file_stash.list()), 0)
+		self.assertEquals(len(notifications), num_notifications + 1)
+		self.assertEquals(notifications[-1]['event_type'], 'remove_many')
+
+		# Blobs should be deleted from the trash directory in the background
+		file_stash.wait_for_deletions()
+		self.assertEquals(os.listdir(file_stash.trash_path), [])
+
+		# The journal should reflect the results of all batch operations
+		self.assertEquals(file_stash.journal.load(), {})
+
+	def test_eviction(self):
+
+		now = datetime.datetime.utcnow()
+		file_stash = FileStash('unittest/file_stash', None, None, max_size_bytes=45, eviction_policy='lru')
+
+		# Each file is 14 bytes large; file 5 shares contents with file 3
+		local('echo "Hello World 1" > unittest/' + self.file1_name)
+		file1 = file_stash.add('unittest', self.file1_name, now - datetime.timedelta(days=4))
+		local('echo "Hello World 2" > unittest/' + self.file2_name)
+		file2 = file_stash.add('unittest', self.file2_name, now - datetime.timedelta(days=3))
+		local('echo "Hello World 3" > unittest/' + self.file3_name)
+		file3 = file_stash.add('unittest', self.file3_name, now - datetime.timedelta(days=2))
+		local('echo "Hello World 3" > unittest/' + self.file5_name)
+		file5 = file_stash.add('unittest', self.file5_name, now - datetime.timedelta(days=1))
+		self.assertEquals(file_stash.total_size, 42)
+		self.assertEquals(len(file_stash.list()), 4)
+
+		# Locked files, and files with shared contents, should not be evicted
+		file_stash.lock(file1.file_id)
+		local('echo "Hello World 4" > unittest/' + self.file4_name)
+		file4 = file_stash.add('unittest', self.file4_name, now)
+		self.assertEquals(file_stash.get(file2.file_id), None)
+		self.assertEquals(file_stash.total_size, 42)
+		self.assertEquals(sorted(file_stash.list()), sorted([file1, file3, file4, file5]))
+
+		# Once the shared contents are only referenced by one file, that file may be evicted
+		file_stash.lock(file4.file_id)
+		file_stash.max_size_bytes = 30
+		self.assertEquals(file_stash.evict_files_if_full(), [])
+		file_stash.remove(file5.file_id)
+		self.assertEquals(file_stash.evict_files_if_full(), [file3])
+		self.assertEquals(file_stash.total_size, 28)
+
+		# Least recently distributed files should be evicted first
+		file_stash.unlock_many([file1, file4])
+		file_stash.record_distribution(file1)
+		file_stash.max_size_bytes = 20
+		self.assertEquals(file_stash.evict_files_if_full(), [file4])
+
+		# Other policies should rank files by distribution count, or by age
+		file4.distribution_count = 2
+		file_stash.record_distribution(file4)
+		self.assertEquals(sorted([file1, file4], key=eviction_policies.get('lru')), [file1, file4])
+		self.assertEquals(sorted([file1, file4], key=eviction_policies.get('lfu')), [file1, file4])
+		self.assertEquals(sorted([file4, file1], key=eviction_policies.get('oldest')), [file1, file4])
+
+		# Distribution statistics should survive a restart
+		file_stash.journal.close()
+		for trust_index in [False, True]:
+			file_stash = FileStash('unittest/file_stash', None, None, trust_index=trust_index)
+			self.assertEquals(file_stash.get(file1.file_id).distribution_count, 1)
+			self.assertEquals(file_stash.get(file1.file_id).last_distribution_time, file1.last_distribution_time)
+			file_stash.journal.close()
+
+	def test_eviction_grace_period(self):
+
+		now = datetime.datetime.utcnow()
+		file_stash = FileStash('unittest/file_stash', None, None, max_size_bytes=30, eviction_policy='lfu')
+		file_stash.eviction_grace_period_seconds = 0.5
+		local('echo "Hello World 1" > unittest/' + self.file1_name)
+		file1 = file_stash.add('unittest', self.file1_name, now - datetime.timedelta(days=2))
+		local('echo "Hello World 2" > unittest/' + self.file2_name)
+		file2 = file_stash.add('unittest', self.file2_name, now - datetime.timedelta(days=1))
+		file_stash.record_distribution(file1)
+		time.sleep(0.6)
+
+		# A file that has just been added should not be evicted, even though it has never been distributed
+		local('echo "Hello World 3" > unittest/' + self.file3_name)
+		file3 = file_stash.add('unittest', self.file3_name, now - datetime.timedelta(days=3))
+		self.assertEquals(sorted(file_stash.list()), sorted([file1, file3]))
+
+		# Once its grace period is over, it should be ranked like any other file
+		time.sleep(0.6)
+		file_stash.max_size_bytes = 20
+		self.assertEquals(file_stash.evict_files_if_full(), [file3])
+
+	def test_timestamp_order(self):
+
+		file_stash = FileStash('unittest/file_stash', None, None)
+		now = datetime.datetime.utcnow()
+		local('echo "Hello World 1" > unittest/' + self.file1_name)
+		file1 = file_stash.add('unittest', self.file1_name, now - datetime.timedelta(days=3))
+		local('echo "Hello World 2" > unittest/' + self.file2_name)
+		file2 = file_stash.add('unittest', self.file2_name, now - datetime.timedelta(days=1))
+		# Files do not need to be added in timestamp order
+		local('echo "Hello World 3" > unittest/' + self.file3_name)
+		file3 = file_stash.add('unittest', self.file3_name, now - datetime.timedelta(days=2))
+		local('echo "Hello World 4" > unittest/' + self.file4_name)
+		file4 = file_stash.add('unittest', self.file4_name, now)
+
+		self.assertEquals(file_stash.list_sorted(), [file1, file3, file2, file4])
+		self.assertEquals(file_stash.list_older_than(now - datetime.timedelta(hours=36)), [file1, file3])
+
+		file_stash.remove(file3.file_id)
+		self.assertEquals(file_stash.list_sorted(), [file1, file2, file4])
+		self.assertEquals(file_stash.list_older_than(now - datetime.timedelta(hours=36)), [file1])
+		self.assertEquals(file_stash.list_older_than(now - datetime.timedelta(days=4)), [])
+
+	def test_trusted_index(self):
+
+		file_stash_init = FileStash('unittest/file_stash', None, None)
+		local('echo "Hello World 1" > unittest/' + self.file1_name)
+		local('echo "Hello World 2" > unittest/' + self.file2_name)
+		local('echo "Hello World 3" > unittest/' + self.file3_name)
+		file1 = file_stash_init.add('unittest', self.file1_name, datetime.datetime.utcnow())
+		file2 = file_stash_init.add('unittest', self.file2_name, datetime.datetime.utcnow())
+		file3 = file_stash_init.add('unittest', self.file3_name, datetime.datetime.utcnow())
+		file_stash_init.journal.close()
+
+		# Make the directory tree disagree with the index: one file is missing, and one is not referenced
+		os.remove(file2.full_path_filename)
+		local('echo "Orphan" > unittest/file_stash/' + self.file4_sha1sum)
+
+		# The persisted index should be served as-is, with the same ids, until reconciliation has completed
+		file_stash = FileStash('unittest/file_stash', None, None, trust_index=True)
+		self.assertEquals(file_stash.get(file1.file_id).physical_file.sha1sum, self.file1_sha1sum)
+		self.assertEquals(file_stash.get(file1.file_id).timestamp, file1.timestamp)
+		self.assertEquals(file_stash.get(file3.file_id).original_filename, self.file3_name)
+
+		for i in range(100):
+			if file_stash.get_reconciliation_progress()['state'] == 'completed':
+				break
+			time.sleep(0.1)
+
+		progress = file_stash.get_reconciliation_progress()
+		self.assertEquals(progress['state'], 'completed')
+		self.assertEquals(progress['missing_files_removed'], 1)
+		self.assertEquals(progress['orphan_files_removed'], 1)
+		self.assertEquals(file_stash.get(file2.file_id), None)
+		self.assertNotEquals(file_stash.get(file3.file_id), None)
+		self.assertFalse(os.path.exists('unittest/file_stash/' + self.file4_sha1sum))
+
+		# New files should not reuse the ids of files in the persisted index
+		local('echo "Hello World 4" > unittest/' + self.file4_name)
+		file4 = file_stash.add('unittest', self.file4_name, datetime.datetime.utcnow())
+		self.assertTrue(int(file4.file_id) > int(file3.file_id))
+
+		# Loaded entries should be served one by one before they have all been added to the index, and
+		#  operations on the whole index should add the rest first
+		file_ids = sorted([stashed_file.file_id for stashed_file in file_stash.list()])
+		with file_stash.index_lock:
+			file_stash.load_index()
+			self.assertEquals(file_stash.stashed_files, {})
+			self.assertEquals(file_stash.get(file3.file_id).original_filename, self.file3_name)
+			self.assertEquals(file_stash.stashed_files.keys(), [file3.file_id])
+			self.assertEquals(sorted([stashed_file.file_id for stashed_file in file_stash.list()]), file_ids)
+			self.assertEquals(file_stash.unpopulated_entries, {})
+
+	def test_sharded_layout(self):
+
+		def wait_until(condition):
+			for i in range(100):
+				if condition():
+					return
+				time.sleep(0.1)
+
+		# Create a stash with flat layout, containing some leftover junk
+		file_stash_init = FileStash('unittest/file_stash', None, None)
+		local('echo "Hello World 1" > unittest/' + self.file1_name)
+		local('echo "Hello World 2" > unittest/' + self.file2_name)
+		file1 = file_stash_init.add('unittest', self.file1_name, datetime.datetime.utcnow())
+		file2 = file_stash_init.add('unittest', self.file2_name, datetime.datetime.utcnow())
+		self.assertTrue(os.path.exists('unittest/file_stash/' + self.file1_sha1sum))
+		file_stash_init.journal.close()
+		os.mkdir('unittest/file_stash/junk')
+
+		# Switching to sharded layout should migrate existing files in the background
+		file_stash = FileStash('unittest/file_stash', None, None, layout=sharded_layout)
+		self.assertFalse(os.path.exists('unittest/file_stash/junk'))
+		file1_sharded_path = 'unittest/file_stash/a2/ab/' + self.file1_sha1sum
+		wait_until(lambda: os.path.exists(file1_sharded_path))
+		self.assertTrue(os.path.exists(file1_sharded_path))
+		self.assertEquals(file_stash.get(file1.file_id).full_path_filename, file1_sharded_path)
+
+		# New files should be stored directly in sharded layout
+		local('echo "Hello World 3" > unittest/' + self.file3_name)
+		file3 = file_stash.add('unittest', self.file3_name, datetime.datetime.utcnow())
+		self.assertEquals(file3.full_path_filename, 'unittest/file_stash/ca/44/' + self.file3_sha1sum)
+		self.assertTrue(os.path.exists(file3.full_path_filename))
+
+		# Files that are streamed in, or that share contents with stashed files, should end up in the same shards
+		ingest = file_stash.begin_ingest()
+		ingest.write('Hello World 3\n')
+		file5 = file_stash.commit_ingest(ingest, self.file5_name, datetime.datetime.utcnow())
+		self.assertEquals(file5.full_path_filename, file3.full_path_filename)
+		file_stash.remove(file5.file_id)
+		self.assertTrue(os.path.exists(file3.full_path_filename))
+		file_stash.journal.close()
+
+		# Rebuilding the index should find the files in their shards, and leave them there
+		file_stash = FileStash('unittest/file_stash', None, None, layout=sharded_layout)
+		self.assertEquals(file_stash.get(file3.file_id).full_path_filename, 'unittest/file_stash/ca/44/' + self.file3_sha1sum)
+		self.assertEquals(len(file_stash.list()), 3)
+		file_stash.journal.close()
+
+		# A trusted index should locate sharded files without any reconciliation
+		file_stash = FileStash('unittest/file_stash', None, None, trust_index=True, layout=sharded_layout)
+		self.assertEquals(file_stash.get(file3.file_id).full_path_filename, 'unittest/file_stash/ca/44/' + self.file3_sha1sum)
+		wait_until(lambda: file_stash.get_reconciliation_progress()['state'] == 'completed')
+		self.assertEquals(len(file_stash.list()), 3)
+
+		# Removing a file should remove it from its shard
+		file_stash.remove(file3.file_id)
+		self.assertFalse(os.path.exists('unittest/file_stash/ca/44/' + self.file3_sha1sum))
+		file_stash.journal.close()
+
+		# Migration back to flat layout should leave locked files alone until they have been unlocked
+		file_stash = FileStash('unittest/file_stash', None, None, layout=sharded_layout)
+		file_stash.lock(file1.file_id)
+		file_stash.layout = flat_layout
+		file_stash.layout_migration_retry_interval_seconds = 0.1
+		migration_thread = threading.Thread(target=file_stash.migrate_layout)
+		migration_thread.start()
+		wait_until(lambda: os.path.exists('unittest/file_stash/' + self.file2_sha1sum))
+		self.assertTrue(os.path.exists(file1_sharded_path))
+		file_stash.unlock(file_stash.get(file1.file_id))
+		migration_thread.join()
+		self.assertTrue(os.path.exists('unittest/file_stash/' + self.file1_sha1sum))
+		self.assertEquals(file_stash.get(file1.file_id).full_path_filename, 'unittest/file_stash/' + self.file1_sha1sum)
+
+	def test_chunk_store(self):
+
+		file_stash = FileStash('unittest/file_stash', None, None, chunk_files=True, average_chunk_size=1024)
+		now = datetime.datetime.utcnow()
+
+		# Two versions of a file that differ in a small region should share most of their chunks
+		data = ''.join([chr(i * 7 % 251) for i in range(16 * 1024)]) + os.urandom(16 * 1024)
+		modified_data = data[:20000] + 'modified' + data[20008:]
+		with open('unittest/version1', 'wb') as file:
+			file.write(data)
+		file1 = file_stash.add('unittest', 'version1', now)
+		with open('unittest/version2', 'wb') as file:
+			file.write(modified_data)
+		file2 = file_stash.add('unittest', 'version2', now)
+
+		# Files should be split into the chunk store in the background, after they have been added
+		file_stash.wait_for_chunking()
+		self.assertEquals(file1.physical_file.layout, chunked_layout)
+		self.assertFalse(os.path.exists('unittest/version1'))
+		self.assertFalse(os.path.exists('unittest/file_stash/' + file1.physical_file.sha1sum))
+		self.assertEquals(file1.manifest_path, 'unittest/file_stash/' + manifest_relative_path(file1.physical_file.sha1sum))
+		self.assertRaises(Exception, getattr, file1, 'full_path_filename')
+		self.assertTrue(file_stash.chunk_store.stored_size() < len(data) * 3 / 2)
+
+		# Locked files should not be chunked until they have been unlocked
+		with open('unittest/version3', 'wb') as file:
+			file.write(data + 'appended')
+		file_stash.chunking_retry_interval_seconds = 0.1
+		with file_stash.index_lock:
+			file3 = file_stash.add('unittest', 'version3', now)
+			file_stash.lock(file3.file_id)
+		file_stash.wait_for_chunking()
+		self.assertEquals(file3.physical_file.layout, flat_layout)
+		self.assertEquals(file3.manifest_path, None)
+		file_stash.unlock(file3)
+		time.sleep(0.5)
+		file_stash.wait_for_chunking()
+		self.assertEquals(file3.physical_file.layout, chunked_layout)
+		file_stash.remove(file3.file_id)
+
+		# Chunked files should read back as their original contents
+		with file_stash.get(file2.file_id).open() as reader:
+			self.assertEquals(reader.read(), modified_data)
+
+		# Chunked files should survive a restart, and be readable even before their layout is known
+		file_stash.journal.close()
+		file_stash = FileStash('unittest/file_stash', None, None)
+		with file_stash.get(file1.file_id).open() as reader:
+			self.assertEquals(reader.read(), data)
+		file_stash.journal.close()
+		file_stash = FileStash('unittest/file_stash', None, None, trust_index=True)
+		with file_stash.get(file2.file_id).open() as reader:
+			self.assertEquals(reader.read(), modified_data)
+
+		# Removing files should release their chunks
+		file_stash.remove(file1.file_id)
+		file_stash.remove(file2.file_id)
+		file_stash.wait_for_deletions()
+		self.assertEquals(file_stash.chunk_store.chunk_refs, {})
+		self.assertEquals(file_stash.chunk_store.stored_size(), 0)
+		for root, dirs, files in os.walk('unittest/file_stash/chunks'):
+			self.assertEquals(files, [])
+
 	def tearDown(self):
 		shutil.rmtree('unittest')
 
@@ -0,0 +1,258 @@
+import json
+import logging
+import os
+import os.path
+import shutil
+import threading
+import time
+import traceback
+import unittest
+
+logger = logging.getLogger('FileStashJournal')
+
+class FileStashJournal(object):
+	""" Persistent storage for the file stash index
+
+		The index is stored as a snapshot of all entries plus an append-only journal
+		of the add/remove operations that have happened since the snapshot was written.
+		Records are written to the OS as they are appended, and fsync()ed in batches.
+		Once the journal has grown large enough, it is compacted into a new snapshot.
+		"""
+
+	snapshot_filename = 'index.json'
+	journal_filename = 'index.journal'
+	compacting_journal_filename = 'index.journal.compacting'
+
+	def __init__(self, root_path, sync_interval_seconds):
+		self.root_path = root_path
+		self.snapshot_path = os.path.join(root_path, self.snapshot_filename)
+		self.journal_path = os.path.join(root_path, self.journal_filename)
+		self.compacting_journal_path = os.path.join(root_path, self.compacting_journal_filename)
+		self.sync_interval_seconds = sync_interval_seconds
+		self.journal_lock = threading.RLock()
+		self.journal_file = None
+		self.num_records = 0
+		self.num_unsynced_records = 0
+
+	def load(self):
+		""" Read back the index, by replaying all journal records on top of the latest snapshot
+			Replay is idempotent, so a journal which was left over from an interrupted compaction
+			can safely be replayed on top of the snapshot that the compaction produced
+			"""
+
+		index = {}
+		try:
+			with open(self.snapshot_path) as snapshot_file:
+				index = json.load(snapshot_file)
+		except IOError:
+			pass
+
+		for journal_path in [self.compacting_journal_path, self.journal_path]:
+			self.replay(journal_path, index)
+
+		return index
+
+	def replay(self, journal_path, index):
+		try:
+			with open(journal_path) as journal_file:
+				for line in journal_file:
+					try:
+						record = json.loads(line)
+					except ValueError:
+						# A record that was only partially written when the server stopped
+						logger.warning("Ignoring incomplete record in " + journal_path)
+						continue
+
+					if record['op'] == 'add':
+						index[record['id']] = record['entry']
+					elif record['op'] == 'remove':
+						index.pop(record['id'], None)
+					else:
+						raise Exception("Unknown journal record type: " + record['op'])
+		except IOError:
+			pass
+
+	def write_snapshot(self, index):
+		""" Atomically replace the snapshot, and discard all journal records that it supersedes
+			Records appended after the last rotate() are kept
+			"""
+
+		temp_snapshot_path = self.snapshot_path + '.tmp'
+		with open(temp_snapshot_path, 'w') as snapshot_file:
+			json.dump(index, snapshot_file)
+			snapshot_file.flush()
+			os.fsync(snapshot_file.fileno())
+		os.rename(temp_snapshot_path, self.snapshot_path)
+
+		if os.path.exists(self.compacting_journal_path):
+			os.remove(self.compacting_journal_path)
+
+	def reset(self, index):
+		""" Replace all persisted state with a snapshot of the given index, and start a new journal """
+
+		with self.journal_lock:
+			self.rotate()
+			self.write_snapshot(index)
+
+	def rotate(self):
+		""" Move the current journal aside, so that a snapshot of the index can be written
+			without holding up further appends
+			A journal which is still set aside, because an earlier snapshot was never written, holds records that
+			no snapshot contains yet; the current journal is appended to it rather than replacing it
+			"""
+
+		with self.journal_lock:
+			self.close()
+			if os.path.exists(self.journal_path):
+				if os.path.exists(self.compacting_journal_path):
+					self.append_journal(self.journal_path, self.compacting_journal_path)
+					os.remove(self.journal_path)
+				else:
+					os.rename(self.journal_path, self.compacting_journal_path)
+			self.journal_file = open(self.journal_path, 'a')
+			self.num_records = 0
+
+	def append_journal(self, source_path, destination_path):
+		""" Append the records of one journal to another, and fsync() the result """
+
+		with open(destination_path, 'a+') as destination_file:
+			# Start on a new line, in case the last record of the destination was only partially written
+			destination_file.seek(0, os.SEEK_END)
+			if destination_file.tell() > 0:
+				destination_file.seek(-1, os.SEEK_END)
+				if destination_file.read(1) != '\n':
+					destination_file.write('\n')
+			with open(source_path) as source_file:
+				shutil.copyfileobj(source_file, destination_file)
+			destination_file.flush()
+			os.fsync(destination_file.fileno())
+
+	def append(self, record):
+		self.append_many([record])
+
+	def append_many(self, records):
+		""" Append a group of records to the journal, with a single write """
+		if not records:
+			return
+		with self.journal_lock:
+			if not self.journal_file:
+				self.journal_file = open(self.journal_path, 'a')
+			self.journal_file.write(''.join([json.dumps(record) + '\n' for record in records]))
+			self.journal_file.flush()
+			self.num_records += len(records)
+			self.num_unsynced_records += len(records)
+			if not self.sync_interval_seconds:
+				self.sync()
+
+	def add_record(self, stashed_file):
+		return { 'op' : 'add', 'id' : stashed_file.file_id, 'entry' : stashed_file.to_json() }
+
+	def remove_record(self, id):
+		return { 'op' : 'remove', 'id' : id }
+
+	def append_add(self, stashed_file):
+		self.append(self.add_record(stashed_file))
+
+	def append_remove(self, id):
+		self.append(self.remove_record(id))
+
+	def sync(self):
+		with self.journal_lock:
+			if self.journal_file and self.num_unsynced_records:
+				os.fsync(self.journal_file.fileno())
+				self.num_unsynced_records = 0
+
+	def close(self):
+		with self.journal_lock:
+			if self.journal_file:
+				self.sync()
+				self.journal_file.close()
+				self.journal_file = None
+
+	def record_count(self):
+		with self.journal_lock:
+			return self.num_records
+
+	def start_maintenance_thread(self, compaction_threshold, compact):
+		""" Periodically fsync() the journal, and invoke compact() whenever it has grown too large """
+
+		def maintenance_thread():
+			while True:
+				time.sleep(self.sync_interval_seconds)
+				try:
+					self.sync()
+					if compaction_threshold and self.record_count() >= compaction_threshold:
+						compact()
+				except Exception, e:
+					logger.error("Exception: " + e.message)
+					logger.error(traceback.format_exc())
+
+		thread = threading.Thread(target=maintenance_thread)
+		thread.daemon = True
+		thread.start()
+
+class FileStashJournalUnitTest(unittest.TestCase):
+
+	root_path = 'unittest'
+
+	def setUp(self):
+		os.mkdir(self.root_path)
+
+	def test_replay(self):
+
+		journal = FileStashJournal(self.root_path, sync_interval_seconds=None)
+		journal.reset({ '0' : { 'sha1sum' : 'a' }, '1' : { 'sha1sum' : 'b' } })
+		journal.append_many([{ 'op' : 'add', 'id' : '2', 'entry' : { 'sha1sum' : 'c' } }, journal.remove_record('0')])
+		journal.close()
+
+		# Journal records should be applied on top of the snapshot
+		index = FileStashJournal(self.root_path, sync_interval_seconds=None).load()
+		self.assertEquals(sorted(index.keys()), ['1', '2'])
+
+		# A partially written record at the end of the journal should be ignored
+		with open(journal.journal_path, 'a') as journal_file:
+			journal_file.write('{ "op" : "remo')
+		index = FileStashJournal(self.root_path, sync_interval_seconds=None).load()
+		self.assertEquals(sorted(index.keys()), ['1', '2'])
+
+	def test_compaction(self):
+
+		journal = FileStashJournal(self.root_path, sync_interval_seconds=None)
+		journal.reset({})
+		journal.append({ 'op' : 'add', 'id' : '0', 'entry' : { 'sha1sum' : 'a' } })
+
+		# Records appended while a snapshot is being written should survive the compaction
+		journal.rotate()
+		journal.append({ 'op' : 'add', 'id' : '1', 'entry' : { 'sha1sum' : 'b' } })
+		self.assertEquals(sorted(FileStashJournal(self.root_path, sync_interval_seconds=None).load().keys()), ['0', '1'])
+		journal.write_snapshot({ '0' : { 'sha1sum' : 'a' } })
+		journal.close()
+
+		self.assertFalse(os.path.exists(journal.compacting_journal_path))
+		self.assertEquals(sorted(FileStashJournal(self.root_path, sync_interval_seconds=None).load().keys()), ['0', '1'])
+
+	def test_interrupted_compaction(self):
+
+		journal = FileStashJournal(self.root_path, sync_interval_seconds=None)
+		journal.reset({})
+		journal.append_many([{ 'op' : 'add', 'id' : '0', 'entry' : { 'sha1sum' : 'a' } }, { 'op' : 'add', 'id' : '3', 'entry' : { 'sha1sum' : 'd' } }])
+
+		# A compaction which stops before its snapshot is written leaves its journal set aside
+		journal.rotate()
+		journal.append_many([{ 'op' : 'add', 'id' : '1', 'entry' : { 'sha1sum' : 'b' } }, journal.remove_record('0')])
+		journal.close()
+		with open(journal.compacting_journal_path, 'a') as journal_file:
+			journal_file.write('{ "op" : "remo')
+
+		# Rotating again should keep the records of both journals, in order
+		journal = FileStashJournal(self.root_path, sync_interval_seconds=None)
+		journal.rotate()
+		journal.append({ 'op' : 'add', 'id' : '2', 'entry' : { 'sha1sum' : 'c' } })
+		journal.close()
+		self.assertEquals(sorted(FileStashJournal(self.root_path, sync_interval_seconds=None).load().keys()), ['1', '2', '3'])
+
+	def tearDown(self):
+		shutil.rmtree(self.root_path)
+
+if __name__ == '__main__':
+	unittest.main()
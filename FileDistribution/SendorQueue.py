@@ -34,7 +34,7 @@ class SendorQueue(Observable):
 	
 	unique_id = 0
 
-	def __init__(self, num_processes, work_directory, max_task_execution_time, max_task_finalization_time, task_cleanup_interval_seconds, max_task_wait_seconds, max_task_exist_days):
+	def __init__(self, num_processes, work_directory, max_task_execution_time, max_task_finalization_time, task_cleanup_interval_seconds, max_task_wait_seconds, max_task_exist_days, max_tasks_per_process=0):
 		super(SendorQueue, self).__init__()
 		self.num_processes = num_processes
 		self.work_directory = work_directory
@@ -43,7 +43,7 @@ class SendorQueue(Observable):
 		os.mkdir(self.tasks_work_directory)
 		self.tasks_lock = threading.RLock()
 		self.tasks = []
-		self.worker = SendorWorker(max_task_execution_time, max_task_finalization_time)
+		self.worker = SendorWorker(max_task_execution_time, max_task_finalization_time, num_processes, max_tasks_per_process)
 		self.nonprocessed_tasks = []
 		self.worker_tasks = []
 		self.task_done = threading.Event()
@@ -176,6 +176,18 @@ class SendorQueue(Observable):
 				self.tasks.remove(task)
 				self.notify(event_type='remove', task=task)
 
+	def stop(self):
+		""" Stop the worker processes; tasks that are running are canceled, and waiting tasks are not run """
+		self.worker.stop()
+
+class DummySendorAction(SendorAction):
+
+	def __init__(self):
+		super(DummySendorAction, self).__init__(completion_weight=10)
+
+	def run(self, context):
+		context.activity("Dummy action invoked")
+
 class SendorQueueUnitTest(unittest.TestCase):
 
 	work_directory = 'unittest'
@@ -186,14 +198,6 @@ class SendorQueueUnitTest(unittest.TestCase):
 
 	def test_multiple_tasks(self):
 
-		class DummySendorAction(SendorAction):
-		
-			def __init__(self):
-				super(DummySendorAction, self).__init__(completion_weight=10)
-				
-			def run(self, context):
-				context.activity("Dummy action invoked")
-
 		tasks = []
 		for i in range(5):
 			task = SendorTask()
@@ -244,6 +248,7 @@ class SendorQueueUnitTest(unittest.TestCase):
 		self.sendor_queue.remove(task)
 
 	def tearDown(self):
+		self.sendor_queue.stop()
 		shutil.rmtree(self.work_directory)
 
 if __name__ == '__main__':
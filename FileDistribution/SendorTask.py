@@ -1,6 +1,8 @@
 
 import datetime
 
+from timestamps import datetime_to_microseconds, microseconds_to_datetime
+
 from abc import ABCMeta, abstractmethod
 
 def format_datetime(time):
@@ -25,6 +27,13 @@ def format_timedelta(duration):
 	return result
 
 class SendorTask(object):
+	""" A unit of work in the queue
+		Completed tasks are kept around for a long time, so they are kept compact: attributes are
+		stored in slots, timestamps are stored as integers, and the log is collected as a list of lines,
+		which is joined into a single string once the task has finished
+		"""
+
+	__slots__ = ('state', 'actions', 'task_id', 'work_directory', 'enqueue_time_microseconds', 'start_time_microseconds', 'end_time_microseconds', 'completion_ratio', 'activity', 'log', 'is_cancelable', 'max_bandwidth', 'bandwidth_allocation')
 
 	NOT_STARTED = 0
 	STARTED = 1
@@ -37,34 +46,63 @@ class SendorTask(object):
 		self.actions = []
 		self.task_id = None
 		self.work_directory = None
-		self.enqueue_time = None
-		self.start_time = None
-		self.end_time = None
+		self.enqueue_time_microseconds = None
+		self.start_time_microseconds = None
+		self.end_time_microseconds = None
 		self.completion_ratio = 0
 		self.activity = ""
-		self.log = ""
+		self.log = []
 		self.is_cancelable = False
+		self.max_bandwidth = None
+		self.bandwidth_allocation = None
+
+	@property
+	def enqueue_time(self):
+		return self.optional_datetime(self.enqueue_time_microseconds)
+
+	@property
+	def start_time(self):
+		return self.optional_datetime(self.start_time_microseconds)
+
+	@property
+	def end_time(self):
+		return self.optional_datetime(self.end_time_microseconds)
+
+	def optional_datetime(self, microseconds):
+		if microseconds is None:
+			return None
+		return microseconds_to_datetime(microseconds)
+
+	def now(self):
+		return datetime_to_microseconds(datetime.datetime.utcnow())
 
 	def enqueued(self, task_id, work_directory):
 		self.task_id = task_id
 		self.work_directory = work_directory
-		self.enqueue_time = datetime.datetime.utcnow()
+		self.enqueue_time_microseconds = self.now()
 		
 	def started(self):
 		self.state = self.STARTED
-		self.start_time = datetime.datetime.utcnow()
+		self.start_time_microseconds = self.now()
 
 	def completed(self):
 		self.state = self.COMPLETED
-		self.end_time = datetime.datetime.utcnow()
+		self.finished()
 
 	def failed(self):
 		self.state = self.FAILED
-		self.end_time = datetime.datetime.utcnow()
+		self.finished()
 
 	def canceled(self):
 		self.state = self.CANCELED
-		self.end_time = datetime.datetime.utcnow()
+		self.finished()
+
+	def finished(self):
+		self.end_time_microseconds = self.now()
+		self.bandwidth_allocation = None
+		# The actions are no longer needed once the task has finished
+		self.actions = []
+		self.log = self.get_log()
 
 	def run(self, context):
 		for action in self.actions:
@@ -98,11 +136,24 @@ class SendorTask(object):
 
 	def get_completion_ratio(self):
 		return self.completion_ratio
+
+	def set_bandwidth_allocation(self, bandwidth_allocation):
+		self.bandwidth_allocation = bandwidth_allocation
 		
 	def append_log(self, log):
-		self.log = self.log + log + "\n"
+		if isinstance(self.log, list):
+			self.log.append(log)
+		else:
+			# Log lines may still arrive after the task has finished
+			self.log = self.log + log + "\n"
+
+	@property
+	def log_lines(self):
+		return self.get_log().splitlines()
 
 	def get_log(self):
+		if isinstance(self.log, list):
+			return ''.join([line + "\n" for line in self.log])
 		return self.log
 
 	def progress(self):
@@ -126,6 +177,8 @@ class SendorTask(object):
 			'activity' : self.get_activity(),
 			'completion_ratio' : self.get_completion_ratio(),
 			'is_cancelable' : self.is_cancelable,
+			'max_bandwidth' : self.max_bandwidth,
+			'bandwidth_allocation' : self.bandwidth_allocation,
 			'log' : self.get_log() }
 			
 		return status
@@ -133,6 +186,10 @@ class SendorTask(object):
 class SendorActionContext(object):
 	__metaclass__ = ABCMeta
 
+	# The task that the actions belong to, and the bandwidth limit of that task, if any
+	task_id = None
+	max_bandwidth = None
+
 	def __init__(self, work_directory):
 		self.work_directory = work_directory
 
@@ -154,6 +211,18 @@ class SendorActionContext(object):
 	def log(self, log):
 		return
 
+	def target_progress(self, target_id, state, completion_ratio):
+		""" Report the progress of an action that distributes to several targets, for one of the targets """
+		return
+
+	def file_progress(self, file_id, state, completion_ratio):
+		""" Report the progress of an action that distributes several files, for one of the files """
+		return
+
+	def bandwidth_allocation(self, bytes_per_second):
+		""" Report the bandwidth that the running transfer is currently allowed; None means unlimited """
+		return
+
 class SendorAction(object):
 	__metaclass__ = ABCMeta
 
@@ -1,26 +1,32 @@
 
+import Queue
+import collections
 import logging
 import multiprocessing
 import multiprocessing.queues
 import os
 import shutil
+import signal
 import thread
 import threading
+import time
 import traceback
 import unittest
 
 from SendorTask import SendorTask, SendorAction, SendorActionContext
 
 from Observable import Observable
+from ssh_connection_pool import connection_pool
 
 logger = logging.getLogger('SendorWorker')
 
 class SendorWorkerTaskArgs(object):
-	def __init__(self, task_id, work_directory, actions, cancel):
+	def __init__(self, task_id, work_directory, actions, cancel, max_bandwidth=None):
 		self.task_id = task_id
 		self.actions = actions
 		self.work_directory = work_directory
 		self.cancel = cancel
+		self.max_bandwidth = max_bandwidth
 
 class QueueItem(object):
 	def __init__(self, task_id, item_type):
@@ -52,14 +58,42 @@ class StdOutQueueItem(QueueItem):
 		super(StdOutQueueItem, self).__init__(task_id, 'stdout')
 		self.message = message
 
+class TargetProgressQueueItem(QueueItem):
+	def __init__(self, task_id, target_id, state, completion_ratio):
+		super(TargetProgressQueueItem, self).__init__(task_id, 'target_progress')
+		self.target_id = target_id
+		self.state = state
+		self.completion_ratio = completion_ratio
+
+class FileProgressQueueItem(QueueItem):
+	def __init__(self, task_id, file_id, state, completion_ratio):
+		super(FileProgressQueueItem, self).__init__(task_id, 'file_progress')
+		self.file_id = file_id
+		self.state = state
+		self.completion_ratio = completion_ratio
+
+class BandwidthAllocationQueueItem(QueueItem):
+	def __init__(self, task_id, bandwidth_allocation):
+		super(BandwidthAllocationQueueItem, self).__init__(task_id, 'bandwidth_allocation')
+		self.bandwidth_allocation = bandwidth_allocation
+
+class ConnectionPoolStatisticsQueueItem(QueueItem):
+	def __init__(self, task_id, statistics):
+		super(ConnectionPoolStatisticsQueueItem, self).__init__(task_id, 'connection_pool_statistics')
+		self.statistics = statistics
+		self.process_id = os.getpid()
+
 class TaskDoneQueueItem(QueueItem):
-	def __init__(self, task_id):
+	def __init__(self, task_id, process_reusable):
 		super(TaskDoneQueueItem, self).__init__(task_id, 'task_done')
+		self.process_reusable = process_reusable
 
 class SendorWorkerActionContext(SendorActionContext):
 	def __init__(self, worker_task, work_directory):
 		super(SendorWorkerActionContext, self).__init__(work_directory)
 		self.worker_task = worker_task
+		self.task_id = worker_task.args.task_id
+		self.max_bandwidth = worker_task.args.max_bandwidth
 		
 	def activity(self, activity):
 		self.worker_task.enqueue_activity(activity)
@@ -71,6 +105,15 @@ class SendorWorkerActionContext(SendorActionContext):
 	def log(self, log):
 		self.worker_task.enqueue_log(log)
 
+	def target_progress(self, target_id, state, completion_ratio):
+		self.worker_task.enqueue_target_progress(target_id, state, completion_ratio)
+
+	def file_progress(self, file_id, state, completion_ratio):
+		self.worker_task.enqueue_file_progress(file_id, state, completion_ratio)
+
+	def bandwidth_allocation(self, bytes_per_second):
+		self.worker_task.enqueue_bandwidth_allocation(bytes_per_second)
+
 class SendorWorkerTask(Observable):
 
 	def __init__(self, queue, max_task_execution_time, args):
@@ -99,11 +142,23 @@ class SendorWorkerTask(Observable):
 	def enqueue_log(self, log):
 		self.enqueue(LogQueueItem(self.args.task_id, log), True)
 
+	def enqueue_target_progress(self, target_id, state, completion_ratio):
+		self.enqueue(TargetProgressQueueItem(self.args.task_id, target_id, state, completion_ratio), True)
+
+	def enqueue_file_progress(self, file_id, state, completion_ratio):
+		self.enqueue(FileProgressQueueItem(self.args.task_id, file_id, state, completion_ratio), True)
+
+	def enqueue_bandwidth_allocation(self, bandwidth_allocation):
+		self.enqueue(BandwidthAllocationQueueItem(self.args.task_id, bandwidth_allocation), True)
+
 	def enqueue_stdout(self, message):
 		self.enqueue(StdOutQueueItem(self.args.task_id, message), True)
 
-	def enqueue_task_done(self):
-		self.enqueue(TaskDoneQueueItem(self.args.task_id), False)
+	def enqueue_connection_pool_statistics(self):
+		self.enqueue(ConnectionPoolStatisticsQueueItem(self.args.task_id, connection_pool.take_statistics()), True)
+
+	def enqueue_task_done(self, process_reusable):
+		self.enqueue(TaskDoneQueueItem(self.args.task_id, process_reusable), False)
 	
 	def run_actions_thread_func(self, actions, context):
 		try:
@@ -127,45 +182,41 @@ class SendorWorkerTask(Observable):
 			self.enqueue_log("Task execution failed due to exception. Callstack:")
 			self.enqueue_log(traceback.format_exc())
 	
-	def wait_for_actions_thread_func(self, run_actions_thread, wait_done):
-		run_actions_thread.join(self.max_task_execution_time)
-		wait_done.set()
-	
-	def wait_for_cancel_thread_func(self, cancel, wait_done):
-		cancel.wait()
-		wait_done.set()
-		
 	def run(self):
+		""" Run the task's actions, and report the outcome through the queue
+			Returns False if an action is still running after the task has been canceled or has timed out;
+			the process must then exit, to stop the action
+			"""
+		process_reusable = True
 		try:
 			os.mkdir(self.args.work_directory)
 			context = SendorWorkerActionContext(self, self.args.work_directory)
 
-			wait_done = threading.Event()
-
-			# Create threads for running actions, checking for cancellation, and timeout
-			wait_for_cancel_thread = threading.Thread(target=(lambda self, cancel, wait_done: self.wait_for_cancel_thread_func(cancel, wait_done)), args=(self, self.args.cancel, wait_done))
-			run_actions_thread = threading.Thread(target=(lambda self, actions, context: self.run_actions_thread_func(actions, context)), args=(self, self.args.actions, context))
-			wait_for_actions_thread = threading.Thread(target=(lambda self, run_actions_thread, wait_done: self.wait_for_actions_thread_func(run_actions_thread, wait_done)), args=(self, run_actions_thread, wait_done))
-			wait_for_cancel_thread.start()
+			# Run the actions on a separate thread, and wait for them to complete, cancel to be requested, or timeout to occur
+			# The actions thread signals completion through the cancel event as well, so that a single wait suffices
+			actions_done = threading.Event()
+			def run_actions():
+				try:
+					self.run_actions_thread_func(self.args.actions, context)
+				finally:
+					actions_done.set()
+					self.args.cancel.set()
+			run_actions_thread = threading.Thread(target=run_actions)
+			run_actions_thread.daemon = True
 			run_actions_thread.start()
-			wait_for_actions_thread.start()
-
-			# Wait for the actions to complete, cancel to be requested, or timeout to occur
-			wait_done.wait()
+			self.args.cancel.wait(self.max_task_execution_time)
 
 			# Handle state transition
-			if self.args.cancel.is_set():
-				self.enqueue_status('canceled')
-				self.enqueue_log("Task execution canceled")
-			elif run_actions_thread.is_alive():
-				self.enqueue_status('failed')
-				self.enqueue_log("Task execution failed due to timeout -- more than " + str(self.max_task_execution_time) + " seconds, terminating task")
-
-			# In case no cancel was selected, then let the cancellation thread complete
-			self.args.cancel.set()
-			wait_for_cancel_thread.join()
-
-			# We cannot wait for the other two threads to complete since they can run for arbitrarily long
+			if not actions_done.is_set():
+				process_reusable = False
+				if self.args.cancel.is_set():
+					self.enqueue_status('canceled')
+					self.enqueue_log("Task execution canceled")
+				else:
+					self.enqueue_status('failed')
+					self.enqueue_log("Task execution failed due to timeout -- more than " + str(self.max_task_execution_time) + " seconds, terminating task")
+
+			# We cannot wait for the actions thread to complete since it can run for arbitrarily long
 	
 		except:
 			self.enqueue_status('failed')
@@ -173,42 +224,129 @@ class SendorWorkerTask(Observable):
 			self.enqueue_log(traceback.format_exc())
 		finally:
 			shutil.rmtree(self.args.work_directory, True)
-			self.enqueue_task_done()
-
-def start_sendor_worker_task(queue, max_task_execution_time, task_args):
-	processor = SendorWorkerTask(queue, max_task_execution_time, task_args)
-	processor.run()
+			self.enqueue_connection_pool_statistics()
+			self.enqueue_task_done(process_reusable)
+		return process_reusable
+
+def run_sendor_worker_process(connection, parent_connections, queue, max_task_execution_time, cancel, connection_pool_report_interval_seconds):
+	""" Main loop of a worker process: run tasks as they arrive over the connection, until told to stop
+		The parent's ends of the pipes, which the process has inherited, are closed first, so that each pipe
+		only stays open for as long as the parent and its own worker process hold it
+		While the process is idle, its pooled SSH connections expire; the parent is told whenever that changes
+		the number of connections that the process holds
+		"""
+	for parent_connection in parent_connections:
+		parent_connection.close()
+	reported_connection_counts = connection_pool.connection_counts()
+	while True:
+		if not connection.poll(connection_pool_report_interval_seconds):
+			if connection_pool.connection_counts() != reported_connection_counts:
+				statistics = connection_pool.take_statistics()
+				reported_connection_counts = (statistics['open_connections'], statistics['idle_connections'])
+				queue.put(ConnectionPoolStatisticsQueueItem(None, statistics))
+			continue
+		task_args = connection.recv()
+		if task_args is None:
+			return
+		task_args.cancel = cancel
+		processor = SendorWorkerTask(queue, max_task_execution_time, task_args)
+		if not processor.run():
+			return
+		# The task has reported the connection counts when it finished
+		reported_connection_counts = connection_pool.connection_counts()
+
+class SendorWorkerProcess(object):
+	""" A long-lived process which runs tasks, one at a time
+		Tasks are sent to the process over a pipe; the process reports back through the shared result queue
+		"""
+
+	connection_pool_report_interval_seconds = 5
+
+	def __init__(self, queue, max_task_execution_time, other_connections=[]):
+		""" other_connections are the parent's ends of the pipes to the other worker processes """
+		self.connection, child_connection = multiprocessing.Pipe()
+		self.cancel = multiprocessing.Event()
+		self.process = multiprocessing.Process(target=run_sendor_worker_process, args=(child_connection, [self.connection] + other_connections, queue, max_task_execution_time, self.cancel, self.connection_pool_report_interval_seconds))
+		self.process.daemon = True
+		self.process.start()
+		child_connection.close()
+		self.num_tasks = 0
+		self.task_in_flight = None
+
+	def run(self, task_in_flight, task_args):
+		self.cancel.clear()
+		self.num_tasks += 1
+		self.task_in_flight = task_in_flight
+		task_in_flight.worker_process = self
+		self.connection.send(task_args)
+
+	def stop(self, max_finalization_time):
+		""" Ask the process to exit once it is idle; terminate it if it does not exit in time """
+		try:
+			self.connection.send(None)
+		except (IOError, OSError):
+			pass
+		self.process.join(max_finalization_time)
+		if self.process.is_alive():
+			logger.warning("Worker process " + str(self.process.pid) + " is still alive after join timeout; terminating forcefully")
+			self.process.terminate()
+			self.process.join()
+		self.connection.close()
 
 class SendorWorker(Observable):
+	""" Runs tasks in a pool of num_processes long-lived worker processes
+		A worker process is replaced after it has run max_tasks_per_process tasks (0 means no limit), when an
+		action is left running after cancellation or timeout, and when the process dies unexpectedly.
+		stop() cancels the running tasks and stops all worker processes; none are replaced from then on
+		"""
 
 	class SendorTaskInFlight(object):
-		def __init__(self, task, process, cancel, task_done):
+		def __init__(self, task, task_args, task_done):
 			self.task = task
-			self.process = process
-			self.cancel = cancel
+			self.task_args = task_args
 			self.task_done = task_done
+			self.worker_process = None
 			self.resolution_signaled = False
-		
-	def __init__(self, max_task_execution_time, max_task_finalization_time):
+
+	process_check_interval_seconds = 1
+
+	def __init__(self, max_task_execution_time, max_task_finalization_time, num_processes=1, max_tasks_per_process=0):
 		super(SendorWorker, self).__init__()
 		self.max_task_execution_time = max_task_execution_time
 		self.max_task_finalization_time = max_task_finalization_time
+		self.max_tasks_per_process = max_tasks_per_process
 		self.tasks_in_flight_lock = threading.RLock()
 		self.tasks_in_flight = {}
+		self.pending_tasks = collections.deque()
+		self.stopping = False
 		self.queue = multiprocessing.Queue()
+		self.worker_processes = []
+		for i in range(num_processes):
+			self.worker_processes.append(self.create_worker_process())
 		self.worker_thread = threading.Thread(target=(lambda self: self.worker_process_result_thread()), args=(self,))
 		self.worker_thread.daemon = True
 		self.worker_thread.start()
 
 	def add(self, task):
 		task_id = task.task_id
-		cancel_event = multiprocessing.Event()
 		task_done = threading.Event()
-		task_args = SendorWorkerTaskArgs(task_id=task.task_id, work_directory=task.work_directory, actions=task.actions, cancel=cancel_event)
+		task_args = SendorWorkerTaskArgs(task_id=task.task_id, work_directory=task.work_directory, actions=task.actions, cancel=None, max_bandwidth=task.max_bandwidth)
 		with self.tasks_in_flight_lock:
-			process = multiprocessing.Process(target=start_sendor_worker_task, args=(self.queue, self.max_task_execution_time, task_args))
-			self.tasks_in_flight[task_id] = self.SendorTaskInFlight(task, process, cancel_event, task_done)
-			process.start()
+			task_in_flight = self.SendorTaskInFlight(task, task_args, task_done)
+			self.tasks_in_flight[task_id] = task_in_flight
+			self.pending_tasks.append(task_in_flight)
+			self.dispatch_pending_tasks()
+
+	def dispatch_pending_tasks(self):
+		with self.tasks_in_flight_lock:
+			if self.stopping:
+				return
+			for worker_process in self.worker_processes:
+				if not self.pending_tasks:
+					return
+				if not worker_process.task_in_flight:
+					task_in_flight = self.pending_tasks.popleft()
+					worker_process.run(task_in_flight, task_in_flight.task_args)
 
 	def join(self, task):
 		with self.tasks_in_flight_lock:
@@ -219,8 +357,17 @@ class SendorWorker(Observable):
 	def cancel(self, task):
 		with self.tasks_in_flight_lock:
 			task_in_flight = self.find_task_in_flight(task)
-		if task_in_flight:
-			task_in_flight.cancel.set()
+			if not task_in_flight:
+				return
+			if task_in_flight.worker_process:
+				task_in_flight.worker_process.cancel.set()
+				return
+			self.pending_tasks.remove(task_in_flight)
+			del self.tasks_in_flight[task_in_flight.task_args.task_id]
+		task_in_flight.task.canceled()
+		task_in_flight.resolution_signaled = True
+		self.notify(event_type='change', task=task_in_flight.task)
+		self.task_finished(task_in_flight)
 				
 	def find_task_in_flight(self, task):
 		with self.tasks_in_flight_lock:
@@ -230,33 +377,104 @@ class SendorWorker(Observable):
 					return task_in_flight
 			return None
 
-	def finalize(self, task_id, task_in_flight):
+	def create_worker_process(self):
+		with self.tasks_in_flight_lock:
+			return SendorWorkerProcess(self.queue, self.max_task_execution_time, [worker_process.connection for worker_process in self.worker_processes])
+
+	def replace_worker_process(self, worker_process):
+		with self.tasks_in_flight_lock:
+			index = self.worker_processes.index(worker_process)
+			self.worker_processes[index] = self.create_worker_process()
 
-		task_in_flight.process.join(self.max_task_finalization_time)
-		if task_in_flight.process.is_alive():
-			task.append_log("Process is still alive after join timeout; terminating forcefully")
-			task_in_flight.process.terminate()
-			task_in_flight.process.join()
+	def finalize(self, task_id, task_in_flight, process_reusable):
 
+		worker_process = task_in_flight.worker_process
 		with self.tasks_in_flight_lock:
 			del self.tasks_in_flight[task_id]
+			worker_process.task_in_flight = None
+			recycle = not process_reusable or (self.max_tasks_per_process and worker_process.num_tasks >= self.max_tasks_per_process)
+			if recycle and not self.stopping:
+				self.replace_worker_process(worker_process)
+
+		if recycle:
+			worker_process.stop(self.max_task_finalization_time)
+
+		self.dispatch_pending_tasks()
+
+	def task_finished(self, task_in_flight):
+		self.notify(event_type='remove', task=task_in_flight.task)
+		task_in_flight.task_done.set()
+
+	def check_worker_processes(self):
+		""" Replace worker processes that have died, and fail the tasks that they were running """
+		with self.tasks_in_flight_lock:
+			if self.stopping:
+				return
+			dead_worker_processes = [worker_process for worker_process in self.worker_processes if not worker_process.process.is_alive()]
+			for worker_process in dead_worker_processes:
+				logger.warning("Worker process " + str(worker_process.process.pid) + " exited unexpectedly with exit code " + str(worker_process.process.exitcode))
+				self.replace_worker_process(worker_process)
+
+		for worker_process in dead_worker_processes:
+			worker_process.connection.close()
+			task_in_flight = worker_process.task_in_flight
+			if task_in_flight:
+				task = task_in_flight.task
+				task.append_log("Worker process exited unexpectedly")
+				if not task_in_flight.resolution_signaled:
+					task.failed()
+					task_in_flight.resolution_signaled = True
+				with self.tasks_in_flight_lock:
+					del self.tasks_in_flight[task.task_id]
+				self.notify(event_type='change', task=task)
+				self.task_finished(task_in_flight)
+
+		if dead_worker_processes:
+			self.dispatch_pending_tasks()
+
+	def stop(self):
+		""" Cancel the running tasks, and stop all worker processes; tasks that are still waiting are not run """
+		with self.tasks_in_flight_lock:
+			self.stopping = True
+			worker_processes = self.worker_processes[:]
+		for worker_process in worker_processes:
+			worker_process.cancel.set()
+			worker_process.stop(self.max_task_finalization_time)
+		self.worker_thread.join()
 
 	def worker_process_result_thread(self):
-		while True:
-			item = self.queue.get()
+		while not self.stopping:
+			try:
+				item = self.queue.get(timeout=self.process_check_interval_seconds)
+			except Queue.Empty:
+				self.check_worker_processes()
+				continue
 			self.handle_worker_queue_item(item)
 	
 	def handle_worker_queue_item(self, item):
+		if item.item_type == 'connection_pool_statistics':
+			# Connections are pooled within each worker process; gather their statistics in this process
+			#  Idle worker processes report these as well, outside of any task
+			connection_pool.add_statistics(item.statistics, item.process_id)
+			return
+
 		task_id = item.task_id
 		with self.tasks_in_flight_lock:
 			task_in_flight = self.tasks_in_flight.get(task_id)
+
+		if not task_in_flight:
+			# The task has already been resolved, because its worker process was found dead
+			logger.debug("Ignoring " + item.item_type + " for task " + str(task_id) + ", which is no longer in flight")
+			return
 		
 		task = task_in_flight.task
 		
 		if item.item_type == 'status':
 			logger.debug("Status: " + item.status)
 			if item.status == 'started':
-				task.started()
+				# The actions thread may report that it has started after the task has been canceled
+				if not task_in_flight.resolution_signaled:
+					task.started()
 			elif item.status == 'completed':
 				if not task_in_flight.resolution_signaled:
 					task.completed()
@@ -285,19 +503,30 @@ class SendorWorker(Observable):
 			logger.debug("Log: " + item.log)
 			task.append_log(item.log)
 
+		elif item.item_type == 'target_progress':
+			logger.debug("Target progress: " + item.target_id + " " + item.state)
+			task.set_target_progress(item.target_id, item.state, item.completion_ratio)
+
+		elif item.item_type == 'file_progress':
+			logger.debug("File progress: " + item.file_id + " " + item.state)
+			task.set_file_progress(item.file_id, item.state, item.completion_ratio)
+
+		elif item.item_type == 'bandwidth_allocation':
+			logger.debug("Bandwidth allocation: " + str(item.bandwidth_allocation))
+			task.set_bandwidth_allocation(item.bandwidth_allocation)
+
 		elif item.item_type == 'stdout':
 			logger.debug("Stdout: " + item.message)
 			task.append_log(item.message)
 
 		elif item.item_type == 'task_done':
 			logger.debug("task_done")
-			self.finalize(task_id, task_in_flight)
+			self.finalize(task_id, task_in_flight, item.process_reusable)
 		else:
 			raise Exception("Unknown type: " + item.item_type)
 
 		if item.item_type == 'task_done':
-			self.notify(event_type='remove', task=task)
-			task_in_flight.task_done.set()
+			self.task_finished(task_in_flight)
 		else:
 			self.notify(event_type='change', task=task)
 
@@ -312,28 +541,189 @@ class DummySendorAction(SendorAction):
 		context.completion_ratio(0.9)
 		context.activity("Dummy action completed")
 
+class ProcessIdSendorAction(SendorAction):
+
+	def __init__(self):
+		super(ProcessIdSendorAction, self).__init__(completion_weight=10)
+
+	def run(self, context):
+		context.log("pid " + str(os.getpid()))
+
+class SleepSendorAction(SendorAction):
+
+	def __init__(self, seconds):
+		super(SleepSendorAction, self).__init__(completion_weight=10)
+		self.seconds = seconds
+
+	def run(self, context):
+		time.sleep(self.seconds)
+
+class OpenPipesSendorAction(SendorAction):
+	""" Logs how many of the given pipes, identified by device and inode, the worker process holds open """
+
+	def __init__(self, pipe_identities):
+		super(OpenPipesSendorAction, self).__init__(completion_weight=10)
+		self.pipe_identities = pipe_identities
+
+	def run(self, context):
+		open_identities = set()
+		for fd in os.listdir('/proc/self/fd'):
+			try:
+				status = os.fstat(int(fd))
+			except OSError:
+				continue
+			open_identities.add((status.st_dev, status.st_ino))
+		context.log("open pipes " + str(len(open_identities.intersection(self.pipe_identities))))
+
+class PooledConnectionsSendorAction(SendorAction):
+	""" Pretends that the worker process's connection pool holds connections, which expire after a while """
+
+	def __init__(self, num_connections, expire_after_seconds):
+		super(PooledConnectionsSendorAction, self).__init__(completion_weight=10)
+		self.num_connections = num_connections
+		self.expire_after_seconds = expire_after_seconds
+
+	def run(self, context):
+		connection_pool.num_connections['target'] = self.num_connections
+		timer = threading.Timer(self.expire_after_seconds, connection_pool.num_connections.pop, ['target'])
+		timer.daemon = True
+		timer.start()
+
 class SendorTaskProcessUnitTest(unittest.TestCase):
 
 	def setUp(self):
 		os.mkdir('unittest')
-	
-	def test_sendor_worker_run(self):
+		self.workers = []
 
+	def create_worker(self, **kwargs):
+		worker = SendorWorker(**kwargs)
+		self.workers.append(worker)
+		return worker
+
+	def run_tasks(self, worker, actions_per_task):
 		tasks = []
-		for i in range(5):
+		for i, actions in enumerate(actions_per_task):
 			task = SendorTask()
-			task.actions = [DummySendorAction()]
+			task.actions = actions
 			task.enqueued(i, 'unittest/' + str(i))
 			tasks.append(task)
-
-		worker = SendorWorker(max_task_execution_time=10, max_task_finalization_time=1)
 		for task in tasks:
 			worker.add(task)
-			
 		for task in tasks:
 			worker.join(task)
+		return tasks
+
+	def process_id(self, task):
+		return [line for line in task.log_lines if line.startswith("pid ")][0]
+	
+	def test_sendor_worker_run(self):
+
+		worker = self.create_worker(max_task_execution_time=10, max_task_finalization_time=1)
+		tasks = self.run_tasks(worker, [[DummySendorAction()] for i in range(5)])
+		for task in tasks:
+			self.assertEquals(task.state, SendorTask.COMPLETED)
+
+	def test_process_reuse(self):
+
+		# Tasks should be run by the same processes, until they have run max_tasks_per_process tasks
+		worker = self.create_worker(max_task_execution_time=10, max_task_finalization_time=1, num_processes=1, max_tasks_per_process=3)
+		tasks = self.run_tasks(worker, [[ProcessIdSendorAction()] for i in range(5)])
+		process_ids = [self.process_id(task) for task in tasks]
+		self.assertEquals(len(set(process_ids[0:3])), 1)
+		self.assertEquals(len(set(process_ids[3:5])), 1)
+		self.assertNotEquals(process_ids[0], process_ids[3])
+
+	def test_process_replacement(self):
+
+		worker = self.create_worker(max_task_execution_time=1, max_task_finalization_time=1, num_processes=1)
+
+		# A process whose task has timed out should be replaced, since the action keeps running
+		tasks = self.run_tasks(worker, [[ProcessIdSendorAction(), SleepSendorAction(10)], [ProcessIdSendorAction()]])
+		self.assertEquals(tasks[0].state, SendorTask.FAILED)
+		self.assertEquals(tasks[1].state, SendorTask.COMPLETED)
+		self.assertNotEquals(self.process_id(tasks[0]), self.process_id(tasks[1]))
+
+		# A process that is killed should fail its task, and be replaced
+		worker = self.create_worker(max_task_execution_time=10, max_task_finalization_time=1, num_processes=1)
+		task = SendorTask()
+		task.actions = [SleepSendorAction(10)]
+		task.enqueued(2, 'unittest/2')
+		worker.add(task)
+		time.sleep(0.5)
+		os.kill(worker.worker_processes[0].process.pid, signal.SIGKILL)
+		worker.join(task)
+		self.assertEquals(task.state, SendorTask.FAILED)
+		self.assertIn("Worker process exited unexpectedly", task.log_lines)
+		self.assertEquals(self.run_tasks(worker, [[DummySendorAction()]])[0].state, SendorTask.COMPLETED)
+
+	def test_cancel(self):
+
+		worker = self.create_worker(max_task_execution_time=10, max_task_finalization_time=1, num_processes=1)
+		tasks = []
+		for i in range(2):
+			task = SendorTask()
+			task.actions = [SleepSendorAction(10)]
+			task.enqueued(i, 'unittest/' + str(i))
+			worker.add(task)
+			tasks.append(task)
+
+		# A task that is still waiting for a process should be canceled right away, and forgotten
+		worker.cancel(tasks[1])
+		worker.join(tasks[1])
+		self.assertEquals(tasks[1].state, SendorTask.CANCELED)
+		self.assertEquals(worker.tasks_in_flight.keys(), [0])
+
+		worker.cancel(tasks[0])
+		worker.join(tasks[0])
+		self.assertEquals(tasks[0].state, SendorTask.CANCELED)
+		self.assertEquals(worker.tasks_in_flight, {})
+
+	def test_pipes(self):
+
+		# Worker processes should only hold their own end of their own pipe
+		worker = self.create_worker(max_task_execution_time=10, max_task_finalization_time=1, num_processes=3)
+		pipe_identities = set()
+		for worker_process in worker.worker_processes:
+			status = os.fstat(worker_process.connection.fileno())
+			pipe_identities.add((status.st_dev, status.st_ino))
+		tasks = self.run_tasks(worker, [[OpenPipesSendorAction(pipe_identities)] for i in range(6)])
+		for task in tasks:
+			self.assertIn("open pipes 0", task.log_lines)
+
+	def test_stop(self):
+
+		# Stopping should end the running tasks and all processes, and dead processes should not be replaced
+		worker = self.create_worker(max_task_execution_time=10, max_task_finalization_time=1, num_processes=2)
+		task = SendorTask()
+		task.actions = [SleepSendorAction(10)]
+		task.enqueued(0, 'unittest/0')
+		worker.add(task)
+		time.sleep(0.5)
+		worker_processes = worker.worker_processes[:]
+		worker.stop()
+		self.assertFalse(any([worker_process.process.is_alive() for worker_process in worker_processes]))
+		worker.check_worker_processes()
+		self.assertEquals(worker.worker_processes, worker_processes)
+
+	def test_connection_pool_statistics(self):
+
+		# Worker processes should report the connections that they hold when their tasks finish, and again when
+		#  the connections expire while the process is idle
+		report_interval_seconds = SendorWorkerProcess.connection_pool_report_interval_seconds
+		SendorWorkerProcess.connection_pool_report_interval_seconds = 0.1
+		try:
+			worker = self.create_worker(max_task_execution_time=10, max_task_finalization_time=1, num_processes=1)
+		finally:
+			SendorWorkerProcess.connection_pool_report_interval_seconds = report_interval_seconds
+		open_connections = connection_pool.get_statistics()['open_connections']
+		self.run_tasks(worker, [[PooledConnectionsSendorAction(2, 0.5)]])
+		self.assertEquals(connection_pool.get_statistics()['open_connections'], open_connections + 2)
+		time.sleep(1)
+		self.assertEquals(connection_pool.get_statistics()['open_connections'], open_connections)
 
 	def tearDown(self):
+		for worker in self.workers:
+			worker.stop()
 		shutil.rmtree('unittest')
 	
 if __name__ == '__main__':
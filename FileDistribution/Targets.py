@@ -5,12 +5,15 @@ import os
 import unittest
 
 from SendorTask import SendorAction
+from actions import BundleDistributionAction, FanOutDistributionAction, RelayDistributionAction
+from bundle_transfer import BundleFile
 
 import target_distribution_methods
 
 import target_distribution_method_cp
 import target_distribution_method_sftp
 import target_distribution_method_parallel_sftp
+import target_distribution_method_delta
 
 distribution_logger = logging.getLogger('main.distribution')
 
@@ -42,6 +45,44 @@ class Targets(object):
 
 		return actions
 
+	def create_fan_out_distribution_actions(self, source, filename, sha1sum, size, ids, relay=False):
+		""" Create actions which distribute a file to several targets at once
+			With relay, targets that have received the file send it on to the others (see RelayDistributionAction)
+			The distribution action logs the completion of each target itself, as soon as that target has the file
+			"""
+		for id in ids:
+			if not id in self.targets:
+				raise Exception("id " + id + " does not exist in targets")
+
+		targets = [(id, self.targets[id]) for id in ids]
+		actions = []
+		actions.extend([LogDistributionAction("Started", filename, target) for (id, target) in targets])
+		if relay:
+			actions.append(RelayDistributionAction(source, filename, sha1sum, size, targets))
+		else:
+			actions.append(FanOutDistributionAction(source, filename, sha1sum, size, targets))
+
+		return actions
+
+	def can_receive_bundles(self, id):
+		return self.targets[id].get('distribution_method') in BundleDistributionAction.distribution_methods
+
+	def create_bundle_distribution_actions(self, files, id):
+		""" Create actions which distribute several files (BundleFile) to one target, as a single bundle """
+		if not id in self.targets:
+			raise Exception("id " + id + " does not exist in targets")
+		if not self.can_receive_bundles(id):
+			raise Exception("Target " + id + " cannot receive bundles; only SSH-based targets can")
+
+		target = self.targets[id]
+		description = str(len(files)) + " files"
+		actions = []
+		actions.append(LogDistributionAction("Started", description, target))
+		actions.append(BundleDistributionAction(files, target))
+		actions.append(LogDistributionAction("Completed", description, target))
+
+		return actions
+
 	def get_targets(self):
 		return self.targets
 
@@ -55,6 +96,17 @@ class test(unittest.TestCase):
 	def test(self):
 
 		self.targets.create_distribution_actions('sourcedir/sourcefile', 'sourcefile', None, None, 'target2')
+		actions = self.targets.create_fan_out_distribution_actions('sourcedir/sourcefile', 'sourcefile', None, None, ['target1', 'target3'])
+		self.assertTrue(isinstance(actions[-1], FanOutDistributionAction))
+		actions = self.targets.create_fan_out_distribution_actions('sourcedir/sourcefile', 'sourcefile', None, None, ['target1', 'target3'], relay=True)
+		self.assertTrue(isinstance(actions[-1], RelayDistributionAction))
+		self.assertRaises(Exception, self.targets.create_fan_out_distribution_actions, 'sourcedir/sourcefile', 'sourcefile', None, None, ['target1', 'target4'])
+
+		# Bundles can only be sent to SSH-based targets
+		files = [BundleFile('0', 'sourcedir/sourcefile', 'sourcefile', None, 0)]
+		self.assertFalse(self.targets.can_receive_bundles('target2'))
+		self.assertRaises(Exception, self.targets.create_bundle_distribution_actions, files, 'target2')
+		self.assertRaises(Exception, self.targets.create_bundle_distribution_actions, files, 'target4')
 
 if __name__ == '__main__':
 	unittest.main()
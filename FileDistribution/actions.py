@@ -1,23 +1,47 @@
 
+import binascii
+import collections
 import datetime
+import hashlib
 import logging
 import json
+import mmap
 import multiprocessing.pool
 import os
+import os.path
+import pipes
 import shutil
+import sys
 import threading
 import time
 import unittest
 import weakref
 
-import paramiko
 import fabric.api
 from fabric.api import local, run, settings
 import fabric.network
 
+from bandwidth import bandwidth_manager
+from bundle_transfer import BundleFile, ChannelWriter, install_command, parse_sha1sums, parse_stats, unpack_command, write_bundle
+from ChunkStore import ChunkedFileReader
+from delta_transfer import DeltaWriter, compute_delta, helper_filename, helper_path, parse_signatures
+from local_copy import copy_file, file_sha1sum, link_file
+from parallel_transfer import ParallelTransferScheduler, transfer_tuning
+from range_verification import RangeVerifier, combined_sha1sum, plan_ranges
+from sftp_transfer import MappedFile, SftpTransferSettings, choose_compression, hashed_blocks, read_file_range, read_mapped_range, send_blocks, stream_blocks
+from ssh_connection_pool import connection_pool
+from target_inventory import target_inventory, target_key
+from transfer_checkpoints import transfer_checkpoints
 from SendorTask import SendorAction, SendorActionContext
 
-threadlocal = threading.local()
+logger = logging.getLogger('actions')
+distribution_logger = logging.getLogger('main.distribution')
+
+def allocate_bandwidth(context, target_name, target_limit):
+	""" Take a share of the bandwidth for sending data to a target, within the task's limit (see bandwidth)
+		Changes to the allocation are shown in the task's progress
+		"""
+	return bandwidth_manager.allocate(target_name, float(target_limit or 0), context.max_bandwidth, context.bandwidth_allocation)
 
 class FabricAction(SendorAction):
 
@@ -40,188 +64,923 @@ class FabricAction(SendorAction):
 				raise Exception("Fabric command failed")
 			return result
 
-class CopyFileAction(FabricAction):
+class CopyFileAction(SendorAction):
+	""" Copies a file to a location on the local machine
+		The copy is made in-process, by cloning the file or letting the kernel move the data when the filesystem
+		allows it (see local_copy). In 'hardlink' mode, the target becomes a hard link to the source instead,
+		when both are on the same filesystem. Targets which already hold the same contents are left alone
+		"""
+
+	copy_modes = ['copy', 'hardlink']
+	new_file_suffix = '.sendor-new'
+	completion_ratio_update_interval = datetime.timedelta(seconds=1)
 
-	def __init__(self, source, sha1sum, size, target):
+	def __init__(self, source, sha1sum, size, target, copy_mode='copy', max_bandwidth=None):
 		super(CopyFileAction, self).__init__(completion_weight=50)
+		if copy_mode not in self.copy_modes:
+			raise Exception("Unknown copy mode " + copy_mode + "; must be one of " + ', '.join(self.copy_modes))
 		self.source = source
+		self.sha1sum = sha1sum
+		self.size = size
 		self.target = target
+		self.copy_mode = copy_mode
+		self.max_bandwidth = max_bandwidth
+
+	def is_up_to_date(self, source, target):
+		if not os.path.exists(target):
+			return False
+		if os.path.samefile(source, target):
+			return True
+		if not self.sha1sum or os.path.getsize(target) != os.path.getsize(source):
+			return False
+		return file_sha1sum(target) == self.sha1sum
 
 	def run(self, context):
-		context.activity("Copying file")
 		source = context.translate_path(self.source)
 		target = context.translate_path(self.target)
-		self.fabric_local('cp ' + source + ' ' + target)
+
+		if self.is_up_to_date(source, target):
+			context.activity("Target file is up-to-date; skipping copy")
+			return
+
+		if self.copy_mode == 'hardlink':
+			context.activity("Linking file")
+			if link_file(source, target):
+				context.activity("Link completed")
+				return
+			context.log("Source and target are on different filesystems; copying instead")
+
+		context.activity("Copying file")
+		total_size = max(os.path.getsize(source), 1)
+		context.copied_size = 0
+		context.completion_ratio_update_timestamp = datetime.datetime.utcnow()
+
+		def progress(size):
+			context.copied_size += size
+			now = datetime.datetime.utcnow()
+			if (now - context.completion_ratio_update_timestamp) >= self.completion_ratio_update_interval:
+				context.completion_ratio_update_timestamp = now
+				context.completion_ratio(float(context.copied_size) / total_size)
+
+		# The copy is made next to the target and renamed over it, so that the target never holds partial contents
+		temp_filename = target + self.new_file_suffix
+		try:
+			with allocate_bandwidth(context, 'local:' + os.path.dirname(os.path.abspath(target)), self.max_bandwidth) as bandwidth:
+				method = copy_file(source, temp_filename, progress, throttle=bandwidth.consume)
+			os.chmod(temp_filename, os.stat(source).st_mode & 0777)
+			os.rename(temp_filename, target)
+		except:
+			if os.path.exists(temp_filename):
+				os.remove(temp_filename)
+			raise
+		context.completion_ratio(1.0)
+		context.log("Copied using " + method)
 		context.activity("Copy completed")
 
-class TestIfFileUpToDateOnTargetAction(FabricAction):
+class ReassembleChunkedFileAction(SendorAction):
+
+	block_size = 1024 * 1024
+
+	def __init__(self, chunk_store_root_path, sha1sum, size, target):
+		super(ReassembleChunkedFileAction, self).__init__(completion_weight=50)
+		self.chunk_store_root_path = chunk_store_root_path
+		self.sha1sum = sha1sum
+		self.size = size
+		self.target = target
+
+	def run(self, context):
+		context.activity("Reassembling file from chunks")
+		target = context.translate_path(self.target)
+		reassembled_size = 0
+		with ChunkedFileReader(self.chunk_store_root_path, self.sha1sum) as reader:
+			with open(target, 'wb') as output_file:
+				while True:
+					data = reader.read(self.block_size)
+					if not data:
+						break
+					output_file.write(data)
+					reassembled_size += len(data)
+					if self.size:
+						context.completion_ratio(float(reassembled_size) / self.size)
+		context.activity("Reassembly completed")
+
+class SshAction(SendorAction):
+	""" An action which talks to a target over SSH
+		Connections are taken from the process-wide connection pool, so that consecutive actions
+		and tasks can reuse them instead of performing a new handshake each time
+		"""
+
+	# Transfers are verified in ranges of this size, unless the target sets verification_range_size
+	verification_range_size = 16 * 1024 * 1024
+	max_range_retransmissions = 2
+
+	def __init__(self, completion_weight, target):
+		super(SshAction, self).__init__(completion_weight)
+		self.target = target
+
+	def connection(self):
+		return connection_pool.connection(self.target)
+
+	def allocate_bandwidth(self, context, target):
+		return allocate_bandwidth(context, target_key(target), target.get('max_bandwidth'))
+
+	def remote_sha1sum(self, connection, filename):
+		return connection.run('sha1sum -b ' + filename)[:40]
+
+	def remote_range_sha1sums(self, connection, filename, ranges):
+		""" Compute the sha1sums of (offset, length) ranges of a file on the target, with a single command """
+		if not ranges:
+			return []
+		commands = ['tail -c +' + str(offset + 1) + ' ' + filename + ' | head -c ' + str(length) + ' | sha1sum -b' for (offset, length) in ranges]
+		return [line[:40] for line in connection.run('; '.join(commands)).splitlines()]
+
+	def remote_stat(self, connection, filename):
+		""" Return the size and modification time of a file on the target, or None if there is no such file """
+		try:
+			attributes = connection.sftp().stat(filename)
+		except IOError:
+			return None
+		return attributes.st_size, attributes.st_mtime
+
+	def update_inventory(self, connection, target, filename, sha1sum):
+		remote_stat = self.remote_stat(connection, filename)
+		if remote_stat:
+			target_inventory.record(target, filename, sha1sum, *remote_stat)
+
+	def remote_file_matches(self, connection, target, filename, sha1sum):
+		""" Check whether a file on the target has the given sha1sum
+			If the inventory knows the file's contents, and the file's size and modification time have not changed
+			since, the inventory is trusted; otherwise the sha1sum is computed on the target and recorded
+			"""
+		entry = target_inventory.get(target, filename)
+		if entry:
+			remote_stat = self.remote_stat(connection, filename)
+			if remote_stat and entry.matches(*remote_stat):
+				return entry.sha1sum == sha1sum
+			target_inventory.remove(target, filename)
+
+		try:
+			target_sha1sum = self.remote_sha1sum(connection, filename)
+		except:
+			return False
+		self.update_inventory(connection, target, filename, target_sha1sum)
+		return target_sha1sum == sha1sum
+
+	def range_verifier(self, target, filename, connection=None):
+		""" Create a verifier which checks ranges of a file on a target
+			The verifier runs its commands over the given connection, alongside the transfer, or otherwise over
+			connections from the pool
+			"""
+		def remote_range_sha1sums(ranges):
+			if connection:
+				return self.remote_range_sha1sums(connection, filename, ranges)
+			with connection_pool.connection(target) as pooled_connection:
+				return self.remote_range_sha1sums(pooled_connection, filename, ranges)
+		return RangeVerifier(remote_range_sha1sums)
+
+	def resend_damaged_ranges(self, context, verifier, damaged_ranges, send_range):
+		""" Send damaged ranges again, and check them again, up to max_range_retransmissions times
+			Returns the ranges that are still damaged
+			"""
+		for attempt in range(self.max_range_retransmissions):
+			if not damaged_ranges:
+				break
+			context.log(str(len(damaged_ranges)) + " ranges were damaged during transfer; sending them again")
+			for offset, length in damaged_ranges:
+				send_range(offset, length)
+			damaged_ranges = verifier.check(damaged_ranges)
+		return damaged_ranges
+
+	def send_verified_file(self, context, connection, target, filename, size, sha1sum, read_range, compression, progress):
+		""" Send a whole file to a target as consecutive ranges, replacing any previous contents
+			Each range is checked on the target while the following ranges are sent (see RangeVerifier), and
+			only damaged ranges are sent again; the file is accepted once the hash derived from the target's
+			ranges matches the hash derived from the ranges that were sent. The data that is read is also
+			checked against sha1sum along the way. A file that remains damaged is removed from the target
+			read_range(offset, length) yields the blocks of a range of the source
+			"""
+		settings = SftpTransferSettings(target)
+		file_sha1 = hashlib.sha1()
+
+		def send_range(offset, length, replace=False, file_sha1=None):
+			blocks = read_range(offset, length)
+			if file_sha1:
+				blocks = hashed_blocks(blocks, file_sha1)
+			if compression == 'zlib':
+				return stream_blocks(connection, blocks, filename, offset, settings, progress, truncate=replace)
+			return send_blocks(connection.sftp(), blocks, filename, offset, settings, progress, mode='w' if replace else 'r+')
+
+		verifier = self.range_verifier(target, filename, connection)
+		try:
+			for offset, length in plan_ranges(size, int(target.get('verification_range_size', self.verification_range_size))):
+				verifier.add(offset, length, send_range(offset, length, offset == 0, file_sha1))
+		finally:
+			damaged_ranges = verifier.finish()
+
+		if file_sha1.hexdigest() != sha1sum:
+			connection.run('rm -f ' + filename)
+			raise Exception("Source file does not match its sha1sum")
+		damaged_ranges = self.resend_damaged_ranges(context, verifier, damaged_ranges, send_range)
+		if damaged_ranges or verifier.remote_file_sha1sum() != verifier.local_file_sha1sum():
+			connection.run('rm -f ' + filename)
+			context.activity("File corrupted during transfer; removed from target location")
+			raise Exception("File corrupted during transfer")
+
+class TestIfFileUpToDateOnTargetAction(SshAction):
 
 	def __init__(self, filename, sha1sum, target):
-		super(TestIfFileUpToDateOnTargetAction, self).__init__(completion_weight=10)
+		super(TestIfFileUpToDateOnTargetAction, self).__init__(10, target)
 		self.filename = filename
 		self.sha1sum = sha1sum
-		self.target = target
 
 	def run(self, context):
 
+		if transfer_checkpoints.exists(self.sha1sum, self.target, self.filename):
+			# Checking the whole file would be wasted effort; the transfer verifies the chunks that are already in place
+			context.activity("Previous transfer was interrupted; resuming it")
+			context.file_up_to_date_on_target = False
+			return
+
 		context.activity("Connecting to SSH server")
-		host_string = self.target['user'] + '@' + self.target['host'] + ':' + self.target['port']
-		with settings(host_string=host_string, key_filename=self.target['private_key_file']):
+		with self.connection() as connection:
 			context.activity("Checking if remote file already is up-to-date")
-			try:
-				target_sha1sum = self.fabric_remote('sha1sum -b ' + self.filename)[:40]
-			except:
-				target_sha1sum = None
-
-			if target_sha1sum == self.sha1sum:
+			if self.remote_file_matches(connection, self.target, self.filename, self.sha1sum):
 				context.activity("Remote file is up-to-date; skipping transfer")
 				context.file_up_to_date_on_target = True
 			else:
 				context.activity("Remote file is not up-to-date")
 				context.file_up_to_date_on_target = False
 
-class SftpSendFileAction(FabricAction):
+class SftpSendFileAction(SshAction):
 
 	completion_ratio_update_interval = datetime.timedelta(seconds=1)
 	
 	def __init__(self, source, filename, sha1sum, size, target):
-		super(SftpSendFileAction, self).__init__(completion_weight=100)
+		super(SftpSendFileAction, self).__init__(100, target)
 		self.source = source
 		self.filename = filename
 		self.sha1sum = sha1sum
-		self.target = target
 		self.transferred = None
 
 	def run(self, context):
 
 		if not (hasattr(context, 'file_up_to_date_on_target') and context.file_up_to_date_on_target):
+			source_path = context.translate_path(self.source)
+			self.transferred = 0
+			self.total = os.path.getsize(source_path)
 		
-			def cb(transferred, total):
-				self.transferred = transferred
-				self.total = total
+			def progress(size):
+				bandwidth.consume(size)
+				self.transferred += size
 				now = datetime.datetime.utcnow()
 				if (now - context.completion_ratio_update_timestamp) >= self.completion_ratio_update_interval:
 					context.completion_ratio_update_timestamp = now
 					ratio = float(self.transferred) / self.total
 					context.completion_ratio(ratio)
 
+			def read_range(offset, length):
+				return read_file_range(source_path, offset, length, settings.block_size)
+
 			context.activity("Connecting to SSH server")
-			host_string = self.target['user'] + '@' + self.target['host'] + ':' + self.target['port']
-			with settings(host_string=host_string, key_filename=self.target['private_key_file']):
-				source_path = context.translate_path(self.source)
-
-				key_file = self.target['private_key_file']
-				key = paramiko.RSAKey.from_private_key_file(key_file)
-				transport = paramiko.Transport((self.target['host'], int(self.target['port'])))
-				transport.connect(username = self.target['user'], pkey = key)
-				context.activity("Transferring file via SFTP")
+			with self.connection() as connection:
+				settings = SftpTransferSettings(self.target)
+				compression = choose_compression(source_path, settings)
+				target_inventory.remove(self.target, self.filename)
 				context.completion_ratio_update_timestamp = datetime.datetime.utcnow()
-				sftp = paramiko.SFTPClient.from_transport(transport)
-				sftp.put(source_path, self.filename, callback=cb)
+				with self.allocate_bandwidth(context, self.target) as bandwidth:
+					if compression == 'zlib':
+						context.activity("Transferring compressed file via SSH, verifying it along the way")
+					else:
+						context.activity("Transferring file via SFTP, verifying it along the way")
+					self.send_verified_file(context, connection, self.target, self.filename, self.total, self.sha1sum, read_range, compression, progress)
 
-				context.activity("Validating file integrity")
-				target_sha1sum = self.fabric_remote('sha1sum -b ' + self.filename)[:40]
-				if target_sha1sum != self.sha1sum:
-					self.fabric_remote('rm ' + self.filename)
-					context.activity("File corrupted during transfer; removed from target location")
-					raise Exception("File corrupted during transfer")
+				self.update_inventory(connection, self.target, self.filename, self.sha1sum)
 
 			context.activity("Transfer complete")
 
-class ParallelSftpSendFileAction(FabricAction):
+class ParallelSftpSendFileAction(SshAction):
+	""" Sends a file as chunks over several concurrent SFTP streams
+		The chunks are laid out from the target's chunk_size, and a ParallelTransferScheduler hands out runs of
+		them to streams while it tunes the number of streams, starting from max_parallel_transfers and going up
+		to max_parallel_transfers_limit; what works best is remembered per target for the next transfer
+		"""
 
 	min_chunks = 1
 	max_chunks = 99
-	completion_ratio_update_interval = datetime.timedelta(seconds=1)
-	block_size = 16384
+	initial_claim_size = 8 * 1024 * 1024
+	min_tuning_measurements = 2
 
 	def __init__(self, source, filename, sha1sum, size, target):
-		super(ParallelSftpSendFileAction, self).__init__(completion_weight=100)
+		super(ParallelSftpSendFileAction, self).__init__(100, target)
 		self.source = source
 		self.filename = filename
 		self.sha1sum = sha1sum
 		self.size = size
-		self.target = target
 		self.transferred = None
 
+	def plan_chunks(self):
+		num_chunks = max(self.min_chunks, min(self.max_chunks, int(self.size / int(self.target['chunk_size']))))
+		chunks = []
+		for i in range(num_chunks):
+			offset = (i * self.size) // num_chunks
+			length = ((i + 1) * self.size) // num_chunks - offset
+			chunks.append((offset, length))
+		return chunks
+
+	def remote_file_size(self, connection):
+		try:
+			return connection.sftp().stat(self.filename).st_size
+		except IOError:
+			return None
+
+	def verify_chunks(self, verifier, checkpoint, indices):
+		""" Compare the target's contents of the given chunks with the checkpoint, and forget chunks that differ
+			Returns the number of chunks that differed
+			"""
+		ranges = [checkpoint.chunks[index] for index in indices]
+		bad_ranges = verifier.check(ranges, [checkpoint.completed_chunks[index] for index in indices])
+		for index in indices:
+			if checkpoint.chunks[index] in bad_ranges:
+				checkpoint.discard(index)
+		return len(bad_ranges)
+
 	def run(self, context):
 
 		if not (hasattr(context, 'file_up_to_date_on_target') and context.file_up_to_date_on_target):
 			source = context.translate_path(self.source)
+			chunks = self.plan_chunks()
+
+			context.activity("Connecting to SSH server")
+			checkpoint = transfer_checkpoints.load(self.sha1sum, self.size, self.target, self.filename, chunks)
+			target_inventory.remove(self.target, self.filename)
+			# Every chunk is checked on the target as soon as it has been sent, while the other chunks are being sent
+			verifier = self.range_verifier(self.target, self.filename)
+			try:
+				with self.connection() as connection:
+					if checkpoint and self.remote_file_size(connection) != self.size:
+						context.activity("File on target machine does not match the interrupted transfer; starting over")
+						checkpoint = None
+
+					if checkpoint:
+						context.activity("Resuming interrupted transfer; verifying previously transferred chunks")
+						num_bad_chunks = self.verify_chunks(verifier, checkpoint, sorted(checkpoint.completed_chunks.keys()))
+						context.log(str(len(checkpoint.completed_chunks)) + " of " + str(len(chunks)) + " chunks verified on target machine; " + str(num_bad_chunks) + " damaged chunks will be sent again")
+					else:
+						context.activity("Creating file on target machine")
+						connection.run('truncate -s ' + str(self.size) + ' ' + self.filename)
+						checkpoint = transfer_checkpoints.create(self.sha1sum, self.size, self.target, self.filename, chunks)
+			except:
+				verifier.finish()
+				raise
+
+			pending_chunks = checkpoint.pending_chunks()
+
+			context.activity("Transferring chunks using SFTP, verifying them along the way")
+
+			previously_transmitted_size = checkpoint.completed_size()
+			context.transmitted_size = previously_transmitted_size
+			context.total_size = self.size
+
+			def report_progress(transmitted_size):
+				context.completion_ratio(float(previously_transmitted_size + transmitted_size) / max(self.size, 1))
+
+			settings = SftpTransferSettings(self.target)
+			is_compressed = choose_compression(source, settings) == 'zlib'
+			if is_compressed:
+				context.log("Sending compressed chunks")
+
+			# The streams send slices of one shared mapping of the source, and count the bytes that they send
+			# on their own; the scheduler adds the counts up and reports progress once per interval
+			def transfer_chunk(index, chunk_progress):
+
+				def progress(size):
+					bandwidth.consume(size)
+					chunk_progress(size)
+
+				offset, length = checkpoint.chunks[index]
+				blocks = mapped_file.blocks(offset, length, settings.block_size)
+				with self.connection() as connection:
+					if is_compressed:
+						chunk_sha1sum = stream_blocks(connection, blocks, self.filename, offset, settings, progress)
+					else:
+						chunk_sha1sum = send_blocks(connection.sftp(), blocks, self.filename, offset, settings, progress)
+				checkpoint.complete(index, chunk_sha1sum)
+				verifier.add(offset, length, chunk_sha1sum)
+
+			# Start from what worked best for this target last time, and let the scheduler adjust from there
 			max_parallel_transfers = int(self.target['max_parallel_transfers'])
-			num_chunks = max(self.min_chunks, min(self.max_chunks, int(self.size / int(self.target['chunk_size']))))
+			max_streams = int(self.target.get('max_parallel_transfers_limit', 2 * max_parallel_transfers))
+			tuning = transfer_tuning.get(self.target)
+			if tuning:
+				scheduler = ParallelTransferScheduler(chunks, pending_chunks, transfer_chunk, tuning['streams'], max_streams, tuning['claim_size'], report_progress)
+			else:
+				scheduler = ParallelTransferScheduler(chunks, pending_chunks, transfer_chunk, max_parallel_transfers, max_streams, self.initial_claim_size, report_progress)
+
+			# Wait for all chunks to complete transfer, and re-raise any exception thrown by the streams
+			# The streams share one allocation, so that the transfer as a whole keeps to its limits
+			with MappedFile(source) as mapped_file, self.allocate_bandwidth(context, self.target) as bandwidth:
+				try:
+					best_streams, claim_size, throughput = scheduler.run()
+				finally:
+					damaged_ranges = verifier.finish()
+					context.transmitted_size = previously_transmitted_size + scheduler.transferred_size()
+				if scheduler.num_measurements >= self.min_tuning_measurements:
+					transfer_tuning.record(self.target, best_streams, claim_size, throughput)
+					context.log("Transferred with up to " + str(best_streams) + " streams at " + str(int(throughput / 1024)) + " kB/s")
+
+				# Only the chunks that arrived damaged are sent again; if they stay damaged, they are forgotten,
+				# so that a retry of the task sends only them
+				damaged_ranges = self.resend_damaged_ranges(context, verifier, damaged_ranges, lambda offset, length: transfer_chunk(chunks.index((offset, length)), lambda size: None))
+			if damaged_ranges:
+				for offset, length in damaged_ranges:
+					checkpoint.discard(chunks.index((offset, length)))
+				context.activity("File corrupted during transfer; corrupted chunks will be sent again on retry")
+				raise Exception("File corrupted during transfer")
+
+			# The hash of the file on the target is derived from its chunks, each of which has been checked
+			if verifier.remote_file_sha1sum() != combined_sha1sum([checkpoint.completed_chunks[index] for index in range(len(chunks))]):
+				checkpoint.remove()
+				with self.connection() as connection:
+					connection.run('rm -f ' + self.filename)
+				context.activity("File corrupted during transfer; removed from target location")
+				raise Exception("File corrupted during transfer")
+
+			with self.connection() as connection:
+				self.update_inventory(connection, self.target, self.filename, self.sha1sum)
+
+			checkpoint.remove()
+
+			context.activity("Transfer complete")
+
+class DeltaSendFileAction(SshAction):
+	""" Sends only the parts of a file that differ from the version that is already on the target
+		A helper script on the target computes signatures of each block of the old version; the differences
+		are then sent next to the file, and the helper reconstructs the new version and atomically replaces
+		the old one with it. If the target has no previous version, the whole file is sent
+		The helper is uploaded under a name that is derived from its contents, and only if the target does
+		not have it yet; each connection checks this once
+		"""
+
+	delta_suffix = '.sendor-delta'
+	new_file_suffix = '.sendor-new'
+	completion_ratio_update_interval = datetime.timedelta(seconds=1)
+
+	def __init__(self, source, filename, sha1sum, size, target):
+		super(DeltaSendFileAction, self).__init__(100, target)
+		self.source = source
+		self.filename = filename
+		self.sha1sum = sha1sum
+		self.size = size
+
+	def install_helper(self, connection):
+		""" Make sure that the target has the helper, and return its filename """
+		filename = helper_filename()
+		if filename not in connection.installed_files:
+			sftp = connection.sftp()
+			try:
+				sftp.stat(filename)
+			except IOError:
+				# Upload under a temporary name first, so that concurrent transfers never run a partial helper
+				temp_filename = filename + '.' + binascii.hexlify(os.urandom(8))
+				sftp.put(helper_path, temp_filename)
+				connection.run('mv -f ' + temp_filename + ' ' + filename)
+			connection.installed_files.add(filename)
+		return filename
+
+	def run(self, context):
+
+		if not (hasattr(context, 'file_up_to_date_on_target') and context.file_up_to_date_on_target):
+			source = context.translate_path(self.source)
+			settings = SftpTransferSettings(self.target)
+			block_size = int(self.target.get('delta_block_size', 65536))
+
+			context.transmitted_size = 0
+			context.completion_ratio_update_timestamp = datetime.datetime.utcnow()
+
+			def progress(size):
+				bandwidth.consume(size)
+				context.transmitted_size += size
+				now = datetime.datetime.utcnow()
+				if (now - context.completion_ratio_update_timestamp) >= self.completion_ratio_update_interval:
+					context.completion_ratio_update_timestamp = now
+					context.completion_ratio(float(context.transmitted_size) / self.size)
 
 			context.activity("Connecting to SSH server")
-			host_string = self.target['user'] + '@' + self.target['host'] + ':' + self.target['port']
-			with settings(host_string=host_string, key_filename=self.target['private_key_file']):
+			target_inventory.remove(self.target, self.filename)
+			with self.connection() as connection, self.allocate_bandwidth(context, self.target) as bandwidth:
+				sftp = connection.sftp()
+				try:
+					sftp.stat(self.filename)
+				except IOError:
+					context.activity("No previous version on target machine; transferring whole file via SFTP")
+					read_range = lambda offset, length: read_file_range(source, offset, length, settings.block_size)
+					self.send_verified_file(context, connection, self.target, self.filename + self.new_file_suffix, self.size, self.sha1sum, read_range, 'none', progress)
+					connection.run('mv -f ' + self.filename + self.new_file_suffix + ' ' + self.filename)
+					self.update_inventory(connection, self.target, self.filename, self.sha1sum)
+					context.activity("Transfer complete")
+					return
+
+				context.activity("Computing signatures of previous version on target machine")
+				helper_command = self.target.get('delta_python', 'python') + ' ' + self.install_helper(connection)
+				signatures = parse_signatures(connection.run(helper_command + ' signatures ' + self.filename + ' ' + str(block_size)))
+
+				context.activity("Transferring differences via SFTP")
+				delta_filename = self.filename + self.delta_suffix
+				with sftp.open(delta_filename, 'w', bufsize=settings.request_size) as delta_file:
+					delta_file.MAX_REQUEST_SIZE = settings.request_size
+					delta_file.set_pipelined(settings.pipelined)
+					writer = DeltaWriter(delta_file, block_size)
+					compute_delta(source, signatures, block_size, writer, progress)
+				context.log("Sent " + str(writer.literal_bytes) + " bytes; reused " + str(writer.copied_bytes) + " bytes of the previous version")
+
+				context.activity("Reconstructing file on target machine")
+				connection.run(helper_command + ' apply ' + self.filename + ' ' + delta_filename + ' ' + self.filename + ' ' + self.sha1sum)
+				self.update_inventory(connection, self.target, self.filename, self.sha1sum)
 
-				context.activity("Creating file on target machine")
-				self.fabric_remote('truncate -s ' + str(self.size) + ' ' + self.filename)
+			context.activity("Transfer complete")
 
-				context.activity("Transferring chunks using SFTP")
+class FanOutDistributionAction(SshAction):
+	""" Distributes one file to several targets at once
+		The source file is mapped into memory once, and the same pages are sent to every target concurrently.
+		Each target succeeds or fails on its own; its progress is reported through context.target_progress,
+		its completion is logged as soon as it has the file, and the action fails after all targets have
+		finished if any of them failed
+		Files are copied directly into the directory of 'cp' targets, and are sent with SFTP, or streamed
+		compressed, to SSH-based targets
+		"""
+
+	ssh_distribution_methods = ['sftp', 'parallel_sftp', 'delta']
+	max_parallel_targets = 16
+	completion_ratio_update_interval = datetime.timedelta(seconds=1)
 
-				completion_ratio_lock = threading.Lock()
-				
-				context.transmitted_size = 0
-				context.total_size = self.size
-				context.completion_ratio_update_timestamp = datetime.datetime.utcnow()
-				
-				def transfer_file_thread_initializer(target):
-					key_file = target['private_key_file']
-					key = paramiko.RSAKey.from_private_key_file(key_file)
-					transport = paramiko.Transport((target['host'], int(target['port'])))
-					transport.connect(username = target['user'], pkey = key)
-					threadlocal.sftp = paramiko.SFTPClient.from_transport(transport)
-				
-				def transfer_file_thread(context, sourcefile, targetfile, offset, length):
-					with open(sourcefile, 'r') as inputfile:
-						with threadlocal.sftp.file(targetfile, 'r+') as outputfile:
-							inputfile.seek(offset, 0)
-							outputfile.seek(offset, outputfile.SEEK_SET)
-							bytes_transferred = 0
-
-							while bytes_transferred < length:
-								block_size = self.block_size
-								if block_size > length - bytes_transferred:
-									block_size = length - bytes_transferred
-								data = inputfile.read(block_size)
-								outputfile.write(data)
-								bytes_transferred += block_size
-
-								with completion_ratio_lock:
-									context.transmitted_size += block_size
-									now = datetime.datetime.utcnow()
-									if (now - context.completion_ratio_update_timestamp) >= self.completion_ratio_update_interval:
-										context.completion_ratio_update_timestamp = now
-										ratio = float(context.transmitted_size) / context.total_size
-										context.completion_ratio(ratio)
-
-				# Bugfix for http://bugs.python.org/issue10015
-				if not hasattr(threading.current_thread(), "_children"):
-					threading.current_thread()._children = weakref.WeakKeyDictionary()
-
-				thread_pool = multiprocessing.pool.ThreadPool(max_parallel_transfers, transfer_file_thread_initializer, (self.target, ))
-					
-				results = []
-				for i in range(num_chunks):
-					offset = (i * self.size) // num_chunks
-					length = ((i + 1) * self.size) // num_chunks - offset
-					results.append(thread_pool.apply_async(transfer_file_thread, (context, source, self.filename, offset, length)))
+	def __init__(self, source, filename, sha1sum, size, targets):
+		super(FanOutDistributionAction, self).__init__(100, None)
+		self.source = source
+		self.filename = filename
+		self.sha1sum = sha1sum
+		self.size = size
+		self.targets = targets
+
+	def log_completion(self, target_id, target):
+		distribution_logger.info("Completed distribution of " + self.filename + " to " + target.get('name', target_id))
+
+	def copy_to_directory(self, target, blocks, progress):
+		target_filename = os.path.join(target['directory'], self.filename)
+		sha1 = hashlib.sha1()
+		with open(target_filename, 'wb') as output_file:
+			for data in blocks:
+				output_file.write(data)
+				sha1.update(data)
+				progress(len(data))
+		if sha1.hexdigest() != self.sha1sum:
+			os.remove(target_filename)
+			raise Exception("File corrupted during transfer")
+
+	def send_to_ssh_target(self, context, target, read_range, progress, compression):
+		with connection_pool.connection(target) as connection:
+			if self.remote_file_matches(connection, target, self.filename, self.sha1sum):
+				return False
+
+			target_inventory.remove(target, self.filename)
+			self.send_verified_file(context, connection, target, self.filename, self.size, self.sha1sum, read_range, compression, progress)
+			self.update_inventory(connection, target, self.filename, self.sha1sum)
+		return True
+
+	def run(self, context):
+		source = context.translate_path(self.source)
+
+		completion_ratio_lock = threading.Lock()
+		context.transmitted_size = 0
+		context.completion_ratio_update_timestamp = datetime.datetime.utcnow()
+		total_size = max(self.size * len(self.targets), 1)
+
+		def distribute_to_target(target_id, target, mapped_file):
+			transmitted_size = [0]
+			target_progress_update_timestamp = [datetime.datetime.utcnow()]
+
+			def progress(size):
+				bandwidth.consume(size)
+				with completion_ratio_lock:
+					transmitted_size[0] += size
+					context.transmitted_size += size
+					now = datetime.datetime.utcnow()
+					if (now - context.completion_ratio_update_timestamp) >= self.completion_ratio_update_interval:
+						context.completion_ratio_update_timestamp = now
+						context.completion_ratio(float(context.transmitted_size) / total_size)
+					if (now - target_progress_update_timestamp[0]) >= self.completion_ratio_update_interval:
+						target_progress_update_timestamp[0] = now
+						context.target_progress(target_id, 'in_progress', float(transmitted_size[0]) / max(self.size, 1))
 
+			try:
+				context.target_progress(target_id, 'in_progress', 0.0)
+				block_size = SftpTransferSettings(target).block_size
+				read_range = lambda offset, length: read_mapped_range(mapped_file, offset, length, block_size)
+				if target['distribution_method'] == 'cp':
+					with allocate_bandwidth(context, 'local:' + os.path.abspath(target['directory']), target.get('max_bandwidth')) as bandwidth:
+						self.copy_to_directory(target, read_range(0, self.size), progress)
+				elif target['distribution_method'] in self.ssh_distribution_methods:
+					with self.allocate_bandwidth(context, target) as bandwidth:
+						if not self.send_to_ssh_target(context, target, read_range, progress, choose_compression(source, SftpTransferSettings(target))):
+							context.log(target_id + ": remote file is up-to-date; skipped transfer")
+				else:
+					raise Exception("Distribution method " + target['distribution_method'] + " cannot be used when distributing to several targets")
+				context.target_progress(target_id, 'completed', 1.0)
+				self.log_completion(target_id, target)
+				return True
+			except Exception, e:
+				logger.exception("Distribution to " + target_id + " failed")
+				context.log(target_id + ": distribution failed: " + str(e))
+				context.target_progress(target_id, 'failed', float(transmitted_size[0]) / max(self.size, 1))
+				return False
+
+		context.activity("Distributing file to " + str(len(self.targets)) + " targets")
+
+		# Bugfix for http://bugs.python.org/issue10015
+		if not hasattr(threading.current_thread(), "_children"):
+			threading.current_thread()._children = weakref.WeakKeyDictionary()
+
+		with open(source, 'rb') as source_file:
+			# Empty files cannot be mapped
+			mapped_file = mmap.mmap(source_file.fileno(), 0, access=mmap.ACCESS_READ) if self.size else None
+			try:
+				thread_pool = multiprocessing.pool.ThreadPool(min(self.max_parallel_targets, max(len(self.targets), 1)))
+				results = [thread_pool.apply_async(distribute_to_target, (target_id, target, mapped_file)) for target_id, target in self.targets]
 				thread_pool.close()
+				succeeded = [result.get() for result in results]
+				thread_pool.join()
+			finally:
+				if mapped_file:
+					mapped_file.close()
+
+		failed_target_ids = [target_id for (target_id, target), target_succeeded in zip(self.targets, succeeded) if not target_succeeded]
+		if failed_target_ids:
+			context.activity("Distribution failed for " + str(len(failed_target_ids)) + " of " + str(len(self.targets)) + " targets")
+			raise Exception("Distribution failed for targets: " + ', '.join(failed_target_ids))
+
+		context.activity("Distribution complete")
+
+class RelayDistributionAction(FanOutDistributionAction):
+	""" Distributes one file to many SSH targets through a distribution tree
+		This host sends the file to one target per round; meanwhile, every target that already holds a verified
+		copy sends it on to another target, by running ssh on that target, so the number of targets holding the
+		file roughly doubles each round while this host only sends about log2(n) copies. Relayed copies are
+		verified by computing their sha1sum on the receiving target before they replace the file.
+		A target can act as a relay if it has a relay_private_key_file, which is the path on that target of a
+		key that the other targets accept; it reaches the others through their relay_host (default: host),
+		and relay_ssh_options are added to its ssh command line. Relaying from a target stops after it has
+		failed once, and targets whose relayed copy failed are sent their copy by this host instead
+		"""
+
+	relay_suffix = '.sendor-relay'
+	default_relay_ssh_options = '-o BatchMode=yes'
+
+	def can_relay(self, target):
+		return bool(target.get('relay_private_key_file'))
+
+	def relay_command(self, source_target, destination_target, temp_filename):
+		""" Return the command which, run on source_target, copies the file to temp_filename on destination_target """
+		destination = destination_target['user'] + '@' + destination_target.get('relay_host', destination_target['host'])
+		return ' '.join(['ssh',
+			'-p', str(destination_target['port']),
+			'-i', pipes.quote(source_target['relay_private_key_file']),
+			source_target.get('relay_ssh_options', self.default_relay_ssh_options),
+			pipes.quote(destination),
+			pipes.quote('cat > ' + pipes.quote(temp_filename)),
+			'<', pipes.quote(self.filename)])
+
+	def relay_to_target(self, source_target, destination_target):
+		temp_filename = self.filename + self.relay_suffix
+		with connection_pool.connection(source_target) as connection:
+			connection.run(self.relay_command(source_target, destination_target, temp_filename))
+		with connection_pool.connection(destination_target) as connection:
+			target_inventory.remove(destination_target, self.filename)
+			if self.remote_sha1sum(connection, temp_filename) != self.sha1sum:
+				connection.run('rm -f ' + temp_filename)
+				raise Exception("File corrupted during relay")
+			connection.run('mv -f ' + temp_filename + ' ' + self.filename)
+			self.update_inventory(connection, destination_target, self.filename, self.sha1sum)
+
+	def is_up_to_date(self, target):
+		try:
+			with connection_pool.connection(target) as connection:
+				return self.remote_file_matches(connection, target, self.filename, self.sha1sum)
+		except Exception:
+			return False
 
-				# Wait for all chunks to complete transfer, and re-raise any exceptions thrown inside those worker threads
-				for result in results:
-					result.get()
+	def run(self, context):
+		source = context.translate_path(self.source)
+		targets = dict(self.targets)
 
-				context.activity("Validating file integrity")
-				target_sha1sum = self.fabric_remote('sha1sum -b ' + self.filename)[:40]
-				if target_sha1sum != self.sha1sum:
-					self.fabric_remote('rm ' + self.filename)
-					context.activity("File corrupted during transfer; removed from target location")
-					raise Exception("File corrupted during transfer")
+		def send_from_host(target_id, target, mapped_file):
+			transmitted_size = [0]
+			target_progress_update_timestamp = [datetime.datetime.utcnow()]
 
-			context.activity("Transfer complete")
+			def progress(size):
+				bandwidth.consume(size)
+				transmitted_size[0] += size
+				now = datetime.datetime.utcnow()
+				if (now - target_progress_update_timestamp[0]) >= self.completion_ratio_update_interval:
+					target_progress_update_timestamp[0] = now
+					context.target_progress(target_id, 'in_progress', float(transmitted_size[0]) / max(self.size, 1))
+
+			block_size = SftpTransferSettings(target).block_size
+			read_range = lambda offset, length: read_mapped_range(mapped_file, offset, length, block_size)
+			with self.allocate_bandwidth(context, target) as bandwidth:
+				self.send_to_ssh_target(context, target, read_range, progress, choose_compression(source, SftpTransferSettings(target)))
+
+		def copy_to_target(source_id, target_id, mapped_file):
+			""" Send the file to a target, from this host if source_id is None, and otherwise from that target
+				Returns whether the copy succeeded
+				"""
+			try:
+				context.target_progress(target_id, 'in_progress', 0.0)
+				if source_id is None:
+					send_from_host(target_id, targets[target_id], mapped_file)
+				else:
+					self.relay_to_target(targets[source_id], targets[target_id])
+					context.log(target_id + ": relayed from " + source_id)
+				return True
+			except Exception, e:
+				logger.exception("Distribution to " + target_id + " from " + (source_id or "this host") + " failed")
+				context.log(target_id + ": distribution from " + (source_id or "this host") + " failed: " + str(e))
+				return False
+
+		non_ssh_target_ids = [target_id for target_id, target in self.targets if target['distribution_method'] not in self.ssh_distribution_methods]
+		for target_id in non_ssh_target_ids:
+			context.log(target_id + ": distribution method " + targets[target_id]['distribution_method'] + " cannot be used when relaying between targets")
+			context.target_progress(target_id, 'failed', 0.0)
+		ssh_target_ids = [target_id for target_id, target in self.targets if target_id not in non_ssh_target_ids]
+
+		# Bugfix for http://bugs.python.org/issue10015
+		if not hasattr(threading.current_thread(), "_children"):
+			threading.current_thread()._children = weakref.WeakKeyDictionary()
+
+		thread_pool = multiprocessing.pool.ThreadPool(min(self.max_parallel_targets, max(len(self.targets), 1)))
+		try:
+			# Targets that already hold the file are the first relays
+			context.activity("Checking which targets already hold the file")
+			up_to_date = thread_pool.map(lambda target_id: self.is_up_to_date(targets[target_id]), ssh_target_ids)
+			holder_ids = [target_id for target_id, is_up_to_date in zip(ssh_target_ids, up_to_date) if is_up_to_date]
+			for target_id in holder_ids:
+				context.log(target_id + ": remote file is up-to-date; skipped transfer")
+				context.target_progress(target_id, 'completed', 1.0)
+				self.log_completion(target_id, targets[target_id])
+			pending_ids = collections.deque([target_id for target_id in ssh_target_ids if target_id not in holder_ids])
+			relay_ids = [target_id for target_id in holder_ids if self.can_relay(targets[target_id])]
+			host_only_ids = collections.deque()
+			failed_target_ids = list(non_ssh_target_ids)
+			num_host_copies = 0
+			num_relayed_copies = 0
+
+			context.activity("Distributing file to " + str(len(pending_ids)) + " targets through a distribution tree")
+			with open(source, 'rb') as source_file:
+				# Empty files cannot be mapped
+				mapped_file = mmap.mmap(source_file.fileno(), 0, access=mmap.ACCESS_READ) if self.size else None
+				try:
+					while pending_ids or host_only_ids:
+						# Every relay feeds one target, and this host feeds one of the targets that are left
+						copies = [(source_id, pending_ids.popleft()) for source_id in relay_ids if pending_ids]
+						if host_only_ids:
+							copies.append((None, host_only_ids.popleft()))
+						elif pending_ids:
+							copies.append((None, pending_ids.popleft()))
+
+						results = [thread_pool.apply_async(copy_to_target, (source_id, target_id, mapped_file)) for source_id, target_id in copies]
+						for (source_id, target_id), result in zip(copies, results):
+							if result.get():
+								context.target_progress(target_id, 'completed', 1.0)
+								self.log_completion(target_id, targets[target_id])
+								if self.can_relay(targets[target_id]):
+									relay_ids.append(target_id)
+								if source_id is None:
+									num_host_copies += 1
+								else:
+									num_relayed_copies += 1
+							elif source_id is None:
+								context.target_progress(target_id, 'failed', 0.0)
+								failed_target_ids.append(target_id)
+							else:
+								relay_ids.remove(source_id)
+								host_only_ids.append(target_id)
+						context.completion_ratio(float(len(self.targets) - len(pending_ids) - len(host_only_ids)) / max(len(self.targets), 1))
+				finally:
+					if mapped_file:
+						mapped_file.close()
+		finally:
+			thread_pool.close()
+			thread_pool.join()
+
+		context.log("Copies sent from this host: " + str(num_host_copies) + "; relayed between targets: " + str(num_relayed_copies))
+		if failed_target_ids:
+			context.activity("Distribution failed for " + str(len(failed_target_ids)) + " of " + str(len(self.targets)) + " targets")
+			raise Exception("Distribution failed for targets: " + ', '.join(failed_target_ids))
+
+		context.activity("Distribution complete")
+
+class BundleDistributionAction(SshAction):
+	""" Distributes many files to one SSH target as a single bundle
+		One remote call tells which files the target already holds. The others are streamed as one tar archive
+		over a single SSH channel, into a staging directory on the target, and the same command hashes every
+		unpacked file; only files whose contents match are then moved over their targets, so the target never
+		holds a partially written file. The outcome of each file is reported through context.file_progress, and
+		the action fails after all files have been handled if any of them failed
+		"""
+
+	distribution_methods = ['sftp', 'parallel_sftp', 'delta']
+	staging_directory_prefix = '.sendor-bundle-'
+	completion_ratio_update_interval = datetime.timedelta(seconds=1)
+
+	def __init__(self, files, target):
+		super(BundleDistributionAction, self).__init__(100, target)
+		self.files = files
+
+	def remote_sha1sums(self, connection, filenames):
+		""" Return the sha1sums of those of the files that exist on the target, by filename, with a single command """
+		output = connection.run('sha1sum -b ' + ' '.join([pipes.quote(filename) for filename in filenames]) + ' 2>/dev/null; true')
+		# sha1sum escapes unusual filenames, which then do not match, and are sent again
+		return dict([(line[42:], line[:40]) for line in output.splitlines() if not line.startswith('\\')])
+
+	def send_bundle(self, connection, files, staging_directory, translate_path, progress):
+		""" Stream files to the staging directory on the target
+			Returns the sha1sums of the data that was sent, and of the unpacked files on the target
+			"""
+		channel = connection.transport.open_session()
+		try:
+			channel.exec_command(unpack_command(staging_directory, len(files)))
+			sent_sha1sums = write_bundle(ChannelWriter(channel), files, translate_path, progress)
+			channel.shutdown_write()
+			output = channel.makefile('rb').read()
+			errors = channel.makefile_stderr('rb').read()
+			exit_status = channel.recv_exit_status()
+		finally:
+			channel.close()
+		if exit_status != 0:
+			raise Exception("Unpacking bundle on target failed: " + errors)
+		return sent_sha1sums, parse_sha1sums(output)
+
+	def run(self, context):
+		total_size = max(sum([bundle_file.size for bundle_file in self.files]), 1)
+		context.transmitted_size = 0
+		context.completion_ratio_update_timestamp = datetime.datetime.utcnow()
+
+		def progress(size):
+			bandwidth.consume(size)
+			context.transmitted_size += size
+			now = datetime.datetime.utcnow()
+			if (now - context.completion_ratio_update_timestamp) >= self.completion_ratio_update_interval:
+				context.completion_ratio_update_timestamp = now
+				context.completion_ratio(float(context.transmitted_size) / total_size)
+
+		failed_files = []
+		context.activity("Connecting to SSH server")
+		with self.connection() as connection:
+			context.activity("Checking which of " + str(len(self.files)) + " files are up-to-date on target")
+			remote_sha1sums = self.remote_sha1sums(connection, [bundle_file.filename for bundle_file in self.files])
+			pending_files = []
+			for bundle_file in self.files:
+				if remote_sha1sums.get(bundle_file.filename) == bundle_file.sha1sum:
+					context.file_progress(bundle_file.file_id, 'completed', 1.0)
+				else:
+					target_inventory.remove(self.target, bundle_file.filename)
+					pending_files.append(bundle_file)
+			context.log(str(len(self.files) - len(pending_files)) + " files are up-to-date on target; sending " + str(len(pending_files)) + " files")
+
+			if pending_files:
+				context.activity("Transferring " + str(len(pending_files)) + " files as one bundle")
+				for bundle_file in pending_files:
+					context.file_progress(bundle_file.file_id, 'in_progress', 0.0)
+				staging_directory = self.staging_directory_prefix + os.urandom(8).encode('hex')
+				try:
+					with self.allocate_bandwidth(context, self.target) as bandwidth:
+						sent_sha1sums, unpacked_sha1sums = self.send_bundle(connection, pending_files, staging_directory, context.translate_path, progress)
+				except:
+					connection.run('rm -rf ' + staging_directory)
+					raise
+
+				context.activity("Installing files on target")
+				installed_files = []
+				for index, bundle_file in enumerate(pending_files):
+					if sent_sha1sums[index] != bundle_file.sha1sum:
+						context.log(bundle_file.filename + ": source file does not match its sha1sum")
+						failed_files.append(bundle_file)
+					elif index >= len(unpacked_sha1sums) or unpacked_sha1sums[index] != bundle_file.sha1sum:
+						context.log(bundle_file.filename + ": file corrupted during transfer")
+						failed_files.append(bundle_file)
+					else:
+						installed_files.append((index, bundle_file))
+				remote_stats = parse_stats(connection.run(install_command(staging_directory, [(index, bundle_file.filename) for index, bundle_file in installed_files])))
+				for (index, bundle_file), remote_stat in zip(installed_files, remote_stats):
+					target_inventory.record(self.target, bundle_file.filename, bundle_file.sha1sum, *remote_stat)
+					context.file_progress(bundle_file.file_id, 'completed', 1.0)
+				for bundle_file in failed_files:
+					context.file_progress(bundle_file.file_id, 'failed', 0.0)
+
+		context.completion_ratio(1.0)
+		if failed_files:
+			context.activity("Distribution failed for " + str(len(failed_files)) + " of " + str(len(self.files)) + " files")
+			raise Exception("Distribution failed for files: " + ', '.join([bundle_file.filename for bundle_file in failed_files]))
+
+		context.activity("Distribution complete")
 
 class SendorActionTestContext(SendorActionContext):
 
@@ -246,6 +1005,32 @@ class CopyFileActionUnitTest(unittest.TestCase):
 		action.run(SendorActionTestContext('unittest'))
 		self.assertTrue(os.path.exists('unittest/target'))
 
+	def test_copy_modes(self):
+		sha1sum = hashlib.sha1('abc123\n').hexdigest()
+
+		# A copy should report its progress, and be skipped once the target holds the same contents
+		context = SendorActionTestContext('unittest')
+		ratios = []
+		context.completion_ratio = ratios.append
+		CopyFileAction('unittest/source', sha1sum, 7, 'unittest/target').run(context)
+		self.assertEquals(open('unittest/target').read(), 'abc123\n')
+		self.assertEquals(ratios[-1], 1.0)
+		self.assertFalse(os.path.exists('unittest/target' + CopyFileAction.new_file_suffix))
+
+		context = SendorActionTestContext('unittest')
+		activities = []
+		context.activity = activities.append
+		CopyFileAction('unittest/source', sha1sum, 7, 'unittest/target').run(context)
+		self.assertEquals(activities, ["Target file is up-to-date; skipping copy"])
+
+		# Targets with other contents should be replaced, by a hard link in hardlink mode
+		with open('unittest/target', 'w') as file:
+			file.write('abc124\n')
+		CopyFileAction('unittest/source', sha1sum, 7, 'unittest/target', 'hardlink').run(SendorActionTestContext('unittest'))
+		self.assertTrue(os.path.samefile('unittest/source', 'unittest/target'))
+
+		self.assertRaises(Exception, CopyFileAction, 'unittest/source', sha1sum, 7, 'unittest/target', 'symlink')
+
 	def tearDown(self):
 		shutil.rmtree('unittest')
 
@@ -309,6 +1094,327 @@ class ParallelSftpSendFileActionUnitTest(unittest.TestCase):
 	def tearDown(self):
 		shutil.rmtree(self.root_path)
 
+class SshActionsUnitTest(unittest.TestCase):
+
+	root_path = 'unittest'
+	source_path = root_path + '/source'
+	file_contents = 'abcdefghijklmnopq1234567890' * 10
+	sha1sum = '6b489bb901fab3c1d07f1a71f1df66e32f5b8e2e'
+
+	def setUp(self):
+		from ssh_test_server import SshTestServer
+		os.mkdir(self.root_path)
+		with open(self.source_path, 'w') as file:
+			file.write(self.file_contents)
+		self.server = SshTestServer(self.root_path + '/target')
+		self.server.start()
+		self.target = self.server.create_target(self.root_path + '/client_key', max_parallel_transfers='3', chunk_size='16')
+		connection_pool.close_all()
+		connection_pool.take_statistics()
+
+	def test_ssh_actions(self):
+
+		# Distribute a file with each SSH-based method, and then check whether it is up to date
+		compressed_target = dict(self.target, compression='zlib')
+		for action in [SftpSendFileAction(self.source_path, 'sftp_file', self.sha1sum, len(self.file_contents), self.target),
+				ParallelSftpSendFileAction(self.source_path, 'parallel_sftp_file', self.sha1sum, len(self.file_contents), self.target),
+				SftpSendFileAction(self.source_path, 'compressed_sftp_file', self.sha1sum, len(self.file_contents), compressed_target),
+				ParallelSftpSendFileAction(self.source_path, 'compressed_parallel_sftp_file', self.sha1sum, len(self.file_contents), compressed_target)]:
+			context = SendorActionTestContext(self.root_path)
+			action.run(context)
+			self.assertEquals(open(self.root_path + '/target/' + action.filename).read(), self.file_contents)
+
+			context = SendorActionTestContext(self.root_path)
+			TestIfFileUpToDateOnTargetAction(action.filename, self.sha1sum, self.target).run(context)
+			self.assertTrue(context.file_up_to_date_on_target)
+
+		# All actions should have shared a few connections; parallel transfers verify chunks over a connection of their own
+		statistics = connection_pool.get_statistics()
+		self.assertTrue(statistics['misses'] <= 4)
+		self.assertTrue(statistics['hits'] > statistics['misses'])
+		self.assertEquals(len(self.server.connections), statistics['misses'])
+
+	def test_tuned_parallel_sftp(self):
+
+		# A learned number of streams and claim size should be used instead of the target's settings
+		transfer_tuning.root_path = self.root_path + '/tuning'
+		transfer_tuning.record(self.target, 1, 16, 1000.0)
+		action = ParallelSftpSendFileAction(self.source_path, 'parallel_sftp_file', self.sha1sum, len(self.file_contents), self.target)
+		action.run(SendorActionTestContext(self.root_path))
+		self.assertEquals(open(self.root_path + '/target/parallel_sftp_file').read(), self.file_contents)
+		self.assertEquals(transfer_tuning.get(self.target)['streams'], 1)
+
+	def test_range_verification(self):
+
+		# Ranges which are damaged on the target should be found while the transfer goes on, and be sent again
+		for action in [SftpSendFileAction(self.source_path, 'sftp_file', self.sha1sum, len(self.file_contents), dict(self.target, verification_range_size='64')),
+				ParallelSftpSendFileAction(self.source_path, 'parallel_sftp_file', self.sha1sum, len(self.file_contents), self.target)]:
+			remote_range_sha1sums = action.remote_range_sha1sums
+			damaged = []
+
+			def damage_first_range(connection, filename, ranges):
+				if not damaged:
+					damaged.append(ranges[0])
+					with open(self.root_path + '/target/' + filename, 'r+b') as file:
+						file.seek(ranges[0][0])
+						file.write('X')
+				return remote_range_sha1sums(connection, filename, ranges)
+			action.remote_range_sha1sums = damage_first_range
+
+			context = SendorActionTestContext(self.root_path)
+			logs = []
+			context.log = logs.append
+			action.run(context)
+			self.assertEquals(open(self.root_path + '/target/' + action.filename).read(), self.file_contents)
+			self.assertTrue("1 ranges were damaged during transfer; sending them again" in logs)
+
+	def test_bandwidth_limit(self):
+
+		# A transfer should keep to the lowest of its limits, and report its allocation
+		file_contents = os.urandom(60000)
+		with open(self.source_path, 'wb') as file:
+			file.write(file_contents)
+		action = SftpSendFileAction(self.source_path, 'limited_file', hashlib.sha1(file_contents).hexdigest(), len(file_contents), dict(self.target, max_bandwidth='50000'))
+		context = SendorActionTestContext(self.root_path)
+		context.max_bandwidth = 80000
+		allocations = []
+		context.bandwidth_allocation = allocations.append
+		start_time = time.time()
+		action.run(context)
+		self.assertTrue(time.time() - start_time > 0.6)
+		self.assertEquals(allocations[0], 50000)
+		self.assertEquals(open(self.root_path + '/target/limited_file', 'rb').read(), file_contents)
+
+	def test_resume_parallel_sftp(self):
+
+		transfer_checkpoints.root_path = self.root_path + '/checkpoints'
+		action = ParallelSftpSendFileAction(self.source_path, 'parallel_sftp_file', self.sha1sum, len(self.file_contents), self.target)
+		chunks = action.plan_chunks()
+
+		# Simulate an interrupted transfer, where one of the completed chunks has been damaged since
+		checkpoint = transfer_checkpoints.create(self.sha1sum, len(self.file_contents), self.target, action.filename, chunks)
+		target_contents = bytearray(len(self.file_contents))
+		for index in range(0, len(chunks) - 3):
+			offset, length = chunks[index]
+			target_contents[offset:offset + length] = self.file_contents[offset:offset + length]
+			checkpoint.complete(index, hashlib.sha1(self.file_contents[offset:offset + length]).hexdigest())
+		target_contents[chunks[0][0]] = 'X'
+		with open(self.root_path + '/target/' + action.filename, 'wb') as file:
+			file.write(target_contents)
+
+		# The up-to-date check should leave verification to the transfer, which should send only the missing and damaged chunks
+		context = SendorActionTestContext(self.root_path)
+		TestIfFileUpToDateOnTargetAction(action.filename, self.sha1sum, self.target).run(context)
+		self.assertFalse(context.file_up_to_date_on_target)
+		logs = []
+		context.log = logs.append
+		action.run(context)
+		self.assertEquals(open(self.root_path + '/target/' + action.filename).read(), self.file_contents)
+		self.assertEquals(logs, [str(len(chunks) - 4) + " of " + str(len(chunks)) + " chunks verified on target machine; 1 damaged chunks will be sent again"])
+		self.assertEquals(context.transmitted_size, len(self.file_contents))
+		self.assertFalse(transfer_checkpoints.exists(self.sha1sum, self.target, action.filename))
+
+		# A checkpoint which does not match the file on the target should be ignored
+		checkpoint = transfer_checkpoints.create(self.sha1sum, len(self.file_contents), self.target, action.filename, chunks)
+		checkpoint.complete(0, hashlib.sha1(self.file_contents[chunks[0][0]:chunks[0][0] + chunks[0][1]]).hexdigest())
+		os.remove(self.root_path + '/target/' + action.filename)
+		action.run(SendorActionTestContext(self.root_path))
+		self.assertEquals(open(self.root_path + '/target/' + action.filename).read(), self.file_contents)
+		self.assertFalse(transfer_checkpoints.exists(self.sha1sum, self.target, action.filename))
+
+	def test_delta(self):
+
+		target = dict(self.target, delta_python=sys.executable, delta_block_size='32')
+		target_path = self.root_path + '/target/delta_file'
+
+		# Without a previous version, the whole file should be sent
+		action = DeltaSendFileAction(self.source_path, 'delta_file', self.sha1sum, len(self.file_contents), target)
+		action.run(SendorActionTestContext(self.root_path))
+		self.assertEquals(open(target_path).read(), self.file_contents)
+
+		# With a previous version, only the differences should be sent
+		old_contents = self.file_contents[:100] + 'old version' + self.file_contents[120:]
+		with open(target_path, 'w') as file:
+			file.write(old_contents)
+		os.chmod(target_path, 0750)
+		context = SendorActionTestContext(self.root_path)
+		logs = []
+		context.log = logs.append
+		action.run(context)
+		self.assertEquals(open(target_path).read(), self.file_contents)
+		self.assertEquals(os.stat(target_path).st_mode & 0777, 0750)
+		self.assertTrue(len(logs) == 1 and logs[0].startswith("Sent "))
+		self.assertTrue(int(logs[0].split()[1]) < 100)
+		self.assertFalse(os.path.exists(target_path + DeltaSendFileAction.delta_suffix))
+
+		# The helper should be stored under a name derived from its contents, and not be uploaded again
+		helper_target_path = self.root_path + '/target/' + helper_filename()
+		self.assertTrue(os.path.exists(helper_target_path))
+		os.utime(helper_target_path, (0, 0))
+		with open(target_path, 'w') as file:
+			file.write(old_contents)
+		action.run(SendorActionTestContext(self.root_path))
+		connection_pool.close_all()
+		with open(target_path, 'w') as file:
+			file.write(old_contents)
+		action.run(SendorActionTestContext(self.root_path))
+		self.assertEquals(open(target_path).read(), self.file_contents)
+		self.assertEquals(os.stat(helper_target_path).st_mtime, 0)
+
+		# A delta that does not reconstruct the expected contents should leave the previous version in place
+		action = DeltaSendFileAction(self.source_path, 'delta_file', '0' * 40, len(self.file_contents), target)
+		self.assertRaises(Exception, action.run, SendorActionTestContext(self.root_path))
+		self.assertEquals(open(target_path).read(), self.file_contents)
+
+	def test_inventory(self):
+
+		target_inventory.root_path = self.root_path + '/inventory'
+		target_path = self.root_path + '/target/sftp_file'
+		action = SftpSendFileAction(self.source_path, 'sftp_file', self.sha1sum, len(self.file_contents), self.target)
+		action.run(SendorActionTestContext(self.root_path))
+		self.assertEquals(target_inventory.get(self.target, 'sftp_file').sha1sum, self.sha1sum)
+
+		# While the file's size and modification time are unchanged, the inventory should be trusted
+		mtime = os.stat(target_path).st_mtime
+		with open(target_path, 'w') as file:
+			file.write(self.file_contents.upper())
+		os.utime(target_path, (mtime, mtime))
+		context = SendorActionTestContext(self.root_path)
+		TestIfFileUpToDateOnTargetAction('sftp_file', self.sha1sum, self.target).run(context)
+		self.assertTrue(context.file_up_to_date_on_target)
+
+		# Once they change, the file should be hashed again, and the inventory should learn its new contents
+		os.utime(target_path, (mtime + 10, mtime + 10))
+		context = SendorActionTestContext(self.root_path)
+		TestIfFileUpToDateOnTargetAction('sftp_file', self.sha1sum, self.target).run(context)
+		self.assertFalse(context.file_up_to_date_on_target)
+		self.assertEquals(target_inventory.get(self.target, 'sftp_file').sha1sum, hashlib.sha1(self.file_contents.upper()).hexdigest())
+
+		# Files which do not exist on the target should not be up to date, whatever the inventory says
+		os.remove(target_path)
+		context = SendorActionTestContext(self.root_path)
+		TestIfFileUpToDateOnTargetAction('sftp_file', self.sha1sum, self.target).run(context)
+		self.assertFalse(context.file_up_to_date_on_target)
+		self.assertEquals(target_inventory.get(self.target, 'sftp_file'), None)
+
+	def test_fan_out(self):
+
+		os.mkdir(self.root_path + '/copy_target')
+		targets = [('ssh', dict(self.target, distribution_method='sftp')),
+			('copy', { 'distribution_method' : 'cp', 'directory' : self.root_path + '/copy_target' }),
+			('missing', { 'distribution_method' : 'cp', 'directory' : self.root_path + '/missing_directory' })]
+		action = FanOutDistributionAction(self.source_path, 'fan_out_file', self.sha1sum, len(self.file_contents), targets)
+		context = SendorActionTestContext(self.root_path)
+		target_states = {}
+		context.target_progress = lambda target_id, state, completion_ratio: target_states.__setitem__(target_id, state)
+
+		# A failing target should not prevent distribution to the other targets, but should fail the action
+		self.assertRaises(Exception, action.run, context)
+		self.assertEquals(target_states, { 'ssh' : 'completed', 'copy' : 'completed', 'missing' : 'failed' })
+		self.assertEquals(open(self.root_path + '/target/fan_out_file').read(), self.file_contents)
+		self.assertEquals(open(self.root_path + '/copy_target/fan_out_file').read(), self.file_contents)
+
+		# Targets which are up to date should be skipped
+		action = FanOutDistributionAction(self.source_path, 'fan_out_file', self.sha1sum, len(self.file_contents), targets[:1])
+		context = SendorActionTestContext(self.root_path)
+		logs = []
+		context.log = logs.append
+		action.run(context)
+		self.assertEquals(logs, ["ssh: remote file is up-to-date; skipped transfer"])
+
+	def test_relay(self):
+		import paramiko
+		from ssh_test_server import SshTestServer
+
+		# The targets accept a common relay key, which each of them can use to reach the others
+		relay_key_file = os.path.abspath(self.root_path + '/relay_key')
+		relay_key = paramiko.RSAKey.generate(1024)
+		relay_key.write_private_key_file(relay_key_file)
+		relay_settings = { 'distribution_method' : 'sftp',
+			'relay_private_key_file' : relay_key_file,
+			'relay_ssh_options' : '-o BatchMode=yes -o StrictHostKeyChecking=no -o UserKnownHostsFile=/dev/null -o LogLevel=ERROR -o PubkeyAcceptedAlgorithms=+ssh-rsa' }
+		servers = [SshTestServer(self.root_path + '/relay_target' + str(i)) for i in range(4)]
+		try:
+			targets = [('broken', dict(self.target, **dict(relay_settings, relay_private_key_file=relay_key_file + '.missing')))]
+			for i, server in enumerate(servers):
+				server.start()
+				targets.append(('target' + str(i), server.create_target(self.root_path + '/client_key' + str(i), **relay_settings)))
+			for server in servers + [self.server]:
+				server.authorized_keys.add(relay_key.get_base64())
+
+			# This host should send the file to a few targets, and the targets should relay it to the rest;
+			# the target which fails to relay should leave its receiver to this host
+			action = RelayDistributionAction(self.source_path, 'relay_file', self.sha1sum, len(self.file_contents), targets)
+			context = SendorActionTestContext(self.root_path)
+			target_states = {}
+			context.target_progress = lambda target_id, state, completion_ratio: target_states.__setitem__(target_id, state)
+			logs = []
+			context.log = logs.append
+			action.run(context)
+			self.assertEquals(target_states, dict([(target_id, 'completed') for target_id, target in targets]))
+			self.assertEquals(logs[-1], "Copies sent from this host: 3; relayed between targets: 2")
+			for server in servers + [self.server]:
+				self.assertEquals(open(server.root_path + '/relay_file').read(), self.file_contents)
+				self.assertFalse(os.path.exists(server.root_path + '/relay_file' + RelayDistributionAction.relay_suffix))
+
+			# Targets which already hold the file should relay it, without this host sending anything
+			os.remove(servers[3].root_path + '/relay_file')
+			action = RelayDistributionAction(self.source_path, 'relay_file', self.sha1sum, len(self.file_contents), targets[1:])
+			del logs[:]
+			action.run(context)
+			self.assertEquals(logs[-1], "Copies sent from this host: 0; relayed between targets: 1")
+		finally:
+			for server in servers:
+				server.stop()
+
+	def test_bundle(self):
+
+		target_inventory.root_path = self.root_path + '/inventory'
+		files = []
+		for index in range(3):
+			source = self.root_path + '/bundle_source' + str(index)
+			contents = self.file_contents * index
+			with open(source, 'w') as file:
+				file.write(contents)
+			files.append(BundleFile(str(index), source, 'bundle file ' + str(index), hashlib.sha1(contents).hexdigest(), len(contents)))
+		with open(self.root_path + '/target/bundle file 0', 'w') as file:
+			file.write('')
+
+		# Files which are up to date should be skipped, and the others installed from one bundle
+		context = SendorActionTestContext(self.root_path)
+		file_states = {}
+		context.file_progress = lambda file_id, state, completion_ratio: file_states.__setitem__(file_id, state)
+		logs = []
+		context.log = logs.append
+		BundleDistributionAction(files, self.target).run(context)
+		self.assertEquals(file_states, { '0' : 'completed', '1' : 'completed', '2' : 'completed' })
+		self.assertEquals(logs, ["1 files are up-to-date on target; sending 2 files"])
+		self.assertEquals(open(self.root_path + '/target/bundle file 2').read(), self.file_contents * 2)
+		self.assertEquals(target_inventory.get(self.target, 'bundle file 2').sha1sum, files[2].sha1sum)
+		self.assertEquals([filename for filename in os.listdir(self.root_path + '/target') if filename.startswith(BundleDistributionAction.staging_directory_prefix)], [])
+
+		# A file whose source does not match its sha1sum should fail on its own, and not replace its target
+		with open(files[2].source, 'w') as file:
+			file.write(self.file_contents.upper() * 2)
+		with open(self.root_path + '/target/bundle file 2', 'w') as file:
+			file.write('previous contents')
+		with open(files[1].source, 'w') as file:
+			file.write(self.file_contents.upper())
+		files[1].sha1sum = hashlib.sha1(self.file_contents.upper()).hexdigest()
+		file_states.clear()
+		self.assertRaises(Exception, BundleDistributionAction(files, self.target).run, context)
+		self.assertEquals(file_states, { '0' : 'completed', '1' : 'completed', '2' : 'failed' })
+		self.assertEquals(open(self.root_path + '/target/bundle file 1').read(), self.file_contents.upper())
+		self.assertEquals(open(self.root_path + '/target/bundle file 2').read(), 'previous contents')
+
+	def tearDown(self):
+		transfer_checkpoints.root_path = None
+		target_inventory.root_path = None
+		transfer_tuning.root_path = None
+		connection_pool.close_all()
+		self.server.stop()
+		shutil.rmtree(self.root_path)
+
 if __name__ == '__main__':
 	logging.basicConfig(level=logging.ERROR)
 	unittest.main()
@@ -6,8 +6,7 @@ def create_backsync_api(sendor_queue, targets, file_stash):
 	class FileStashHandler(backsync.BacksyncHandler):
 
 		def read(self, *args, **kwargs):
-			sorted_file_stash = sorted(file_stash.list(), cmp = lambda x, y: cmp(x.timestamp, y.timestamp))
-			file_stash_contents = [file.to_json() for file in sorted_file_stash]
+			file_stash_contents = [file.to_json() for file in file_stash.list_sorted()]
 			return { 'collection' : file_stash_contents }
 
 		def upsert(self, *args, **kwargs):
@@ -55,7 +54,7 @@ def create_backsync_api(sendor_queue, targets, file_stash):
 		else:
 			raise NotImplementedError
 			
-	def file_stash_notification(event_type, stashed_file):
+	def file_stash_notification(event_type, stashed_file=None, stashed_files=None):
 		class FileStashModel(object):
 			sync_name = '/api/file_stash'
 
@@ -63,6 +62,12 @@ def create_backsync_api(sendor_queue, targets, file_stash):
 			backsync.BacksyncModelRouter.post_save(FileStashModel, stashed_file.to_json())
 		elif event_type == 'remove':
 			backsync.BacksyncModelRouter.post_delete(FileStashModel, stashed_file.to_json())
+		elif event_type == 'add_many' or event_type == 'change_many':
+			for stashed_file in stashed_files:
+				backsync.BacksyncModelRouter.post_save(FileStashModel, stashed_file.to_json())
+		elif event_type == 'remove_many':
+			for stashed_file in stashed_files:
+				backsync.BacksyncModelRouter.post_delete(FileStashModel, stashed_file.to_json())
 		else:
 			raise NotImplementedError
 			
@@ -0,0 +1,242 @@
+import errno
+import logging
+import multiprocessing
+import os
+import threading
+import time
+import unittest
+import zlib
+
+logger = logging.getLogger('bandwidth')
+
+unlimited = float('inf')
+
+def water_fill(total, demands):
+	""" Share total between consumers with the given demands: no consumer gets more than it demands, and
+		whatever a consumer leaves unused is shared equally between the others
+		"""
+	allocations = [0] * len(demands)
+	remaining = total
+	order = sorted(range(len(demands)), key=lambda i: demands[i])
+	for position, i in enumerate(order):
+		share = remaining / (len(demands) - position)
+		allocations[i] = min(demands[i], share)
+		remaining -= allocations[i]
+	return allocations
+
+class BandwidthAllocation(object):
+	""" The share of bandwidth of one transfer; consume() is called with the size of each block that is sent,
+		and sleeps for as long as the transfer is ahead of its allocation (a token bucket)
+		"""
+
+	def __init__(self, manager, slot, on_change):
+		self.manager = manager
+		self.slot = slot
+		self.on_change = on_change
+		self.lock = threading.Lock()
+		self.rate = None
+		self.tokens = 0
+		self.last_time = time.time()
+		self.consumed_size = 0
+		self.last_rebalance_time = self.last_time
+		self.rebalance(self.last_time)
+
+	def rebalance(self, now):
+		""" Recompute the allocation from the transfers that are currently active; must be called with the lock held """
+		# The throughput is only known once the transfer has been measured over a whole interval
+		elapsed = now - self.last_rebalance_time
+		measured_rate = self.consumed_size / elapsed if elapsed >= self.manager.rebalance_interval_seconds else None
+		rate = self.manager.rebalance(self.slot, measured_rate, self.rate)
+		self.consumed_size = 0
+		self.last_rebalance_time = now
+		if rate != self.rate:
+			previous_rate = self.rate
+			self.rate = rate
+			# The burst allows a quarter of a second's worth of data, so that block sizes do not matter
+			self.tokens = min(self.tokens, self.burst_size())
+			if self.on_change and (previous_rate is None or rate is None or abs(rate - previous_rate) > 0.1 * previous_rate):
+				self.on_change(rate)
+
+	def burst_size(self):
+		return self.rate / 4 if self.rate is not None else 0
+
+	def consume(self, size):
+		with self.lock:
+			now = time.time()
+			self.consumed_size += size
+			if now - self.last_rebalance_time >= self.manager.rebalance_interval_seconds:
+				self.rebalance(now)
+			if self.rate is None:
+				return
+			self.tokens = min(self.burst_size(), self.tokens + (now - self.last_time) * self.rate) - size
+			self.last_time = now
+			wait = -self.tokens / self.rate if self.tokens < 0 else 0
+		if wait:
+			time.sleep(wait)
+
+	def release(self):
+		self.manager.release(self.slot)
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, type, value, traceback):
+		self.release()
+
+class BandwidthManager(object):
+	""" Shares bandwidth between all transfers of all worker processes
+
+		Limits may apply globally (global_limit), per target (given when a transfer starts) and per task (given
+		when a transfer starts, or task_limit by default); a limit of 0 or None means no limit.
+		Every transfer occupies a slot in a table in shared memory, which is created before the worker processes
+		are forked. Each transfer periodically records its throughput there, and computes its allocation from the
+		whole table: transfers which do not use their share, because they are limited elsewhere, only keep
+		what they use, and the rest of the capacity is shared between the transfers that can use it
+		"""
+
+	# Fields of each slot in the shared table
+	in_use_field, process_id_field, target_hash_field, target_limit_field, task_limit_field, demand_field = range(6)
+	num_fields = 6
+
+	rebalance_interval_seconds = 0.5
+	demand_headroom = 2
+	min_demand = 4096
+
+	def __init__(self, max_slots=256, global_limit=0, task_limit=0):
+		self.max_slots = max_slots
+		self.global_limit = global_limit
+		self.task_limit = task_limit
+		self.lock = multiprocessing.Lock()
+		self.table = multiprocessing.RawArray('d', max_slots * self.num_fields)
+
+	def get(self, slot, field):
+		return self.table[slot * self.num_fields + field]
+
+	def set(self, slot, field, value):
+		self.table[slot * self.num_fields + field] = value
+
+	def allocate(self, target_name, target_limit=None, task_limit=None, on_change=None):
+		""" Start a transfer to a target, and return its allocation; the allocation must be released afterward
+			on_change is called with the allocated bytes per second, or None for unlimited, whenever it changes
+			"""
+		if task_limit is None:
+			task_limit = self.task_limit
+		with self.lock:
+			self.free_abandoned_slots()
+			free_slots = [slot for slot in range(self.max_slots) if not self.get(slot, self.in_use_field)]
+			if not free_slots:
+				raise Exception("Too many concurrent transfers; at most " + str(self.max_slots) + " are supported")
+			slot = free_slots[0]
+			self.set(slot, self.in_use_field, 1)
+			self.set(slot, self.process_id_field, os.getpid())
+			self.set(slot, self.target_hash_field, zlib.crc32(target_name) & 0xffffffff)
+			self.set(slot, self.target_limit_field, target_limit or 0)
+			self.set(slot, self.task_limit_field, task_limit or 0)
+			self.set(slot, self.demand_field, unlimited)
+		return BandwidthAllocation(self, slot, on_change)
+
+	def release(self, slot):
+		with self.lock:
+			self.set(slot, self.in_use_field, 0)
+
+	def free_abandoned_slots(self):
+		""" Free the slots of processes that have died in the middle of a transfer; must be called with the lock held """
+		for slot in range(self.max_slots):
+			if self.get(slot, self.in_use_field):
+				try:
+					os.kill(int(self.get(slot, self.process_id_field)), 0)
+				except OSError, e:
+					if e.errno == errno.ESRCH:
+						self.set(slot, self.in_use_field, 0)
+
+	def rebalance(self, slot, measured_rate, current_rate):
+		""" Record the throughput of a transfer, and return its allocation in bytes per second, or None for unlimited """
+		with self.lock:
+			# A transfer which uses clearly less than its allocation is held back by something else; it only
+			# demands twice what it uses, so that it can grow again, and leaves the rest to others
+			if current_rate is not None and measured_rate is not None and measured_rate < current_rate * 0.8:
+				self.set(slot, self.demand_field, max(measured_rate * self.demand_headroom, self.min_demand))
+			else:
+				self.set(slot, self.demand_field, unlimited)
+
+			slots = [s for s in range(self.max_slots) if self.get(s, self.in_use_field)]
+			demands = dict([(s, min(self.get(s, self.demand_field), self.get(s, self.task_limit_field) or unlimited)) for s in slots])
+
+		# Share each target's limit between the transfers to that target, and then the global limit between all
+		targets = {}
+		for s in slots:
+			targets.setdefault(self.get(s, self.target_hash_field), []).append(s)
+		for target_slots in targets.values():
+			target_limit = min([self.get(s, self.target_limit_field) or unlimited for s in target_slots])
+			if target_limit != unlimited:
+				for s, allocation in zip(target_slots, water_fill(target_limit, [demands[s] for s in target_slots])):
+					demands[s] = allocation
+		rate = dict(zip(slots, water_fill(self.global_limit or unlimited, [demands[s] for s in slots])))[slot]
+		return None if rate == unlimited else rate
+
+# The bandwidth manager that is shared by all worker processes
+bandwidth_manager = BandwidthManager()
+
+class BandwidthUnitTest(unittest.TestCase):
+
+	def test_water_fill(self):
+		self.assertEquals(water_fill(90, [unlimited, unlimited, unlimited]), [30, 30, 30])
+		self.assertEquals(water_fill(90, [10, unlimited, unlimited]), [10, 40, 40])
+		self.assertEquals(water_fill(unlimited, [10, unlimited]), [10, unlimited])
+
+	def test_allocations(self):
+
+		manager = BandwidthManager(max_slots=4, global_limit=100000)
+		changes = []
+		first = manager.allocate('target1', on_change=changes.append)
+		self.assertEquals(first.rate, 100000)
+
+		# The global limit should be shared between transfers, and per-target and per-task limits should hold
+		second = manager.allocate('target2', target_limit=20000)
+		third = manager.allocate('target3', task_limit=30000)
+		first.rebalance(time.time())
+		self.assertEquals(first.rate, 50000)
+		self.assertEquals(second.rate, 20000)
+		self.assertEquals(third.rate, 30000)
+		self.assertEquals(changes, [100000, 50000])
+
+		# Slots should be reused once transfers are released, and run out when there are too many transfers
+		third.release()
+		fourth = manager.allocate('target4')
+		fifth = manager.allocate('target5')
+		self.assertRaises(Exception, manager.allocate, 'target6')
+		for allocation in [first, second, fourth, fifth]:
+			allocation.release()
+
+		# Without limits, transfers should not be throttled
+		self.assertEquals(BandwidthManager().allocate('target1').rate, None)
+
+	def test_throttling(self):
+
+		manager = BandwidthManager(global_limit=400000)
+		manager.rebalance_interval_seconds = 0.1
+		start_time = time.time()
+		with manager.allocate('target1') as allocation:
+			for i in range(20):
+				allocation.consume(10000)
+		elapsed_time = time.time() - start_time
+		self.assertTrue(0.3 < elapsed_time < 1.0)
+
+	def test_redistribution(self):
+
+		# A transfer that only uses part of its share should leave the rest to other transfers
+		manager = BandwidthManager(global_limit=100000)
+		slow = manager.allocate('target1')
+		fast = manager.allocate('target2')
+		fast.rebalance(time.time())
+		self.assertEquals(fast.rate, 50000)
+		slow.last_rebalance_time = time.time() - 1
+		slow.consumed_size = 10000
+		slow.rebalance(time.time())
+		fast.rebalance(time.time())
+		self.assertAlmostEqual(fast.rate, 80000, delta=100)
+		slow.release()
+		fast.release()
+
+if __name__ == '__main__':
+	unittest.main()
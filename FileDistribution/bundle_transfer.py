@@ -0,0 +1,142 @@
+import hashlib
+import os
+import pipes
+import shutil
+import tarfile
+import time
+import unittest
+
+from ChunkStore import ChunkedFileReader
+
+class BundleFile(object):
+	""" One file of a bundle: where its contents are on this host, and the name that it gets on the target
+		Files that are held in the chunk store are read from there directly (see ChunkedFileReader)
+		"""
+
+	def __init__(self, file_id, source, filename, sha1sum, size, chunk_store_root_path=None):
+		self.file_id = file_id
+		self.source = source
+		self.filename = filename
+		self.sha1sum = sha1sum
+		self.size = size
+		self.chunk_store_root_path = chunk_store_root_path
+
+	def open(self, translate_path):
+		if self.chunk_store_root_path:
+			return ChunkedFileReader(self.chunk_store_root_path, self.sha1sum)
+		return open(translate_path(self.source), 'rb')
+
+class HashingReader(object):
+	""" Reads from a file, adding the data to a sha1 object and reporting its size on the way """
+
+	def __init__(self, input_file, sha1, progress=None):
+		self.input_file = input_file
+		self.sha1 = sha1
+		self.progress = progress
+
+	def read(self, size=-1):
+		data = self.input_file.read(size)
+		self.sha1.update(data)
+		if self.progress:
+			self.progress(len(data))
+		return data
+
+class ChannelWriter(object):
+	""" Lets tarfile write a stream to an SSH channel """
+
+	def __init__(self, channel):
+		self.channel = channel
+
+	def write(self, data):
+		self.channel.sendall(data)
+
+def write_bundle(output, files, translate_path, progress=None):
+	""" Write files to output as a tar stream; each file is stored under its index within the bundle
+		Returns the sha1sums of the data that was read for each file
+		"""
+	sha1sums = []
+	archive = tarfile.open(fileobj=output, mode='w|')
+	try:
+		for index, bundle_file in enumerate(files):
+			info = tarfile.TarInfo(str(index))
+			info.size = bundle_file.size
+			info.mode = 0644
+			info.mtime = int(time.time())
+			sha1 = hashlib.sha1()
+			input_file = bundle_file.open(translate_path)
+			try:
+				archive.addfile(info, HashingReader(input_file, sha1, progress))
+			finally:
+				input_file.close()
+			sha1sums.append(sha1.hexdigest())
+	finally:
+		archive.close()
+	return sha1sums
+
+def unpack_command(staging_directory, num_files):
+	""" A command which unpacks a bundle from its input into an empty staging directory, and prints the sha1sums
+		of the unpacked files in bundle order
+		"""
+	staging_directory = pipes.quote(staging_directory)
+	return ('rm -rf ' + staging_directory + ' && mkdir ' + staging_directory + ' && tar -xf - -C ' + staging_directory
+		+ ' && cd ' + staging_directory + ' && sha1sum -b ' + ' '.join([str(index) for index in range(num_files)]))
+
+def install_command(staging_directory, installed_files):
+	""" A command which moves unpacked files from the staging directory over their targets, removes the staging
+		directory, and prints the size and modification time of each installed file
+		installed_files is a list of (index within bundle, target filename)
+		"""
+	staging_directory = pipes.quote(staging_directory)
+	commands = ['mv -f ' + staging_directory + '/' + str(index) + ' ' + pipes.quote(filename) for index, filename in installed_files]
+	commands.append('rm -rf ' + staging_directory)
+	if installed_files:
+		commands.append('stat -c "%s %Y" ' + ' '.join([pipes.quote(filename) for index, filename in installed_files]))
+	return ' && '.join(commands)
+
+def parse_sha1sums(output):
+	return [line[:40] for line in output.splitlines()]
+
+def parse_stats(output):
+	return [tuple([int(value) for value in line.split()]) for line in output.splitlines()]
+
+class BundleTransferUnitTest(unittest.TestCase):
+
+	root_path = 'unittest'
+
+	def setUp(self):
+		os.mkdir(self.root_path)
+
+	def test_bundle(self):
+
+		contents = ['first file', '', 'third file' * 1000]
+		files = []
+		for index, file_contents in enumerate(contents):
+			source = os.path.join(self.root_path, 'source' + str(index))
+			with open(source, 'wb') as file:
+				file.write(file_contents)
+			files.append(BundleFile(str(index), source, 'file' + str(index), hashlib.sha1(file_contents).hexdigest(), len(file_contents)))
+
+		# The bundle should be a tar stream, with the files stored under their indices
+		progress = []
+		with open(os.path.join(self.root_path, 'bundle.tar'), 'wb') as output:
+			sha1sums = write_bundle(output, files, lambda path: path, progress.append)
+		self.assertEquals(sha1sums, [bundle_file.sha1sum for bundle_file in files])
+		self.assertEquals(sum(progress), sum([len(file_contents) for file_contents in contents]))
+		archive = tarfile.open(os.path.join(self.root_path, 'bundle.tar'))
+		self.assertEquals(archive.getnames(), ['0', '1', '2'])
+		self.assertEquals(archive.extractfile('2').read(), contents[2])
+
+		# Sources which are shorter than declared should fail the bundle
+		files[0].size += 1
+		with open(os.path.join(self.root_path, 'bundle.tar'), 'wb') as output:
+			self.assertRaises(IOError, write_bundle, output, files, lambda path: path)
+
+		self.assertEquals(parse_sha1sums('%s *0\n%s *1\n' % ('a' * 40, 'b' * 40)), ['a' * 40, 'b' * 40])
+		self.assertEquals(parse_stats('25 1000\n30 2000\n'), [(25, 1000), (30, 2000)])
+		self.assertEquals(install_command('stage', []), 'rm -rf stage')
+
+	def tearDown(self):
+		shutil.rmtree(self.root_path)
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,98 @@
+# Target-side helper for delta transfers
+#  This file is copied to targets and run there with whichever Python the target has, so it must work with
+#  both Python 2 and Python 3, and must not depend on anything beyond the standard library
+#
+#  python delta_helper.py signatures <file> <block_size>
+#      Prints the weak (adler32) and strong (md5) checksums of each whole block of the file, one block per line
+#
+#  python delta_helper.py apply <basis> <delta> <target> <sha1sum>
+#      Reconstructs a file from the basis file and a delta, checks its sha1sum, and atomically replaces the target
+#      with it; the delta is removed afterward
+
+import hashlib
+import os
+import struct
+import sys
+import zlib
+
+delta_header = b'SENDORDELTA1'
+copy_record = b'C'
+literal_record = b'L'
+copy_record_format = '>QI'
+literal_record_format = '>I'
+
+def weak_checksum(data):
+	return zlib.adler32(data) & 0xffffffff
+
+def strong_checksum(data):
+	return hashlib.md5(data).hexdigest()
+
+def signatures(filename, block_size):
+	with open(filename, 'rb') as file:
+		while True:
+			block = file.read(block_size)
+			if len(block) < block_size:
+				return
+			yield weak_checksum(block), strong_checksum(block)
+
+def read_exactly(file, size):
+	data = file.read(size)
+	if len(data) != size:
+		raise Exception("Delta is truncated")
+	return data
+
+def apply_delta(basis_filename, delta_filename, output_file):
+	with open(basis_filename, 'rb') as basis_file:
+		with open(delta_filename, 'rb') as delta_file:
+			if read_exactly(delta_file, len(delta_header)) != delta_header:
+				raise Exception("Not a delta: " + delta_filename)
+			block_size = struct.unpack('>I', read_exactly(delta_file, 4))[0]
+			while True:
+				record_type = delta_file.read(1)
+				if not record_type:
+					return
+				elif record_type == copy_record:
+					block_index, num_blocks = struct.unpack(copy_record_format, read_exactly(delta_file, struct.calcsize(copy_record_format)))
+					basis_file.seek(block_index * block_size)
+					for i in range(num_blocks):
+						output_file.write(read_exactly(basis_file, block_size))
+				elif record_type == literal_record:
+					length = struct.unpack(literal_record_format, read_exactly(delta_file, struct.calcsize(literal_record_format)))[0]
+					output_file.write(read_exactly(delta_file, length))
+				else:
+					raise Exception("Unknown delta record type")
+
+def reconstruct(basis_filename, delta_filename, target_filename, sha1sum):
+	temp_filename = target_filename + '.sendor-new'
+	try:
+		with open(temp_filename, 'wb') as output_file:
+			apply_delta(basis_filename, delta_filename, output_file)
+			output_file.flush()
+			os.fsync(output_file.fileno())
+
+		sha1 = hashlib.sha1()
+		with open(temp_filename, 'rb') as output_file:
+			for block in iter(lambda: output_file.read(1024 * 1024), b''):
+				sha1.update(block)
+		if sha1.hexdigest() != sha1sum:
+			raise Exception("Reconstructed file does not match sha1sum " + sha1sum)
+
+		if os.path.exists(basis_filename):
+			os.chmod(temp_filename, os.stat(basis_filename).st_mode & 0o7777)
+		os.rename(temp_filename, target_filename)
+	finally:
+		if os.path.exists(temp_filename):
+			os.remove(temp_filename)
+		os.remove(delta_filename)
+
+def main(args):
+	if args[0] == 'signatures':
+		for weak, strong in signatures(args[1], int(args[2])):
+			sys.stdout.write('%d %s\n' % (weak, strong))
+	elif args[0] == 'apply':
+		reconstruct(args[1], args[2], args[3], args[4])
+	else:
+		raise Exception("Unknown command " + args[0])
+
+if __name__ == '__main__':
+	main(sys.argv[1:])
@@ -0,0 +1,203 @@
+import hashlib
+import logging
+import os
+import random
+import shutil
+import struct
+import unittest
+import zlib
+
+import delta_helper
+
+logger = logging.getLogger('delta_transfer')
+
+helper_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'delta_helper.py')
+helper_sha1sums = []
+
+def helper_filename():
+	""" The name under which the helper is stored on targets; it is derived from the helper's contents, so
+		that targets never run a helper from another version
+		"""
+	if not helper_sha1sums:
+		with open(helper_path, 'rb') as helper_file:
+			helper_sha1sums.append(hashlib.sha1(helper_file.read()).hexdigest())
+	return '.sendor_delta_helper-' + helper_sha1sums[0][:16] + '.py'
+
+# adler32 works modulo this prime
+adler_modulus = 65521
+
+def parse_signatures(output):
+	""" Parse the output of the target-side helper's signatures command into a list of (weak, strong) checksums """
+	signatures = []
+	for line in output.splitlines():
+		weak, strong = line.split()
+		signatures.append((int(weak), strong))
+	return signatures
+
+class DeltaWriter(object):
+	""" Writes delta records to a file-like object; consecutive block copies are merged into a single record """
+
+	max_literal_size = 1024 * 1024
+
+	def __init__(self, output_file, block_size):
+		self.output_file = output_file
+		self.block_size = block_size
+		self.pending_copy = None
+		self.literal_bytes = 0
+		self.copied_bytes = 0
+		self.output_file.write(delta_helper.delta_header + struct.pack('>I', block_size))
+
+	def copy(self, block_index):
+		if self.pending_copy and self.pending_copy[0] + self.pending_copy[1] == block_index:
+			self.pending_copy[1] += 1
+		else:
+			self.flush()
+			self.pending_copy = [block_index, 1]
+		self.copied_bytes += self.block_size
+
+	def literal(self, data):
+		self.flush()
+		for offset in range(0, len(data), self.max_literal_size):
+			piece = data[offset:offset + self.max_literal_size]
+			self.output_file.write(delta_helper.literal_record + struct.pack(delta_helper.literal_record_format, len(piece)))
+			self.output_file.write(bytes(piece))
+		self.literal_bytes += len(data)
+
+	def flush(self):
+		if self.pending_copy:
+			self.output_file.write(delta_helper.copy_record + struct.pack(delta_helper.copy_record_format, self.pending_copy[0], self.pending_copy[1]))
+			self.pending_copy = None
+
+def compute_delta(source_filename, signatures, block_size, writer, progress=None):
+	""" Describe the source file as blocks of the basis file, whose signatures are given, and literal data
+
+		The weak checksum of a window is computed with zlib when the window starts after a match, and is
+		rolled forward one byte at a time through data that does not match; unchanged files are thus mostly
+		scanned at the speed of zlib and hashlib. Rolling is done in Python, though, so data that matches
+		nothing in the previous version is scanned far more slowly; files that have mostly changed are
+		better sent whole
+		progress is called with the number of bytes read from the source file, after each read
+		"""
+
+	blocks_by_weak_checksum = {}
+	for block_index, (weak, strong) in enumerate(signatures):
+		blocks_by_weak_checksum.setdefault(weak, {}).setdefault(strong, block_index)
+
+	read_size = max(block_size * 16, 1024 * 1024)
+	with open(source_filename, 'rb') as source_file:
+		window_buffer = bytearray()
+		position = 0
+		literal_start = 0
+		end_of_file = False
+		weak = None
+		while True:
+			# Keep at least one window plus one byte in the buffer; drop data that has already been written
+			if not end_of_file and len(window_buffer) - position < block_size + 1:
+				if position - literal_start >= writer.max_literal_size:
+					writer.literal(window_buffer[literal_start:position])
+					literal_start = position
+				del window_buffer[:literal_start]
+				position -= literal_start
+				literal_start = 0
+				data = source_file.read(read_size)
+				if data:
+					window_buffer.extend(data)
+					if progress:
+						progress(len(data))
+				else:
+					end_of_file = True
+
+			if len(window_buffer) - position < block_size:
+				break
+
+			if weak is None:
+				weak = zlib.adler32(bytes(window_buffer[position:position + block_size])) & 0xffffffff
+				a = weak & 0xffff
+				b = weak >> 16
+
+			candidates = blocks_by_weak_checksum.get(weak)
+			if candidates:
+				block_index = candidates.get(delta_helper.strong_checksum(bytes(window_buffer[position:position + block_size])))
+				if block_index is not None:
+					if position > literal_start:
+						writer.literal(window_buffer[literal_start:position])
+					writer.copy(block_index)
+					position += block_size
+					literal_start = position
+					weak = None
+					continue
+
+			if len(window_buffer) - position == block_size:
+				# The window has reached the end of the file
+				break
+
+			# Roll the window one byte forward
+			outgoing = window_buffer[position]
+			incoming = window_buffer[position + block_size]
+			a = (a - outgoing + incoming) % adler_modulus
+			b = (b - block_size * outgoing + a - 1) % adler_modulus
+			weak = (b << 16) | a
+			position += 1
+
+		if len(window_buffer) > literal_start:
+			writer.literal(window_buffer[literal_start:])
+		writer.flush()
+
+class DeltaTransferUnitTest(unittest.TestCase):
+
+	root_path = 'unittest'
+	block_size = 1024
+
+	def setUp(self):
+		os.mkdir(self.root_path)
+
+	def write(self, filename, data):
+		with open(os.path.join(self.root_path, filename), 'wb') as file:
+			file.write(data)
+
+	def transfer(self, basis, source):
+		""" Compute a delta between two contents and reconstruct the source from it, as a target would """
+		self.write('basis', basis)
+		self.write('source', source)
+		signatures = list(delta_helper.signatures(os.path.join(self.root_path, 'basis'), self.block_size))
+		output = ''.join(['%d %s\n' % signature for signature in signatures])
+		with open(os.path.join(self.root_path, 'delta'), 'wb') as delta_file:
+			writer = DeltaWriter(delta_file, self.block_size)
+			compute_delta(os.path.join(self.root_path, 'source'), parse_signatures(output), self.block_size, writer)
+		delta_helper.reconstruct(os.path.join(self.root_path, 'basis'), os.path.join(self.root_path, 'delta'), os.path.join(self.root_path, 'basis'), hashlib.sha1(source).hexdigest())
+		self.assertEquals(open(os.path.join(self.root_path, 'basis'), 'rb').read(), source)
+		self.assertFalse(os.path.exists(os.path.join(self.root_path, 'delta')))
+		return writer
+
+	def test_delta(self):
+
+		rng = random.Random(1)
+		basis = ''.join([chr(rng.randint(0, 255)) for i in range(100000)])
+
+		# An identical file should be sent as copies only, except for the basis' partial last block
+		writer = self.transfer(basis, basis)
+		self.assertEquals(writer.literal_bytes, len(basis) % self.block_size)
+
+		# Inserting, changing and removing data should only cost the affected blocks
+		modified = basis[:5000] + 'inserted data' + basis[5000:40000] + 'X' + basis[40001:70000] + basis[71000:]
+		writer = self.transfer(basis, modified)
+		self.assertTrue(writer.literal_bytes < 5 * self.block_size)
+
+		# Unrelated contents, and empty files, should still be reconstructed
+		self.transfer(basis, ''.join([chr(rng.randint(0, 255)) for i in range(5000)]))
+		self.transfer(basis, '')
+		self.transfer('', basis)
+
+		# A reconstruction that does not match the expected sha1sum should leave the target untouched
+		self.write('basis', basis)
+		with open(os.path.join(self.root_path, 'delta'), 'wb') as delta_file:
+			DeltaWriter(delta_file, self.block_size).literal('something else')
+		self.assertRaises(Exception, delta_helper.reconstruct, os.path.join(self.root_path, 'basis'), os.path.join(self.root_path, 'delta'), os.path.join(self.root_path, 'basis'), hashlib.sha1(basis).hexdigest())
+		self.assertEquals(open(os.path.join(self.root_path, 'basis'), 'rb').read(), basis)
+		self.assertEquals(sorted(os.listdir(self.root_path)), ['basis', 'source'])
+
+	def tearDown(self):
+		shutil.rmtree(self.root_path)
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,33 @@
+
+# An eviction policy ranks stashed files for eviction; files with lower keys are evicted first
+#  Files that were added less than the policy's grace period ago are not evicted at all
+
+eviction_policies = {}
+grace_periods = {}
+
+def register(eviction_policy_name, eviction_policy, grace_period_seconds=0):
+	eviction_policies[eviction_policy_name] = eviction_policy
+	grace_periods[eviction_policy_name] = grace_period_seconds
+
+def get(eviction_policy_name):
+	if not eviction_policy_name in eviction_policies:
+		raise Exception("Unknown eviction policy: " + eviction_policy_name)
+	return eviction_policies[eviction_policy_name]
+
+def grace_period(eviction_policy_name):
+	get(eviction_policy_name)
+	return grace_periods[eviction_policy_name]
+
+def least_recently_distributed(stashed_file):
+	return (stashed_file.last_distribution_time_microseconds, stashed_file.timestamp_microseconds)
+
+def least_frequently_distributed(stashed_file):
+	return (stashed_file.distribution_count, stashed_file.last_distribution_time_microseconds, stashed_file.timestamp_microseconds)
+
+def oldest_first(stashed_file):
+	return stashed_file.timestamp_microseconds
+
+register('lru', least_recently_distributed)
+# New files have not been distributed yet, so they would always be the first to go
+register('lfu', least_frequently_distributed, grace_period_seconds=3600)
+register('oldest', oldest_first)
@@ -0,0 +1,202 @@
+import ctypes
+import ctypes.util
+import errno
+import fcntl
+import hashlib
+import logging
+import os
+import shutil
+import unittest
+
+logger = logging.getLogger('local_copy')
+
+# ioctl request which makes a file share the extents of another file, on filesystems which support it (btrfs, xfs, ...)
+FICLONE = 0x40049409
+
+# Largest amount of data that is copied by each copy_file_range or sendfile call, between progress reports
+max_copy_size = 8 * 1024 * 1024
+buffer_size = 1024 * 1024
+
+# The ways to copy a file, in order of preference
+copy_methods = ['reflink', 'copy_file_range', 'sendfile', 'buffered']
+
+# Errors which mean that the filesystem, or the kernel, cannot copy the file in a particular way
+unsupported_errnos = set([errno.ENOSYS, errno.EXDEV, errno.EINVAL, errno.EOPNOTSUPP, errno.ENOTTY, errno.EBADF, errno.EPERM])
+
+libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+
+def libc_function(name, argtypes):
+	function = getattr(libc, name, None)
+	if function:
+		function.argtypes = argtypes
+		function.restype = ctypes.c_ssize_t
+	return function
+
+libc_copy_file_range = libc_function('copy_file_range', [ctypes.c_int, ctypes.c_void_p, ctypes.c_int, ctypes.c_void_p, ctypes.c_size_t, ctypes.c_uint])
+libc_sendfile = libc_function('sendfile', [ctypes.c_int, ctypes.c_int, ctypes.c_void_p, ctypes.c_size_t])
+
+class CopyMethodUnsupported(Exception):
+	pass
+
+def check_result(result):
+	if result < 0:
+		error = ctypes.get_errno()
+		if error in unsupported_errnos:
+			raise CopyMethodUnsupported(os.strerror(error))
+		raise OSError(error, os.strerror(error))
+	return result
+
+def copy_with_reflink(source_fd, target_fd, remaining):
+	try:
+		fcntl.ioctl(target_fd, FICLONE, source_fd)
+	except IOError, e:
+		if e.errno in unsupported_errnos:
+			raise CopyMethodUnsupported(e.strerror)
+		raise
+	yield remaining
+
+def copy_with_copy_file_range(source_fd, target_fd, remaining):
+	if not libc_copy_file_range:
+		raise CopyMethodUnsupported("copy_file_range is not available")
+	while remaining > 0:
+		copied = check_result(libc_copy_file_range(source_fd, None, target_fd, None, min(remaining, max_copy_size), 0))
+		if copied == 0:
+			break
+		remaining -= copied
+		yield copied
+
+def copy_with_sendfile(source_fd, target_fd, remaining):
+	if not libc_sendfile:
+		raise CopyMethodUnsupported("sendfile is not available")
+	while remaining > 0:
+		copied = check_result(libc_sendfile(target_fd, source_fd, None, min(remaining, max_copy_size)))
+		if copied == 0:
+			break
+		remaining -= copied
+		yield copied
+
+def copy_with_buffer(source_fd, target_fd, remaining):
+	while remaining > 0:
+		data = os.read(source_fd, min(remaining, buffer_size))
+		if not data:
+			break
+		written = 0
+		while written < len(data):
+			written += os.write(target_fd, data[written:])
+		remaining -= len(data)
+		yield len(data)
+
+copy_functions = { 'reflink' : copy_with_reflink,
+	'copy_file_range' : copy_with_copy_file_range,
+	'sendfile' : copy_with_sendfile,
+	'buffered' : copy_with_buffer }
+
+def copy_file(source, target, progress=None, methods=copy_methods, throttle=None):
+	""" Copy a file within the local machine, replacing any previous contents of the target
+		Each method is tried in turn until one is supported; the data is moved by the kernel, or shared between
+		the two files, whenever possible. A method that stops working partway through is continued by the next one
+		progress is called with the number of bytes copied, after each step
+		throttle is called like progress, but only for steps that moved data, and may hold the copy back;
+		cloning a file does not move any data
+		Returns the name of the method that completed the copy
+		"""
+	size = os.path.getsize(source)
+	source_fd = os.open(source, os.O_RDONLY)
+	try:
+		target_fd = os.open(target, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0666)
+		try:
+			copied = 0
+			for method in methods:
+				if method == 'reflink' and copied:
+					# Only whole files can be cloned
+					continue
+				os.lseek(source_fd, copied, os.SEEK_SET)
+				os.lseek(target_fd, copied, os.SEEK_SET)
+				try:
+					for step in copy_functions[method](source_fd, target_fd, size - copied):
+						copied += step
+						if progress:
+							progress(step)
+						if throttle and method != 'reflink':
+							throttle(step)
+				except CopyMethodUnsupported, e:
+					logger.debug("Cannot copy " + source + " with " + method + ": " + str(e))
+					continue
+				if copied != size:
+					raise Exception("Source file " + source + " ended before all data was copied")
+				return method
+			raise Exception("No copy method could copy " + source + " to " + target)
+		finally:
+			os.close(target_fd)
+	finally:
+		os.close(source_fd)
+
+def link_file(source, target):
+	""" Make target a hard link to source, replacing any previous target atomically
+		Returns False, without changing anything, if the two are on different filesystems
+		"""
+	temp_filename = target + '.sendor-new'
+	if os.path.lexists(temp_filename):
+		os.remove(temp_filename)
+	try:
+		os.link(source, temp_filename)
+	except OSError, e:
+		if e.errno in [errno.EXDEV, errno.EPERM, errno.EMLINK]:
+			return False
+		raise
+	os.rename(temp_filename, target)
+	return True
+
+def file_sha1sum(filename):
+	sha1 = hashlib.sha1()
+	with open(filename, 'rb') as input_file:
+		for block in iter(lambda: input_file.read(buffer_size), ''):
+			sha1.update(block)
+	return sha1.hexdigest()
+
+class LocalCopyUnitTest(unittest.TestCase):
+
+	root_path = 'unittest'
+	source_path = root_path + '/source'
+	target_path = root_path + '/target'
+
+	def setUp(self):
+		os.mkdir(self.root_path)
+		self.file_contents = os.urandom(3 * buffer_size + 1000)
+		with open(self.source_path, 'wb') as file:
+			file.write(self.file_contents)
+
+	def test_copy_file(self):
+
+		# Every method should either copy the whole file, or leave the copy to the next method
+		for method in copy_methods:
+			with open(self.target_path, 'wb') as file:
+				file.write('previous contents which are longer than nothing')
+			progress = []
+			throttled = []
+			used_method = copy_file(self.source_path, self.target_path, progress.append, [method, 'buffered'], throttled.append)
+			self.assertTrue(used_method in [method, 'buffered'])
+			self.assertEquals(open(self.target_path, 'rb').read(), self.file_contents)
+			self.assertEquals(sum(progress), len(self.file_contents))
+			self.assertEquals(sum(throttled), 0 if used_method == 'reflink' else len(self.file_contents))
+
+		self.assertRaises(Exception, copy_file, self.source_path, self.target_path, None, [])
+
+		# Empty files should be copied too
+		open(self.source_path, 'wb').close()
+		copy_file(self.source_path, self.target_path)
+		self.assertEquals(os.path.getsize(self.target_path), 0)
+
+	def test_link_file(self):
+
+		with open(self.target_path, 'wb') as file:
+			file.write('previous contents')
+		self.assertTrue(link_file(self.source_path, self.target_path))
+		self.assertTrue(os.path.samefile(self.source_path, self.target_path))
+		self.assertEquals(file_sha1sum(self.target_path), hashlib.sha1(self.file_contents).hexdigest())
+
+	def tearDown(self):
+		shutil.rmtree(self.root_path)
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,287 @@
+import collections
+import errno
+import hashlib
+import json
+import logging
+import os
+import os.path
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+from target_inventory import target_key
+
+logger = logging.getLogger('parallel_transfer')
+
+class ChunkClaim(object):
+	""" A run of consecutive chunks which one stream has taken on; other streams may steal its tail """
+
+	def __init__(self, indices):
+		self.indices = collections.deque(indices)
+
+class ParallelTransferScheduler(object):
+	""" Sends the chunks of a file over a varying number of concurrent streams
+
+		Streams claim runs of consecutive pending chunks, sized so that each claim takes about claim_seconds at
+		the measured per-stream throughput; once nothing is left to claim, an idle stream steals the second half
+		of the largest claim that another stream is still working on.
+		Every tuning_interval_seconds, the aggregate throughput is measured, and the number of streams is climbed
+		one at a time, for as long as each added stream improves throughput by at least min_improvement; a stream
+		that does not help is removed again, and the stream count is left alone from then on.
+
+		send_chunk(index, progress) sends one chunk, and calls progress with the number of bytes sent. Each stream
+		counts its bytes on its own, without locking, and the counts are only added up once per interval, when
+		report_progress (if given) is called with the total number of bytes sent so far
+		"""
+
+	tuning_interval_seconds = 1.0
+	claim_seconds = 2.0
+	min_improvement = 1.1
+
+	def __init__(self, chunks, pending_indices, send_chunk, initial_streams, max_streams, initial_claim_size, report_progress=None):
+		self.chunks = chunks
+		self.pending = collections.deque(sorted(pending_indices))
+		self.send_chunk = send_chunk
+		self.report_progress = report_progress
+		self.max_streams = max(1, max_streams)
+		self.desired_streams = max(1, min(initial_streams, self.max_streams))
+		self.claim_size = max(1, initial_claim_size)
+
+		self.lock = threading.Lock()
+		self.claims = []
+		self.threads = []
+		self.active_streams = 0
+		self.errors = []
+		# Bytes sent by each stream; every stream only writes its own count
+		self.stream_sizes = []
+		self.best_streams = self.desired_streams
+		self.best_throughput = None
+		self.num_measurements = 0
+		self.stolen_claims = 0
+
+	def claim_chunks(self):
+		""" Take on the next run of pending chunks, or steal from another stream; must be called with the lock held """
+		if self.pending:
+			indices = [self.pending.popleft()]
+			size = self.chunks[indices[0]][1]
+			while self.pending and self.pending[0] == indices[-1] + 1 and size + self.chunks[self.pending[0]][1] <= self.claim_size:
+				indices.append(self.pending.popleft())
+				size += self.chunks[indices[-1]][1]
+			claim = ChunkClaim(indices)
+		else:
+			victims = [claim for claim in self.claims if len(claim.indices) > 1]
+			if not victims:
+				return None
+			victim = max(victims, key=lambda claim: sum([self.chunks[index][1] for index in claim.indices]))
+			num_stolen = len(victim.indices) // 2
+			stolen = [victim.indices.pop() for i in range(num_stolen)]
+			claim = ChunkClaim(reversed(stolen))
+			self.stolen_claims += 1
+		self.claims.append(claim)
+		return claim
+
+	def transferred_size(self):
+		return sum(self.stream_sizes)
+
+	def stream(self, stream_index):
+		stream_sizes = self.stream_sizes
+
+		def progress(size):
+			stream_sizes[stream_index] += size
+
+		try:
+			while True:
+				with self.lock:
+					# Surplus streams leave one at a time, each accounting for itself before the next one checks
+					claim = None
+					if not self.errors and self.active_streams <= self.desired_streams:
+						claim = self.claim_chunks()
+					if not claim:
+						self.active_streams -= 1
+						return
+				while True:
+					with self.lock:
+						if self.errors or not claim.indices:
+							self.claims.remove(claim)
+							break
+						index = claim.indices.popleft()
+					self.send_chunk(index, progress)
+		except Exception, e:
+			logger.exception("Stream " + str(stream_index) + " failed")
+			with self.lock:
+				self.errors.append(e)
+				self.active_streams -= 1
+
+	def start_streams(self):
+		with self.lock:
+			num_new_streams = self.desired_streams - self.active_streams if (self.pending and not self.errors) else 0
+			self.active_streams += max(num_new_streams, 0)
+		for i in range(num_new_streams):
+			self.stream_sizes.append(0)
+			thread = threading.Thread(target=self.stream, args=(len(self.threads),))
+			thread.daemon = True
+			self.threads.append(thread)
+			thread.start()
+
+	def tune(self, throughput, streams):
+		""" Adjust the number of streams and the claim size after a measurement over a whole interval """
+		self.num_measurements += 1
+		if self.best_throughput is None or throughput > self.best_throughput * self.min_improvement:
+			self.best_throughput = throughput
+			self.best_streams = streams
+			if streams < self.max_streams:
+				self.desired_streams = streams + 1
+		elif streams > self.best_streams:
+			# The last stream did not help; go back to the best number of streams and stay there
+			self.desired_streams = self.best_streams
+			self.max_streams = self.best_streams
+		self.claim_size = max(self.claim_size // 4, int(throughput / max(streams, 1) * self.claim_seconds), 1)
+
+	def run(self):
+		""" Send all pending chunks, and return the best number of streams, the claim size and the best throughput
+			Raises the first error of any stream, once all streams have stopped
+			"""
+		self.start_streams()
+		last_time = time.time()
+		last_size = 0
+		measured_streams = self.desired_streams
+		while True:
+			for thread in self.threads:
+				thread.join(max(0, last_time + self.tuning_interval_seconds - time.time()))
+			if not any([thread.is_alive() for thread in self.threads]):
+				break
+			now = time.time()
+			size = self.transferred_size()
+			if self.report_progress:
+				self.report_progress(size)
+			with self.lock:
+				# Only measure intervals throughout which the same number of streams had work to do
+				if self.active_streams == measured_streams and self.pending:
+					self.tune((size - last_size) / (now - last_time), measured_streams)
+				measured_streams = self.desired_streams
+			last_time = now
+			last_size = size
+			self.start_streams()
+
+		if self.errors:
+			raise self.errors[0]
+		return self.best_streams, self.claim_size, self.best_throughput
+
+class TransferTuning(object):
+	""" Remembers, per target, the number of streams and the claim size that gave the best throughput
+		The settings are kept as one file per target below root_path, so that all worker processes share them;
+		without a root path, nothing is remembered
+		"""
+
+	def __init__(self, root_path=None):
+		self.root_path = root_path
+
+	def settings_path(self, target):
+		if not self.root_path:
+			return None
+		return os.path.join(self.root_path, hashlib.sha1(target_key(target)).hexdigest() + '.json')
+
+	def get(self, target):
+		path = self.settings_path(target)
+		if not path:
+			return None
+		try:
+			with open(path) as settings_file:
+				return json.load(settings_file)
+		except IOError:
+			return None
+		except ValueError:
+			logger.warning("Ignoring unreadable transfer tuning " + path)
+			return None
+
+	def record(self, target, streams, claim_size, throughput):
+		path = self.settings_path(target)
+		if not path:
+			return
+		try:
+			os.makedirs(self.root_path)
+		except OSError, e:
+			if e.errno != errno.EEXIST:
+				raise
+		temp_file_handle, temp_filename = tempfile.mkstemp(dir=self.root_path)
+		with os.fdopen(temp_file_handle, 'w') as temp_file:
+			json.dump({ 'target' : target_key(target), 'streams' : streams, 'claim_size' : claim_size, 'throughput' : throughput }, temp_file)
+		os.rename(temp_filename, path)
+
+# The tuning that is used by all actions within a process
+transfer_tuning = TransferTuning()
+
+class ParallelTransferUnitTest(unittest.TestCase):
+
+	root_path = 'unittest'
+
+	def setUp(self):
+		os.mkdir(self.root_path)
+
+	def create_scheduler(self, num_chunks, chunk_size, stream_bandwidth, initial_streams, max_streams, fail_at=None):
+		""" Create a scheduler whose streams each send stream_bandwidth bytes per second, regardless of their number """
+		self.sent = []
+		sent_lock = threading.Lock()
+
+		def send_chunk(index, progress):
+			if index == fail_at:
+				raise Exception("Simulated failure")
+			time.sleep(float(chunk_size) / stream_bandwidth)
+			progress(chunk_size)
+			with sent_lock:
+				self.sent.append(index)
+
+		chunks = [(i * chunk_size, chunk_size) for i in range(num_chunks)]
+		self.reported_sizes = []
+		scheduler = ParallelTransferScheduler(chunks, range(num_chunks), send_chunk, initial_streams, max_streams, chunk_size * 4, self.reported_sizes.append)
+		scheduler.tuning_interval_seconds = 0.05
+		scheduler.claim_seconds = 0.05
+		return scheduler
+
+	def test_scheduler(self):
+
+		# Streams should be added while they increase throughput, and every chunk should be sent exactly once
+		scheduler = self.create_scheduler(200, 1000, 100000, 1, 4)
+		best_streams, claim_size, throughput = scheduler.run()
+		self.assertEquals(sorted(self.sent), range(200))
+		self.assertEquals(best_streams, 4)
+		self.assertTrue(claim_size >= 1000)
+
+		# The bytes counted by each stream should add up, and progress should be reported along the way
+		self.assertEquals(scheduler.transferred_size(), 200 * 1000)
+		self.assertTrue(self.reported_sizes and self.reported_sizes == sorted(self.reported_sizes))
+
+		# Once nothing is left to claim, an idle stream should steal the tail of the largest claim
+		scheduler = self.create_scheduler(10, 1000, 100000, 1, 1)
+		scheduler.pending.clear()
+		small_claim = ChunkClaim([0, 1])
+		large_claim = ChunkClaim([2, 3, 4, 5, 6])
+		scheduler.claims = [small_claim, large_claim]
+		stolen_claim = scheduler.claim_chunks()
+		self.assertEquals(list(stolen_claim.indices), [5, 6])
+		self.assertEquals(list(large_claim.indices), [2, 3, 4])
+		self.assertEquals(scheduler.stolen_claims, 1)
+		scheduler.claims = [ChunkClaim([7])]
+		self.assertEquals(scheduler.claim_chunks(), None)
+
+		# A failing chunk should stop all streams, and be reported
+		scheduler = self.create_scheduler(50, 1000, 100000, 2, 2, fail_at=10)
+		self.assertRaises(Exception, scheduler.run)
+		self.assertTrue(10 not in self.sent)
+
+	def test_tuning(self):
+
+		target = { 'user' : 'user', 'host' : 'host', 'port' : '22' }
+		transfer_tuning = TransferTuning(self.root_path + '/tuning')
+		self.assertEquals(transfer_tuning.get(target), None)
+		transfer_tuning.record(target, 3, 1024, 100.0)
+		self.assertEquals(transfer_tuning.get(target)['streams'], 3)
+		self.assertEquals(TransferTuning().get(target), None)
+
+	def tearDown(self):
+		shutil.rmtree(self.root_path)
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,133 @@
+import Queue
+import hashlib
+import logging
+import threading
+import unittest
+
+logger = logging.getLogger('range_verification')
+
+def plan_ranges(size, range_size):
+	""" Split a file into (offset, length) ranges of at most range_size bytes; an empty file has one empty range """
+	range_size = max(1, range_size)
+	return [(offset, min(range_size, size - offset)) for offset in range(0, size, range_size)] or [(0, 0)]
+
+def combined_sha1sum(range_sha1sums):
+	""" Derive a hash of a whole file from the sha1sums of its consecutive ranges """
+	return hashlib.sha1(''.join(range_sha1sums)).hexdigest()
+
+class RangeVerifier(object):
+	""" Checks ranges of a file on a target against the sha1sums of the data that was sent, while the transfer goes on
+		Ranges are added as soon as they have been written; a thread computes the sha1sums of all ranges that
+		are waiting on the target, with one remote call, and compares them. remote_range_sha1sums(ranges) returns
+		the target's sha1sums of a list of (offset, length) ranges
+		"""
+
+	max_ranges_per_call = 64
+
+	def __init__(self, remote_range_sha1sums):
+		self.remote_range_sha1sums = remote_range_sha1sums
+		self.queue = Queue.Queue()
+		self.local_sha1sums = {}
+		self.remote_sha1sums = {}
+		self.lock = threading.Lock()
+		self.thread = threading.Thread(target=self.verify_thread)
+		self.thread.daemon = True
+		self.thread.start()
+
+	def add(self, offset, length, sha1sum):
+		with self.lock:
+			self.local_sha1sums[(offset, length)] = sha1sum
+		self.queue.put((offset, length))
+
+	def verify_thread(self):
+		while True:
+			ranges = [self.queue.get()]
+			while len(ranges) < self.max_ranges_per_call:
+				try:
+					ranges.append(self.queue.get_nowait())
+				except Queue.Empty:
+					break
+			finish = None in ranges
+			ranges = [file_range for file_range in ranges if file_range is not None]
+			if ranges:
+				self.verify(ranges)
+			if finish:
+				return
+
+	def verify(self, ranges):
+		try:
+			sha1sums = self.remote_range_sha1sums(ranges)
+		except Exception:
+			# Ranges that could not be checked count as failed, and are sent again
+			logger.exception("Verification of " + str(len(ranges)) + " ranges failed")
+			sha1sums = [None] * len(ranges)
+		with self.lock:
+			for file_range, sha1sum in zip(ranges, sha1sums):
+				self.remote_sha1sums[file_range] = sha1sum
+
+	def finish(self):
+		""" Wait for all added ranges to be checked, and return the ranges whose contents on the target differ """
+		self.queue.put(None)
+		self.thread.join()
+		with self.lock:
+			return sorted([file_range for file_range, sha1sum in self.local_sha1sums.items() if self.remote_sha1sums.get(file_range) != sha1sum])
+
+	def check(self, ranges, sha1sums=None):
+		""" Check ranges right away, and return the ranges whose contents on the target differ
+			Without sha1sums, the ranges are compared with the sha1sums that they were added with
+			"""
+		if sha1sums is not None:
+			with self.lock:
+				self.local_sha1sums.update(zip(ranges, sha1sums))
+		self.verify(ranges)
+		with self.lock:
+			return [file_range for file_range in ranges if self.remote_sha1sums.get(file_range) != self.local_sha1sums[file_range]]
+
+	def remote_file_sha1sum(self):
+		""" Return the hash of the whole file on the target, derived from the checked ranges """
+		with self.lock:
+			return combined_sha1sum([self.remote_sha1sums[file_range] or '' for file_range in sorted(self.remote_sha1sums.keys())])
+
+	def local_file_sha1sum(self):
+		with self.lock:
+			return combined_sha1sum([self.local_sha1sums[file_range] for file_range in sorted(self.local_sha1sums.keys())])
+
+class RangeVerificationUnitTest(unittest.TestCase):
+
+	def test_plan_ranges(self):
+		self.assertEquals(plan_ranges(10, 4), [(0, 4), (4, 4), (8, 2)])
+		self.assertEquals(plan_ranges(8, 4), [(0, 4), (4, 4)])
+		self.assertEquals(plan_ranges(0, 4), [(0, 0)])
+
+	def test_verifier(self):
+
+		remote_contents = ['0123456789abcdef']
+		calls = []
+
+		def remote_range_sha1sums(ranges):
+			calls.append(ranges)
+			return [hashlib.sha1(remote_contents[0][offset:offset + length]).hexdigest() for offset, length in ranges]
+
+		local_contents = '0123456789abcdeF'
+		verifier = RangeVerifier(remote_range_sha1sums)
+		for offset, length in plan_ranges(len(local_contents), 4):
+			verifier.add(offset, length, hashlib.sha1(local_contents[offset:offset + length]).hexdigest())
+
+		# Only the range that differs should fail, and be accepted once it has been sent again
+		self.assertEquals(verifier.finish(), [(12, 4)])
+		self.assertNotEquals(verifier.remote_file_sha1sum(), verifier.local_file_sha1sum())
+		remote_contents[0] = local_contents
+		self.assertEquals(verifier.check([(12, 4)]), [])
+		self.assertEquals(verifier.remote_file_sha1sum(), verifier.local_file_sha1sum())
+		self.assertTrue(sum([len(ranges) for ranges in calls]) == 5)
+
+		# Ranges which cannot be checked should count as failed
+		def fail(ranges):
+			raise Exception("Simulated failure")
+		verifier = RangeVerifier(fail)
+		verifier.add(0, 4, hashlib.sha1('0123').hexdigest())
+		self.assertEquals(verifier.finish(), [(0, 4)])
+		self.assertEquals(verifier.check([(4, 4)], [hashlib.sha1('4567').hexdigest()]), [(4, 4)])
+
+if __name__ == '__main__':
+	unittest.main()
@@ -1,28 +1,41 @@
 
+import datetime
+import hashlib
 import json
 import logging
 import os
 import shutil
+import time
 import unittest
 
-from flask import Flask, Blueprint, Response, jsonify
+from flask import Flask, Blueprint, Response, jsonify, request, url_for
+from werkzeug import secure_filename
 
 from SendorTask import SendorTask
 
 from SendorQueue import SendorQueue
 from Targets import Targets
 from FileStash import FileStash
+from actions import ReassembleChunkedFileAction
+from bundle_transfer import BundleFile
+from ssh_connection_pool import connection_pool
+from target_inventory import target_inventory
 
 logger = logging.getLogger('main.api')
 
+upload_block_size = 1024 * 1024
+
 class DistributeFileTask(SendorTask):
 
+	__slots__ = ('file_stash', 'source', 'target', 'stashed_file')
+
 	def __init__(self, file_stash, source, target, stashed_file_id):
 		super(DistributeFileTask, self).__init__()
 		self.file_stash = file_stash
 		self.source = source
 		self.target = target
 		self.stashed_file = self.file_stash.lock(stashed_file_id)
+		self.file_stash.record_distribution(self.stashed_file)
 
 	def string_description(self):
 		return "Distribute file " + self.source + " to " + self.target
@@ -39,6 +52,71 @@ class DistributeFileTask(SendorTask):
 		super(DistributeFileTask, self).canceled()
 		self.file_stash.unlock(self.stashed_file)
 
+class FanOutDistributeFileTask(DistributeFileTask):
+
+	__slots__ = ('target_ids', 'target_progress')
+
+	def __init__(self, file_stash, source, target_ids, stashed_file_id):
+		super(FanOutDistributeFileTask, self).__init__(file_stash, source, ', '.join(target_ids), stashed_file_id)
+		self.target_ids = target_ids
+		self.target_progress = dict([(target_id, { 'state' : 'not_started', 'completion_ratio' : 0 }) for target_id in target_ids])
+
+	def set_target_progress(self, target_id, state, completion_ratio):
+		self.target_progress[target_id] = { 'state' : state, 'completion_ratio' : completion_ratio }
+
+	def progress(self):
+		status = super(FanOutDistributeFileTask, self).progress()
+		status['targets'] = self.target_progress
+		return status
+
+class DistributeBundleTask(SendorTask):
+
+	__slots__ = ('file_stash', 'target', 'stashed_files', 'file_progress')
+
+	def __init__(self, file_stash, target, stashed_file_ids):
+		super(DistributeBundleTask, self).__init__()
+		self.file_stash = file_stash
+		self.target = target
+		self.stashed_files = self.file_stash.lock_many(stashed_file_ids)
+		for stashed_file in self.stashed_files:
+			self.file_stash.record_distribution(stashed_file)
+		self.file_progress = dict([(stashed_file.file_id, { 'filename' : stashed_file.original_filename, 'state' : 'not_started', 'completion_ratio' : 0 }) for stashed_file in self.stashed_files])
+
+	def string_description(self):
+		return "Distribute bundle of " + str(len(self.stashed_files)) + " files to " + self.target
+
+	def bundle_files(self):
+		""" Describe the locked files for BundleDistributionAction; chunked files are read from the chunk store """
+		files = []
+		for stashed_file in self.stashed_files:
+			chunk_store_root_path = self.file_stash.root_path if stashed_file.is_chunked else None
+			source = None if chunk_store_root_path else stashed_file.full_path_filename
+			files.append(BundleFile(stashed_file.file_id, source, stashed_file.original_filename, stashed_file.physical_file.sha1sum, stashed_file.size, chunk_store_root_path))
+		return files
+
+	def set_file_progress(self, file_id, state, completion_ratio):
+		self.file_progress[file_id] = dict(self.file_progress[file_id], state=state, completion_ratio=completion_ratio)
+
+	def progress(self):
+		status = super(DistributeBundleTask, self).progress()
+		status['files'] = self.file_progress
+		return status
+
+	def unlock_files(self):
+		self.file_stash.unlock_many(self.stashed_files)
+
+	def completed(self):
+		super(DistributeBundleTask, self).completed()
+		self.unlock_files()
+
+	def failed(self):
+		super(DistributeBundleTask, self).failed()
+		self.unlock_files()
+
+	def canceled(self):
+		super(DistributeBundleTask, self).canceled()
+		self.unlock_files()
+
 def create_rest_api(sendor_queue, targets, file_stash):
 
 	api_app = Blueprint('api', __name__)
@@ -83,12 +161,92 @@ def create_rest_api(sendor_queue, targets, file_stash):
 		targets_contents = [{ 'target_id' : target_id, 'name' : target_details['name'] } for (target_id, target_details) in target_list.iteritems()]
 		return jsonify(collection=targets_contents)
 
+	@api_app.route('/connection_pool', methods = ['GET'])
+	def connection_pool_get():
+		return jsonify(connection_pool.get_statistics())
+
+	@api_app.route('/target_inventory', methods = ['GET'])
+	def target_inventory_get():
+		target_id = request.args.get('target_id')
+		if target_id is None:
+			entries = target_inventory.list()
+		elif target_id in targets.get_targets():
+			target = targets.get_targets()[target_id]
+			# Only targets which are reached over SSH are kept in the inventory
+			entries = target_inventory.list(target) if 'host' in target else []
+		else:
+			response = jsonify({'message' : "Unknown target " + target_id})
+			response.status_code = 404
+			return response
+		return jsonify(collection=[entry.to_json() for entry in entries])
+
 	@api_app.route('/file_stash', methods = ['GET'])
 	def file_stash_get():
-		sorted_file_stash = sorted(file_stash.list(), cmp = lambda x, y: cmp(x.timestamp, y.timestamp))
-		file_stash_contents = [file.to_json() for file in sorted_file_stash]
+		file_stash_contents = [file.to_json() for file in file_stash.list_sorted()]
 		return jsonify(collection=file_stash_contents)
 
+	@api_app.route('/file_stash', methods = ['DELETE'])
+	def file_stash_delete_many():
+		request_json = request.get_json(force=True, silent=True)
+		if not request_json or not 'file_ids' in request_json:
+			response = jsonify({'message' : "Request body should be a JSON object with a 'file_ids' list"})
+			response.status_code = 400
+			return response
+
+		removed_files, failures = file_stash.remove_many(request_json['file_ids'])
+		return jsonify(removed=[file.file_id for file in removed_files],
+			failed=dict((id, failure.message) for (id, failure) in failures.iteritems()))
+
+	@api_app.route('/file_stash/negotiate', methods = ['POST'])
+	def file_stash_negotiate():
+		request_json = request.get_json(force=True, silent=True)
+		if not request_json or not all(key in request_json for key in ['filename', 'size', 'sha1sum']):
+			response = jsonify({'message' : "Request body should be a JSON object with 'filename', 'size' and 'sha1sum' elements"})
+			response.status_code = 400
+			return response
+
+		filename = secure_filename(request_json['filename'])
+		size = int(request_json['size'])
+		sha1sum = request_json['sha1sum'].lower()
+
+		# If the stash already holds the contents, the file is added right away, without any transfer
+		stashed_file = file_stash.add_if_content_stashed(filename, sha1sum, size, datetime.datetime.utcnow())
+		if stashed_file:
+			return jsonify(upload_required=False, file=stashed_file.to_json())
+		else:
+			return jsonify(upload_required=True, upload_url=url_for('.file_stash_upload', filename=filename, sha1sum=sha1sum))
+
+	@api_app.route('/file_stash/upload/<filename>', methods = ['PUT'])
+	def file_stash_upload(filename):
+		ingest = file_stash.begin_ingest()
+		try:
+			while True:
+				data = request.stream.read(upload_block_size)
+				if not data:
+					break
+				ingest.write(data)
+			ingest.close()
+
+			expected_sha1sum = request.args.get('sha1sum')
+			if expected_sha1sum and expected_sha1sum != ingest.sha1sum():
+				ingest.abort()
+				response = jsonify({'message' : "Uploaded contents do not match SHA1 " + expected_sha1sum})
+				response.status_code = 400
+				return response
+
+			stashed_file = ingest.commit(secure_filename(filename), datetime.datetime.utcnow())
+		except:
+			ingest.abort()
+			raise
+
+		response = jsonify(file=stashed_file.to_json())
+		response.status_code = 201
+		return response
+
+	@api_app.route('/file_stash/reconciliation', methods = ['GET'])
+	def file_stash_reconciliation_get():
+		return jsonify(file_stash.get_reconciliation_progress())
+
 	@api_app.route('/file_stash/<file_id>', methods = ['DELETE'])
 	def file_stash_delete(file_id):
 		try:
@@ -103,8 +261,24 @@ def create_rest_api(sendor_queue, targets, file_stash):
 			response.status_code = 403
 			return response
 	
+	def invalid_max_bandwidth_response(max_bandwidth):
+		""" Return an error response unless max_bandwidth is missing or a positive number of bytes per second """
+		try:
+			if max_bandwidth is None or int(max_bandwidth) > 0:
+				return None
+		except (TypeError, ValueError):
+			pass
+		response = jsonify({'message' : "max_bandwidth should be a positive number of bytes per second"})
+		response.status_code = 400
+		return response
+
 	@api_app.route('/file_stash/<file_id>/distribute/<target_id>', methods = ['POST'])
 	def file_stash_distribute(file_id, target_id):
+		max_bandwidth = request.args.get('max_bandwidth')
+		error_response = invalid_max_bandwidth_response(max_bandwidth)
+		if error_response:
+			return error_response
+
 		try:
 			stashed_file = file_stash.lock(file_id)
 		except FileStash.FileDoesNotExistError, e:
@@ -114,7 +288,15 @@ def create_rest_api(sendor_queue, targets, file_stash):
 
 		try:
 			distribute_file_task = DistributeFileTask(file_stash, stashed_file.original_filename, target_id, file_id)
-			distribute_file_actions = targets.create_distribution_actions(stashed_file.full_path_filename, stashed_file.original_filename, stashed_file.physical_file.sha1sum, stashed_file.size, target_id)
+			if max_bandwidth:
+				distribute_file_task.max_bandwidth = int(max_bandwidth)
+			if stashed_file.is_chunked:
+				# Files in the chunk store are reassembled into the task's work directory before distribution
+				source = os.path.join('{task_work_directory}', stashed_file.physical_file.sha1sum)
+				distribute_file_task.actions.append(ReassembleChunkedFileAction(file_stash.root_path, stashed_file.physical_file.sha1sum, stashed_file.size, source))
+			else:
+				source = stashed_file.full_path_filename
+			distribute_file_actions = targets.create_distribution_actions(source, stashed_file.original_filename, stashed_file.physical_file.sha1sum, stashed_file.size, target_id)
 			distribute_file_task.actions.extend(distribute_file_actions)
 			sendor_queue.add(distribute_file_task)
 		except:
@@ -124,6 +306,98 @@ def create_rest_api(sendor_queue, targets, file_stash):
 		file_stash.unlock(stashed_file)
 		return jsonify({})
 
+	@api_app.route('/file_stash/<file_id>/distribute', methods = ['POST'])
+	def file_stash_distribute_many(file_id):
+		request_json = request.get_json(force=True, silent=True)
+		if not request_json or not isinstance(request_json.get('target_ids'), list) or not request_json['target_ids']:
+			response = jsonify({'message' : "Request body should be a JSON object with a non-empty 'target_ids' list, and optionally 'relay' and 'max_bandwidth'"})
+			response.status_code = 400
+			return response
+
+		error_response = invalid_max_bandwidth_response(request_json.get('max_bandwidth'))
+		if error_response:
+			return error_response
+
+		target_ids = request_json['target_ids']
+		unknown_target_ids = [target_id for target_id in target_ids if target_id not in targets.get_targets()]
+		if unknown_target_ids:
+			response = jsonify({'message' : "Unknown targets: " + ', '.join(unknown_target_ids)})
+			response.status_code = 404
+			return response
+
+		try:
+			stashed_file = file_stash.lock(file_id)
+		except FileStash.FileDoesNotExistError, e:
+			response = jsonify({'message' : e.message})
+			response.status_code = 404
+			return response
+
+		try:
+			distribute_file_task = FanOutDistributeFileTask(file_stash, stashed_file.original_filename, target_ids, file_id)
+			if request_json.get('max_bandwidth'):
+				distribute_file_task.max_bandwidth = int(request_json['max_bandwidth'])
+			if stashed_file.is_chunked:
+				source = os.path.join('{task_work_directory}', stashed_file.physical_file.sha1sum)
+				distribute_file_task.actions.append(ReassembleChunkedFileAction(file_stash.root_path, stashed_file.physical_file.sha1sum, stashed_file.size, source))
+			else:
+				source = stashed_file.full_path_filename
+			distribute_file_actions = targets.create_fan_out_distribution_actions(source, stashed_file.original_filename, stashed_file.physical_file.sha1sum, stashed_file.size, target_ids, bool(request_json.get('relay')))
+			distribute_file_task.actions.extend(distribute_file_actions)
+			sendor_queue.add(distribute_file_task)
+		except:
+			file_stash.unlock(stashed_file)
+			raise
+
+		file_stash.unlock(stashed_file)
+		return jsonify(task_id=distribute_file_task.task_id)
+
+	@api_app.route('/file_stash/bundle/distribute', methods = ['POST'])
+	def file_stash_distribute_bundle():
+		request_json = request.get_json(force=True, silent=True)
+		if not request_json or not all(isinstance(request_json.get(key), list) and request_json[key] for key in ['file_ids', 'target_ids']):
+			response = jsonify({'message' : "Request body should be a JSON object with non-empty 'file_ids' and 'target_ids' lists, and optionally 'max_bandwidth'"})
+			response.status_code = 400
+			return response
+
+		error_response = invalid_max_bandwidth_response(request_json.get('max_bandwidth'))
+		if error_response:
+			return error_response
+
+		target_ids = request_json['target_ids']
+		unknown_target_ids = [target_id for target_id in target_ids if target_id not in targets.get_targets()]
+		if unknown_target_ids:
+			response = jsonify({'message' : "Unknown targets: " + ', '.join(unknown_target_ids)})
+			response.status_code = 404
+			return response
+
+		unsupported_target_ids = [target_id for target_id in target_ids if not targets.can_receive_bundles(target_id)]
+		if unsupported_target_ids:
+			response = jsonify({'message' : "Only SSH-based targets can receive bundles: " + ', '.join(unsupported_target_ids)})
+			response.status_code = 400
+			return response
+
+		# Files that are bound for the same target are sent as one bundle, by one task per target
+		task_ids = []
+		for target_id in target_ids:
+			try:
+				distribute_bundle_task = DistributeBundleTask(file_stash, target_id, request_json['file_ids'])
+			except FileStash.FileDoesNotExistError, e:
+				response = jsonify({'message' : e.message, 'task_ids' : task_ids})
+				response.status_code = 404
+				return response
+
+			try:
+				if request_json.get('max_bandwidth'):
+					distribute_bundle_task.max_bandwidth = int(request_json['max_bandwidth'])
+				distribute_bundle_task.actions.extend(targets.create_bundle_distribution_actions(distribute_bundle_task.bundle_files(), target_id))
+				sendor_queue.add(distribute_bundle_task)
+			except:
+				distribute_bundle_task.unlock_files()
+				raise
+			task_ids.append(distribute_bundle_task.task_id)
+
+		return jsonify(task_ids=task_ids)
+
 	return api_app
 
 class ApiTestCase(unittest.TestCase):
@@ -154,14 +428,128 @@ class ApiTestCase(unittest.TestCase):
 		self.assertIn('collection', response)
 		self.assertEquals(len(response['collection']), 0)
 	
+		# An untrusted index is reconciled before the file stash becomes available
+		raw_response = self.app.get('/api/file_stash/reconciliation')
+		response = json.loads(raw_response.data)
+		self.assertEquals(response['state'], 'completed')
+
 		# Deleting a nonexistent file should result in "file not found"
 		raw_response = self.app.delete('/api/file_stash/0')
 		self.assertEquals(raw_response.status_code, 404)
 		
+		# Deleting several files at once should report the files which could not be deleted
+		raw_response = self.app.delete('/api/file_stash', data=json.dumps({ 'file_ids' : ['0', '1'] }), content_type='application/json')
+		response = json.loads(raw_response.data)
+		self.assertEquals(raw_response.status_code, 200)
+		self.assertEquals(response['removed'], [])
+		self.assertEquals(sorted(response['failed'].keys()), ['0', '1'])
+
+		raw_response = self.app.delete('/api/file_stash')
+		self.assertEquals(raw_response.status_code, 400)
+
 		# Attempting to distribute a nonexistent file should result in a "file not found"
 		raw_response = self.app.post('/api/file_stash/0/distribute/0')
 		self.assertEquals(raw_response.status_code, 404)
-		
+
+	def test_distribute_to_many_targets(self):
+
+		contents = 'Hello World\n'
+		sha1sum = hashlib.sha1(contents).hexdigest()
+		raw_response = self.app.put('/api/file_stash/upload/fan_out_test.txt', data=contents)
+		file_id = json.loads(raw_response.data)['file']['file_id']
+
+		# Requests without targets, or with unknown targets or files, should be rejected
+		raw_response = self.app.post('/api/file_stash/' + file_id + '/distribute', data=json.dumps({ 'target_ids' : [] }), content_type='application/json')
+		self.assertEquals(raw_response.status_code, 400)
+		raw_response = self.app.post('/api/file_stash/' + file_id + '/distribute', data=json.dumps({ 'target_ids' : ['target1', 'target4'] }), content_type='application/json')
+		self.assertEquals(raw_response.status_code, 404)
+		raw_response = self.app.post('/api/file_stash/' + file_id + '0/distribute', data=json.dumps({ 'target_ids' : ['target1'] }), content_type='application/json')
+		self.assertEquals(raw_response.status_code, 404)
+		raw_response = self.app.post('/api/file_stash/' + file_id + '/distribute', data=json.dumps({ 'target_ids' : ['target1'], 'max_bandwidth' : 'fast' }), content_type='application/json')
+		self.assertEquals(raw_response.status_code, 400)
+
+		# A single task should distribute the file to all targets, and report progress for each of them
+		target_ids = ['target1', 'target3']
+		try:
+			raw_response = self.app.post('/api/file_stash/' + file_id + '/distribute', data=json.dumps({ 'target_ids' : target_ids, 'max_bandwidth' : 1000000 }), content_type='application/json')
+			self.assertEquals(raw_response.status_code, 200)
+			task_id = json.loads(raw_response.data)['task_id']
+			for i in range(100):
+				task_progress = json.loads(self.app.get('/api/tasks/' + str(task_id)).data)['collection']
+				if task_progress['state'] != 'not_started' and task_progress['state'] != 'in_progress':
+					break
+				time.sleep(0.1)
+			self.assertEquals(task_progress['state'], 'completed')
+			self.assertEquals(sorted(task_progress['targets'].keys()), target_ids)
+			self.assertEquals(task_progress['max_bandwidth'], 1000000)
+			self.assertTrue(all(target['state'] == 'completed' for target in task_progress['targets'].values()))
+			for target_id in target_ids:
+				self.assertEquals(open(os.path.join(self.targets.get_targets()[target_id]['directory'], 'fan_out_test.txt')).read(), contents)
+		finally:
+			for target_id in target_ids:
+				target_filename = os.path.join(self.targets.get_targets()[target_id]['directory'], 'fan_out_test.txt')
+				if os.path.exists(target_filename):
+					os.remove(target_filename)
+
+	def test_distribute_bundle(self):
+
+		file_ids = []
+		for filename in ['bundle1.txt', 'bundle2.txt']:
+			raw_response = self.app.put('/api/file_stash/upload/' + filename, data=filename)
+			file_ids.append(json.loads(raw_response.data)['file']['file_id'])
+
+		# Bundles need files and targets, all of which must exist, and targets must be reached over SSH
+		raw_response = self.app.post('/api/file_stash/bundle/distribute', data=json.dumps({ 'file_ids' : file_ids, 'target_ids' : [] }), content_type='application/json')
+		self.assertEquals(raw_response.status_code, 400)
+		raw_response = self.app.post('/api/file_stash/bundle/distribute', data=json.dumps({ 'file_ids' : file_ids, 'target_ids' : ['target4'] }), content_type='application/json')
+		self.assertEquals(raw_response.status_code, 404)
+		raw_response = self.app.post('/api/file_stash/bundle/distribute', data=json.dumps({ 'file_ids' : file_ids, 'target_ids' : ['target1'] }), content_type='application/json')
+		self.assertEquals(raw_response.status_code, 400)
+
+		# A bundle task should report progress for each of its files, and lock them until it is done
+		task = DistributeBundleTask(self.file_stash, 'target1', file_ids)
+		self.assertEquals(sorted(task.file_progress.keys()), sorted(file_ids))
+		self.assertEquals([bundle_file.filename for bundle_file in task.bundle_files()], ['bundle1.txt', 'bundle2.txt'])
+		task.set_file_progress(file_ids[0], 'completed', 1.0)
+		self.assertEquals(task.progress()['files'][file_ids[0]]['state'], 'completed')
+		task.completed()
+
+		# A task which cannot lock all of its files should leave none of them locked
+		self.assertRaises(FileStash.FileDoesNotExistError, DistributeBundleTask, self.file_stash, 'target1', file_ids + ['missing'])
+		self.file_stash.remove(file_ids[0])
+		self.file_stash.remove(file_ids[1])
+
+	def test_upload_negotiation(self):
+
+		contents = 'Hello World\n'
+		sha1sum = hashlib.sha1(contents).hexdigest()
+		declaration = { 'filename' : 'hello.txt', 'size' : len(contents), 'sha1sum' : sha1sum }
+
+		# Unknown contents should require an upload
+		raw_response = self.app.post('/api/file_stash/negotiate', data=json.dumps(declaration), content_type='application/json')
+		response = json.loads(raw_response.data)
+		self.assertTrue(response['upload_required'])
+
+		# Uploads which do not match the declared hash should be rejected
+		raw_response = self.app.put(response['upload_url'], data='Goodbye World\n')
+		self.assertEquals(raw_response.status_code, 400)
+		self.assertEquals(len(self.file_stash.list()), 0)
+
+		raw_response = self.app.put(response['upload_url'], data=contents)
+		self.assertEquals(raw_response.status_code, 201)
+		self.assertEquals(json.loads(raw_response.data)['file']['sha1sum'], sha1sum)
+
+		# Once the contents are stashed, declaring the same contents should add a file without any upload
+		declaration['filename'] = 'hello_again.txt'
+		raw_response = self.app.post('/api/file_stash/negotiate', data=json.dumps(declaration), content_type='application/json')
+		response = json.loads(raw_response.data)
+		self.assertFalse(response['upload_required'])
+		self.assertEquals(response['file']['original_filename'], 'hello_again.txt')
+		self.assertEquals(len(self.file_stash.list()), 2)
+
+		raw_response = self.app.post('/api/file_stash/negotiate', data=json.dumps({ 'filename' : 'hello.txt' }), content_type='application/json')
+		self.assertEquals(raw_response.status_code, 400)
+
 	def test_tasks(self):
 
 		# Querying an empty queue should return a response with a 'collection' element referencing an empty collection
@@ -180,6 +568,24 @@ class ApiTestCase(unittest.TestCase):
 		response = json.loads(raw_response.data)
 		self.assertEquals(raw_response.status_code, 404)
 		
+	def test_connection_pool(self):
+
+		raw_response = self.app.get('/api/connection_pool')
+		response = json.loads(raw_response.data)
+		self.assertIn('hits', response)
+		self.assertIn('misses', response)
+
+	def test_target_inventory(self):
+
+		raw_response = self.app.get('/api/target_inventory')
+		response = json.loads(raw_response.data)
+		self.assertEquals(response['collection'], [])
+
+		raw_response = self.app.get('/api/target_inventory?target_id=target1')
+		self.assertEquals(raw_response.status_code, 200)
+		raw_response = self.app.get('/api/target_inventory?target_id=target4')
+		self.assertEquals(raw_response.status_code, 404)
+
 	def test_targets(self):
 
 		# Querying a non-empty set of targets should return a response with a 'collection' element referencing a non-collection of targets
@@ -189,6 +595,7 @@ class ApiTestCase(unittest.TestCase):
 		self.assertNotEquals(len(response['collection']), 0)
 		
 	def tearDown(self):
+		self.sendor_queue.stop()
 		shutil.rmtree(self.work_directory)
 		pass
 
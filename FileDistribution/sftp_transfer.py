@@ -0,0 +1,294 @@
+import ctypes
+import hashlib
+import logging
+import mmap
+import os
+import random
+import shutil
+import unittest
+import zlib
+
+import paramiko
+import paramiko.common
+
+logger = logging.getLogger('sftp_transfer')
+
+class SftpTransferSettings(object):
+	""" Tuning of the SSH/SFTP data path, read from the target description
+
+		sftp_block_size:     bytes read from the local file per write call
+		sftp_request_size:   bytes per SFTP write request; OpenSSH's sftp-server accepts requests of up to 255 kB, which
+		                     is the default; targets whose servers only accept smaller requests must lower it
+		sftp_pipelined:      'true' to send write requests without waiting for each response
+		ssh_window_size:     SSH channel window size, in bytes; this is the window that the target may send into,
+		                     while the window for data sent to the target is chosen by the target's SSH server
+		ssh_max_packet_size: largest SSH packet that the target may send
+		ssh_ciphers:         comma-separated list of ciphers, in order of preference
+		compression:         'none', 'ssh' for compression by the SSH transport, 'zlib' for streaming gzip data into
+		                     a decompressor on the target, or 'auto' for 'zlib' if a probe of the file compresses well
+		compression_level:   zlib compression level of streamed data
+		compression_probe_size: bytes at the start of the file that are compressed to decide whether 'auto' compresses
+		compression_max_ratio:  'auto' compresses when the probe shrinks to at most this fraction of its size
+		"""
+
+	compression_modes = ['none', 'ssh', 'zlib', 'auto']
+
+	def __init__(self, target):
+		self.block_size = int(target.get('sftp_block_size', 1024 * 1024))
+		self.request_size = int(target.get('sftp_request_size', 255 * 1024))
+		self.pipelined = target.get('sftp_pipelined', 'true') == 'true'
+		self.window_size = int(target.get('ssh_window_size', paramiko.common.DEFAULT_WINDOW_SIZE))
+		self.max_packet_size = int(target.get('ssh_max_packet_size', paramiko.common.DEFAULT_MAX_PACKET_SIZE))
+		self.ciphers = tuple([cipher.strip() for cipher in target.get('ssh_ciphers', '').split(',') if cipher.strip()])
+		self.compression = target.get('compression', 'none')
+		if self.compression not in self.compression_modes:
+			raise Exception("Unknown compression mode " + self.compression + "; must be one of " + ', '.join(self.compression_modes))
+		self.compression_level = int(target.get('compression_level', 1))
+		self.compression_probe_size = int(target.get('compression_probe_size', 4 * 1024 * 1024))
+		self.compression_max_ratio = float(target.get('compression_max_ratio', 0.8))
+
+def read_file_range(source, offset, length, block_size):
+	""" Yield the blocks of a range of a local file """
+	with open(source, 'rb') as input_file:
+		input_file.seek(offset)
+		remaining = length
+		while remaining > 0:
+			data = input_file.read(min(block_size, remaining))
+			if not data:
+				raise Exception("Source file " + source + " ended before all data was sent")
+			remaining -= len(data)
+			yield data
+
+class MappedFile(object):
+	""" A local file that is mapped into memory once, and shared by all threads that send parts of it
+		Ranges are handed out as memoryview slices of the mapping, so that blocks are not copied into strings
+		before they are sent. Python 2's mmap objects cannot be viewed by memoryview directly, so the mapping
+		is viewed through a ctypes array; ctypes needs a writable mapping, which is therefore private
+		(copy-on-write), but it is never written. The mapping must not be closed while slices are in use
+		"""
+
+	def __init__(self, path):
+		self.file = open(path, 'rb')
+		self.size = os.fstat(self.file.fileno()).st_size
+		# Empty files cannot be mapped
+		if self.size:
+			self.mapping = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_COPY)
+			self.view = memoryview((ctypes.c_char * self.size).from_buffer(self.mapping))
+		else:
+			self.mapping = None
+			self.view = memoryview('')
+
+	def blocks(self, offset, length, block_size):
+		""" Yield the blocks of a range of the file, as memoryview slices """
+		for block_offset in xrange(offset, offset + length, block_size):
+			yield self.view[block_offset:min(block_offset + block_size, offset + length)]
+
+	def close(self):
+		self.view = None
+		if self.mapping:
+			self.mapping.close()
+		self.file.close()
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, type, value, traceback):
+		self.close()
+
+def read_mapped_range(mapped_file, offset, length, block_size):
+	""" Yield the blocks of a range of a memory-mapped file """
+	for block_offset in range(offset, offset + length, block_size):
+		yield mapped_file[block_offset:min(block_offset + block_size, offset + length)]
+
+def hashed_blocks(blocks, sha1):
+	""" Yield blocks of data, adding each of them to a sha1 object on the way """
+	for data in blocks:
+		sha1.update(data)
+		yield data
+
+def send_blocks(sftp, blocks, filename, offset, settings, progress=None, mode='r+'):
+	""" Write blocks of data to a remote file, starting at offset
+		progress is called with the number of bytes sent, after each block
+		Errors reported by the target for pipelined writes are raised when the remote file is closed
+		Returns the sha1sum of the data that was sent
+		"""
+	sha1 = hashlib.sha1()
+	with sftp.open(filename, mode, bufsize=0) as output_file:
+		output_file.MAX_REQUEST_SIZE = settings.request_size
+		output_file.set_pipelined(settings.pipelined)
+		output_file.seek(offset)
+		for data in blocks:
+			output_file.write(data)
+			sha1.update(data)
+			if progress:
+				progress(len(data))
+	return sha1.hexdigest()
+
+def send_file_range(sftp, source, filename, offset, length, settings, progress=None, mode='r+'):
+	""" Write length bytes of a local file, starting at offset, to the same offset within a remote file """
+	return send_blocks(sftp, read_file_range(source, offset, length, settings.block_size), filename, offset, settings, progress, mode)
+
+def send_file(sftp, source, filename, settings, progress=None):
+	""" Write a local file to a remote file, replacing any previous contents """
+	return send_file_range(sftp, source, filename, 0, os.path.getsize(source), settings, progress, mode='w')
+
+def choose_compression(source, settings):
+	""" Decide whether to stream a file compressed ('zlib') or not ('none'); 'ssh' compression is up to the connection """
+	if settings.compression != 'auto':
+		return 'zlib' if settings.compression == 'zlib' else 'none'
+	with open(source, 'rb') as input_file:
+		probe = input_file.read(settings.compression_probe_size)
+	if not probe:
+		return 'none'
+	compressed_size = len(zlib.compress(probe, settings.compression_level))
+	return 'zlib' if compressed_size <= len(probe) * settings.compression_max_ratio else 'none'
+
+def stream_blocks(connection, blocks, filename, offset, settings, progress=None, truncate=False):
+	""" Send blocks of data compressed to the target, where gzip decompresses them into a file, starting at offset
+		The remote file is replaced when truncate is set
+		Returns the sha1sum of the uncompressed data that was sent
+		"""
+	if truncate:
+		command = 'gzip -dc > ' + filename
+	else:
+		command = 'gzip -dc | dd of=' + filename + ' bs=1M seek=' + str(offset) + ' oflag=seek_bytes conv=notrunc 2>/dev/null'
+
+	sha1 = hashlib.sha1()
+	compressor = zlib.compressobj(settings.compression_level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+	channel = connection.transport.open_session()
+	try:
+		channel.exec_command(command)
+		for data in blocks:
+			# zlib only takes strings; compressing copies the data anyway
+			if isinstance(data, memoryview):
+				data = data.tobytes()
+			channel.sendall(compressor.compress(data))
+			sha1.update(data)
+			if progress:
+				progress(len(data))
+		channel.sendall(compressor.flush())
+		channel.shutdown_write()
+		errors = channel.makefile_stderr('rb').read()
+		exit_status = channel.recv_exit_status()
+	finally:
+		channel.close()
+	if exit_status != 0:
+		raise Exception("Remote decompression failed: " + errors)
+	return sha1.hexdigest()
+
+def stream_file_range(connection, source, filename, offset, length, settings, progress=None, truncate=False):
+	""" Send a range of a local file compressed to the target, where it is decompressed to the same offset within a file """
+	return stream_blocks(connection, read_file_range(source, offset, length, settings.block_size), filename, offset, settings, progress, truncate)
+
+def stream_file(connection, source, filename, settings, progress=None):
+	""" Send a local file compressed to the target, replacing any previous contents """
+	return stream_file_range(connection, source, filename, 0, os.path.getsize(source), settings, progress, truncate=True)
+
+class SftpTransferUnitTest(unittest.TestCase):
+
+	root_path = 'unittest'
+	source_path = root_path + '/source'
+	file_contents = ''.join([chr(i % 251) for i in range(300000)])
+
+	def setUp(self):
+		from ssh_test_server import SshTestServer, LatencyProxy
+		from ssh_connection_pool import SshConnectionPool
+		os.mkdir(self.root_path)
+		with open(self.source_path, 'wb') as file:
+			file.write(self.file_contents)
+		self.server = SshTestServer(self.root_path + '/target')
+		self.server.start()
+		self.proxy = LatencyProxy(self.server.port, 0.01)
+		self.proxy.start()
+		self.connection_pool = SshConnectionPool()
+
+	def create_target(self, **settings):
+		target = self.server.create_target(self.root_path + '/client_key', **settings)
+		target['port'] = str(self.proxy.port)
+		return target
+
+	def test_send_file(self):
+
+		# Every combination of settings should deliver the file intact
+		for settings in [{ 'sftp_pipelined' : 'false', 'sftp_block_size' : '16384' },
+				{ 'sftp_pipelined' : 'true', 'sftp_request_size' : '65536', 'ssh_window_size' : '16777216', 'ssh_ciphers' : 'aes256-ctr' }]:
+			target = self.create_target(**settings)
+			progress = []
+			with self.connection_pool.connection(target) as connection:
+				send_file(connection.sftp(), self.source_path, 'file', SftpTransferSettings(target), progress.append)
+				if 'ssh_ciphers' in settings:
+					self.assertEquals(connection.transport.local_cipher, 'aes256-ctr')
+			self.assertEquals(open(self.root_path + '/target/file', 'rb').read(), self.file_contents)
+			self.assertEquals(sum(progress), len(self.file_contents))
+
+	def test_send_file_range(self):
+
+		target = self.create_target()
+		settings = SftpTransferSettings(target)
+		with open(self.root_path + '/target/file', 'wb') as file:
+			file.truncate(len(self.file_contents))
+		with self.connection_pool.connection(target) as connection:
+			self.assertEquals(send_file_range(connection.sftp(), self.source_path, 'file', 100000, 200000, settings), hashlib.sha1(self.file_contents[100000:300000]).hexdigest())
+			send_file_range(connection.sftp(), self.source_path, 'file', 0, 100000, settings)
+		self.assertEquals(open(self.root_path + '/target/file', 'rb').read(), self.file_contents)
+
+		# Blocks of a mapped file should be sent without being copied into strings first
+		with MappedFile(self.source_path) as mapped_file:
+			blocks = list(mapped_file.blocks(1000, 250000, settings.block_size))
+			self.assertTrue(all(isinstance(data, memoryview) for data in blocks))
+			with self.connection_pool.connection(target) as connection:
+				self.assertEquals(send_blocks(connection.sftp(), blocks, 'file', 1000, settings), hashlib.sha1(self.file_contents[1000:251000]).hexdigest())
+			del blocks
+		self.assertEquals(open(self.root_path + '/target/file', 'rb').read(), self.file_contents)
+
+		# Unknown ciphers should be rejected when connecting
+		self.assertRaises(ValueError, self.connection_pool.acquire, self.create_target(ssh_ciphers='rot13'))
+
+	def test_compression(self):
+
+		rng = random.Random(1)
+		text = ''.join([rng.choice(['alpha ', 'beta ', 'gamma\n']) for i in range(100000)])
+		with open(self.root_path + '/text', 'wb') as file:
+			file.write(text)
+		with open(self.root_path + '/random', 'wb') as file:
+			file.write(''.join([chr(rng.randint(0, 255)) for i in range(100000)]))
+
+		# Automatic compression should only compress data that compresses well
+		settings = SftpTransferSettings({ 'compression' : 'auto' })
+		self.assertEquals(choose_compression(self.root_path + '/text', settings), 'zlib')
+		self.assertEquals(choose_compression(self.root_path + '/random', settings), 'none')
+		self.assertEquals(choose_compression(self.source_path, SftpTransferSettings({ 'compression' : 'ssh' })), 'none')
+		self.assertRaises(Exception, SftpTransferSettings, { 'compression' : 'lzma' })
+
+		# Compressed data should be decompressed into whole files and into ranges of files
+		target = self.create_target()
+		with self.connection_pool.connection(target) as connection:
+			progress = []
+			self.assertEquals(stream_file(connection, self.root_path + '/text', 'text', settings, progress.append), hashlib.sha1(text).hexdigest())
+			self.assertEquals(sum(progress), len(text))
+			self.assertEquals(open(self.root_path + '/target/text', 'rb').read(), text)
+
+			connection.run('truncate -s ' + str(len(text)) + ' ranges')
+			stream_file_range(connection, self.root_path + '/text', 'ranges', 200000, len(text) - 200000, settings)
+			stream_file_range(connection, self.root_path + '/text', 'ranges', 0, 200000, settings)
+			self.assertEquals(open(self.root_path + '/target/ranges', 'rb').read(), text)
+
+			self.assertRaises(Exception, stream_file, connection, self.root_path + '/text', 'missing_directory/text', settings)
+
+			with MappedFile(self.root_path + '/text') as mapped_file:
+				self.assertEquals(stream_blocks(connection, mapped_file.blocks(0, len(text), 65536), 'mapped_text', 0, settings, truncate=True), hashlib.sha1(text).hexdigest())
+			self.assertEquals(open(self.root_path + '/target/mapped_text', 'rb').read(), text)
+
+		# SSH compression should be negotiated with the target
+		target = self.create_target(compression='ssh')
+		with self.connection_pool.connection(target) as connection:
+			self.assertTrue(connection.transport.local_compression in ['zlib', 'zlib@openssh.com'])
+
+	def tearDown(self):
+		self.connection_pool.close_all()
+		self.proxy.stop()
+		self.server.stop()
+		shutil.rmtree(self.root_path)
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,419 @@
+import errno
+import logging
+import multiprocessing
+import os
+import shutil
+import threading
+import time
+import unittest
+
+from contextlib import contextmanager
+
+import paramiko
+
+from sftp_transfer import SftpTransferSettings
+
+logger = logging.getLogger('ssh_connection_pool')
+
+def process_exists(process_id):
+	try:
+		os.kill(process_id, 0)
+	except OSError, e:
+		if e.errno == errno.ESRCH:
+			return False
+	return True
+
+class SshConnection(object):
+	""" An authenticated SSH connection to a target, with a lazily opened SFTP session """
+
+	def __init__(self, transport):
+		self.transport = transport
+		self.sftp_client = None
+		self.last_used_time = time.time()
+		# Files which have been installed on the target over this connection, and need not be checked again
+		self.installed_files = set()
+
+	def sftp(self):
+		if not self.sftp_client:
+			self.sftp_client = paramiko.SFTPClient.from_transport(self.transport)
+		return self.sftp_client
+
+	def run(self, command):
+		""" Run a command on the target, and return its output
+			Raises an exception if the command fails
+			"""
+		channel = self.transport.open_session()
+		try:
+			channel.exec_command(command)
+			output = channel.makefile('rb').read()
+			exit_status = channel.recv_exit_status()
+		finally:
+			channel.close()
+		if exit_status != 0:
+			raise Exception("Remote command failed: " + command)
+		return output
+
+	def is_healthy(self, timeout_seconds):
+		""" Check that the connection still works, with a round trip to the target """
+		if not self.transport.is_active():
+			return False
+		try:
+			channel = self.sftp().get_channel()
+			channel.settimeout(timeout_seconds)
+			self.sftp().normalize('.')
+			channel.settimeout(None)
+			return True
+		except Exception:
+			return False
+
+	def close(self):
+		try:
+			if self.sftp_client:
+				self.sftp_client.close()
+			self.transport.close()
+		except Exception:
+			pass
+
+class SshConnectionPool(object):
+	""" Keeps SSH connections to targets open, so that actions and tasks can share them
+
+		Connections are keyed by target user, host, port, private key and SSH transport settings. A connection that has been
+		idle for a while is checked before it is handed out again, and connections that have been idle
+		for longer than the idle timeout are closed by a background thread, which runs for as long as the pool
+		has connections. At most max_sessions_per_target connections are open to each target at a time;
+		further requests wait for a connection to be released.
+
+		Connections cannot be shared with child processes. A pool that is used after a fork
+		forgets the connections it inherited, and starts over. Pools in other processes report their
+		statistics, including how many connections they hold, through add_statistics()
+		"""
+
+	statistics_names = ['hits', 'misses', 'waits', 'health_check_failures', 'idle_timeouts', 'connection_failures']
+	expiry_check_interval_seconds = 10
+
+	def __init__(self, idle_timeout_seconds=300, health_check_interval_seconds=30, health_check_timeout_seconds=10, max_sessions_per_target=10):
+		self.idle_timeout_seconds = idle_timeout_seconds
+		self.health_check_interval_seconds = health_check_interval_seconds
+		self.health_check_timeout_seconds = health_check_timeout_seconds
+		self.max_sessions_per_target = max_sessions_per_target
+		self.lock = threading.Condition()
+		self.keys = {}
+		self.reset()
+
+	def reset(self):
+		with self.lock:
+			self.pid = os.getpid()
+			self.idle_connections = {}
+			self.num_connections = {}
+			self.statistics = dict((name, 0) for name in self.statistics_names)
+			# The (open, idle) connection counts that other processes have last reported, by process id
+			self.process_connection_counts = {}
+			self.expiry_thread = None
+
+	def check_process(self):
+		if self.pid != os.getpid():
+			# The connections belong to the parent process; closing them here would disturb the parent's sessions
+			self.keys = {}
+			self.reset()
+
+	def target_key(self, target):
+		settings = SftpTransferSettings(target)
+		return (target['user'], target['host'], int(target['port']), target['private_key_file'], settings.window_size, settings.max_packet_size, settings.ciphers, settings.compression == 'ssh')
+
+	def load_key(self, private_key_file):
+		""" Read a private key file; keys are parsed once, and kept until the file changes """
+		modification_time = os.stat(private_key_file).st_mtime
+		with self.lock:
+			cached_key = self.keys.get(private_key_file)
+			if cached_key and cached_key[0] == modification_time:
+				return cached_key[1]
+		key = paramiko.RSAKey.from_private_key_file(private_key_file)
+		with self.lock:
+			self.keys[private_key_file] = (modification_time, key)
+		return key
+
+	def open_connection(self, target):
+		key = self.load_key(target['private_key_file'])
+		settings = SftpTransferSettings(target)
+		transport = paramiko.Transport((target['host'], int(target['port'])), default_window_size=settings.window_size, default_max_packet_size=settings.max_packet_size)
+		try:
+			if settings.ciphers:
+				transport.get_security_options().ciphers = settings.ciphers
+			transport.use_compression(settings.compression == 'ssh')
+			transport.connect(username=target['user'], pkey=key)
+		except:
+			transport.close()
+			raise
+		return SshConnection(transport)
+
+	def acquire(self, target):
+		""" Get a connection to a target; release it with release() when done """
+
+		target_key = self.target_key(target)
+		has_waited = False
+		while True:
+			connection = None
+			with self.lock:
+				self.check_process()
+				while True:
+					self.close_all_expired_connections()
+					idle_connections = self.idle_connections.setdefault(target_key, [])
+					if idle_connections:
+						connection = idle_connections.pop()
+						break
+					elif self.num_connections.get(target_key, 0) < self.max_sessions_per_target:
+						self.num_connections[target_key] = self.num_connections.get(target_key, 0) + 1
+						self.statistics['misses'] += 1
+						self.start_expiry_thread()
+						break
+					else:
+						if not has_waited:
+							self.statistics['waits'] += 1
+							has_waited = True
+						self.lock.wait()
+
+			if not connection:
+				# Connect without holding the lock, since the handshake takes a while
+				try:
+					return self.open_connection(target)
+				except:
+					with self.lock:
+						self.statistics['connection_failures'] += 1
+						self.num_connections[target_key] -= 1
+						self.lock.notify()
+					raise
+
+			# Connections which have been idle for a while are checked before they are reused
+			if time.time() - connection.last_used_time < self.health_check_interval_seconds or connection.is_healthy(self.health_check_timeout_seconds):
+				with self.lock:
+					self.statistics['hits'] += 1
+				return connection
+
+			with self.lock:
+				self.statistics['health_check_failures'] += 1
+				self.discard_connection(target_key, connection)
+
+	def release(self, target, connection, reusable=True):
+		""" Return a connection to the pool
+			Connections that may have been left in an unknown state should not be reused
+			"""
+		target_key = self.target_key(target)
+		with self.lock:
+			if self.pid != os.getpid():
+				return
+			if reusable and connection.transport.is_active():
+				connection.last_used_time = time.time()
+				self.idle_connections.setdefault(target_key, []).append(connection)
+			else:
+				self.discard_connection(target_key, connection)
+			self.lock.notify()
+
+	@contextmanager
+	def connection(self, target):
+		connection = self.acquire(target)
+		try:
+			yield connection
+		except:
+			self.release(target, connection, reusable=False)
+			raise
+		self.release(target, connection)
+
+	def discard_connection(self, target_key, connection):
+		with self.lock:
+			connection.close()
+			self.num_connections[target_key] -= 1
+			self.lock.notify()
+
+	def close_expired_connections(self, target_key):
+		with self.lock:
+			now = time.time()
+			idle_connections = self.idle_connections.get(target_key, [])
+			for connection in idle_connections[:]:
+				if now - connection.last_used_time >= self.idle_timeout_seconds:
+					idle_connections.remove(connection)
+					self.statistics['idle_timeouts'] += 1
+					self.discard_connection(target_key, connection)
+
+	def close_all_expired_connections(self):
+		with self.lock:
+			self.check_process()
+			for target_key in self.idle_connections.keys():
+				self.close_expired_connections(target_key)
+
+	def start_expiry_thread(self):
+		""" Start closing expired connections in the background, unless that is already being done; must be called with the lock held """
+		if not self.expiry_thread:
+			self.expiry_thread = threading.Thread(target=self.expiry_thread_func)
+			self.expiry_thread.daemon = True
+			self.expiry_thread.start()
+
+	def expiry_thread_func(self):
+		while True:
+			time.sleep(self.expiry_check_interval_seconds)
+			with self.lock:
+				if self.pid != os.getpid():
+					return
+				try:
+					self.close_all_expired_connections()
+				except Exception:
+					logger.exception("Closing expired connections failed")
+				# The thread is started again once a new connection is opened
+				if not any(self.num_connections.values()):
+					self.expiry_thread = None
+					return
+
+	def close_all(self):
+		with self.lock:
+			self.check_process()
+			for target_key, idle_connections in self.idle_connections.items():
+				for connection in idle_connections:
+					self.discard_connection(target_key, connection)
+			self.idle_connections = {}
+
+	def connection_counts(self):
+		""" Return the number of connections that this process holds, and how many of those are idle """
+		with self.lock:
+			self.check_process()
+			return sum(self.num_connections.values()), sum(len(connections) for connections in self.idle_connections.values())
+
+	def take_statistics(self):
+		""" Return the statistics gathered since the previous call, and start over
+			The current connection counts are included, but not reset
+			"""
+		with self.lock:
+			self.check_process()
+			statistics = self.statistics
+			self.statistics = dict((name, 0) for name in self.statistics_names)
+			statistics['open_connections'], statistics['idle_connections'] = self.connection_counts()
+			return statistics
+
+	def add_statistics(self, statistics, process_id=None):
+		""" Accumulate statistics that were gathered by another process
+			The connection counts of process_id replace the ones that it reported before
+			"""
+		with self.lock:
+			for name in self.statistics_names:
+				self.statistics[name] += statistics.get(name, 0)
+			if process_id is not None and 'open_connections' in statistics:
+				self.process_connection_counts[process_id] = (statistics['open_connections'], statistics['idle_connections'])
+
+	def get_statistics(self):
+		""" Return the statistics, with the connections of this process and of the other processes that still exist """
+		with self.lock:
+			self.check_process()
+			statistics = dict(self.statistics)
+			statistics['open_connections'], statistics['idle_connections'] = self.connection_counts()
+			for process_id, (open_connections, idle_connections) in self.process_connection_counts.items():
+				if process_exists(process_id):
+					statistics['open_connections'] += open_connections
+					statistics['idle_connections'] += idle_connections
+				else:
+					del self.process_connection_counts[process_id]
+			return statistics
+
+# The pool that is shared by all actions within a process
+connection_pool = SshConnectionPool()
+
+class SshConnectionPoolUnitTest(unittest.TestCase):
+
+	root_path = 'unittest'
+
+	def setUp(self):
+		from ssh_test_server import SshTestServer
+		os.mkdir(self.root_path)
+		self.server = SshTestServer(os.path.join(self.root_path, 'target'))
+		self.server.start()
+		self.target = self.server.create_target(os.path.join(self.root_path, 'client_key'))
+		self.connection_pool = SshConnectionPool(idle_timeout_seconds=60, health_check_interval_seconds=0, max_sessions_per_target=2)
+
+	def test_reuse(self):
+
+		# Connections should be reused once they have been released
+		with self.connection_pool.connection(self.target) as connection:
+			self.assertEquals(connection.run('echo hello'), 'hello\n')
+		with self.connection_pool.connection(self.target) as connection:
+			connection.sftp().open('file', 'w').write('contents')
+		statistics = self.connection_pool.get_statistics()
+		self.assertEquals(statistics['misses'], 1)
+		self.assertEquals(statistics['hits'], 1)
+		self.assertEquals(statistics['idle_connections'], 1)
+		self.assertEquals(len(self.server.connections), 1)
+
+		# Failed commands should raise exceptions, and not leave broken connections in the pool
+		def fail():
+			with self.connection_pool.connection(self.target) as connection:
+				connection.run('false')
+		self.assertRaises(Exception, fail)
+		self.assertEquals(self.connection_pool.get_statistics()['open_connections'], 0)
+
+		# Connections that have died while idle should be replaced
+		connection = self.connection_pool.acquire(self.target)
+		self.connection_pool.release(self.target, connection)
+		self.server.disconnect_all()
+		time.sleep(0.5)
+		with self.connection_pool.connection(self.target) as connection:
+			self.assertEquals(connection.run('echo hello'), 'hello\n')
+
+		# Connections that have been idle for too long should be closed
+		self.connection_pool.idle_timeout_seconds = 0
+		self.connection_pool.close_all_expired_connections()
+		self.assertEquals(self.connection_pool.get_statistics()['open_connections'], 0)
+
+		# Statistics should be transferable to another pool, along with the connections of the process that sent them
+		with self.connection_pool.connection(self.target) as connection:
+			statistics = self.connection_pool.take_statistics()
+		self.assertEquals(self.connection_pool.get_statistics()['misses'], 0)
+		other_pool = SshConnectionPool()
+		other_pool.add_statistics(statistics, os.getpid())
+		self.assertEquals(other_pool.get_statistics()['misses'], statistics['misses'])
+		self.assertEquals(other_pool.get_statistics()['open_connections'], 1)
+		other_pool.add_statistics(self.connection_pool.take_statistics(), os.getpid())
+		self.assertEquals(other_pool.get_statistics()['idle_connections'], 1)
+
+		# Connections of processes that no longer exist should not be counted
+		process = multiprocessing.Process(target=time.sleep, args=(0,))
+		process.start()
+		process.join()
+		other_pool.add_statistics({ 'open_connections' : 1, 'idle_connections' : 1 }, process.pid)
+		self.assertEquals(other_pool.get_statistics()['open_connections'], 1)
+
+	def test_expiry(self):
+
+		# Idle connections should be closed once they expire, without the pool being used meanwhile
+		self.connection_pool.idle_timeout_seconds = 0.2
+		self.connection_pool.expiry_check_interval_seconds = 0.1
+		with self.connection_pool.connection(self.target) as connection:
+			connection.run('true')
+		self.assertEquals(self.connection_pool.get_statistics()['idle_connections'], 1)
+		time.sleep(1)
+		statistics = self.connection_pool.get_statistics()
+		self.assertEquals(statistics['open_connections'], 0)
+		self.assertEquals(statistics['idle_timeouts'], 1)
+		self.assertEquals(self.connection_pool.expiry_thread, None)
+
+	def test_max_sessions(self):
+
+		connection1 = self.connection_pool.acquire(self.target)
+		connection2 = self.connection_pool.acquire(self.target)
+
+		# A third connection should only be handed out once another one has been released
+		acquired = []
+		thread = threading.Thread(target=lambda: acquired.append(self.connection_pool.acquire(self.target)))
+		thread.start()
+		time.sleep(0.5)
+		self.assertEquals(acquired, [])
+		self.connection_pool.release(self.target, connection1)
+		thread.join()
+		self.assertEquals(acquired, [connection1])
+		self.assertEquals(self.connection_pool.get_statistics()['waits'], 1)
+
+		self.connection_pool.release(self.target, connection2)
+		self.connection_pool.release(self.target, acquired[0])
+
+	def tearDown(self):
+		self.connection_pool.close_all()
+		self.server.stop()
+		shutil.rmtree(self.root_path)
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,323 @@
+import Queue
+import errno
+import logging
+import os
+import os.path
+import socket
+import subprocess
+import threading
+import time
+
+import paramiko
+
+logger = logging.getLogger('ssh_test_server')
+
+# A minimal SSH server, for tests and benchmarks that need an SSH target without a real SSH daemon
+#  Files are served over SFTP from a local directory, and commands are run by the local shell within that directory
+
+class LocalSftpHandle(paramiko.SFTPHandle):
+
+	def stat(self):
+		try:
+			return paramiko.SFTPAttributes.from_stat(os.fstat(self.readfile.fileno()))
+		except OSError, e:
+			return paramiko.SFTPServer.convert_errno(e.errno)
+
+	def chattr(self, attr):
+		return paramiko.SFTP_OK
+
+class LocalSftpServerInterface(paramiko.SFTPServerInterface):
+
+	def __init__(self, server, root_path, *args, **kwargs):
+		super(LocalSftpServerInterface, self).__init__(server, *args, **kwargs)
+		self.root_path = root_path
+
+	def local_path(self, path):
+		return os.path.join(self.root_path, self.canonicalize(path).lstrip('/'))
+
+	def canonicalize(self, path):
+		return os.path.normpath(os.path.join('/', path))
+
+	def list_folder(self, path):
+		try:
+			local_path = self.local_path(path)
+			attributes = []
+			for filename in os.listdir(local_path):
+				attribute = paramiko.SFTPAttributes.from_stat(os.stat(os.path.join(local_path, filename)))
+				attribute.filename = filename
+				attributes.append(attribute)
+			return attributes
+		except OSError, e:
+			return paramiko.SFTPServer.convert_errno(e.errno)
+
+	def stat(self, path):
+		try:
+			return paramiko.SFTPAttributes.from_stat(os.stat(self.local_path(path)))
+		except OSError, e:
+			return paramiko.SFTPServer.convert_errno(e.errno)
+
+	def lstat(self, path):
+		try:
+			return paramiko.SFTPAttributes.from_stat(os.lstat(self.local_path(path)))
+		except OSError, e:
+			return paramiko.SFTPServer.convert_errno(e.errno)
+
+	def open(self, path, flags, attr):
+		local_path = self.local_path(path)
+		try:
+			fd = os.open(local_path, flags | getattr(os, 'O_BINARY', 0), 0644)
+		except OSError, e:
+			return paramiko.SFTPServer.convert_errno(e.errno)
+
+		if flags & os.O_WRONLY:
+			mode = 'ab' if flags & os.O_APPEND else 'wb'
+		elif flags & os.O_RDWR:
+			mode = 'a+b' if flags & os.O_APPEND else 'r+b'
+		else:
+			mode = 'rb'
+		try:
+			file = os.fdopen(fd, mode)
+		except OSError, e:
+			return paramiko.SFTPServer.convert_errno(e.errno)
+
+		handle = LocalSftpHandle(flags)
+		handle.filename = local_path
+		handle.readfile = file
+		handle.writefile = file
+		return handle
+
+	def remove(self, path):
+		try:
+			os.remove(self.local_path(path))
+		except OSError, e:
+			return paramiko.SFTPServer.convert_errno(e.errno)
+		return paramiko.SFTP_OK
+
+	def rename(self, oldpath, newpath):
+		try:
+			os.rename(self.local_path(oldpath), self.local_path(newpath))
+		except OSError, e:
+			return paramiko.SFTPServer.convert_errno(e.errno)
+		return paramiko.SFTP_OK
+
+	def mkdir(self, path, attr):
+		try:
+			os.mkdir(self.local_path(path))
+		except OSError, e:
+			return paramiko.SFTPServer.convert_errno(e.errno)
+		return paramiko.SFTP_OK
+
+	def rmdir(self, path):
+		try:
+			os.rmdir(self.local_path(path))
+		except OSError, e:
+			return paramiko.SFTPServer.convert_errno(e.errno)
+		return paramiko.SFTP_OK
+
+	def chattr(self, path, attr):
+		return paramiko.SFTP_OK
+
+class SshTestServerInterface(paramiko.ServerInterface):
+
+	def __init__(self, server):
+		self.server = server
+
+	def get_allowed_auths(self, username):
+		return 'publickey'
+
+	def check_auth_publickey(self, username, key):
+		if key.get_base64() in self.server.authorized_keys:
+			return paramiko.AUTH_SUCCESSFUL
+		return paramiko.AUTH_FAILED
+
+	def check_channel_request(self, kind, chanid):
+		if kind == 'session':
+			return paramiko.OPEN_SUCCEEDED
+		return paramiko.OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED
+
+	def check_channel_exec_request(self, channel, command):
+		thread = threading.Thread(target=self.server.run_command, args=(channel, command))
+		thread.daemon = True
+		thread.start()
+		return True
+
+class SshTestServer(object):
+
+	def __init__(self, root_path):
+		self.root_path = os.path.abspath(root_path)
+		if not os.path.exists(self.root_path):
+			os.makedirs(self.root_path)
+		self.host_key = paramiko.RSAKey.generate(1024)
+		self.authorized_keys = set()
+		self.connections = []
+		self.listen_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+		self.listen_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+		self.listen_socket.bind(('127.0.0.1', 0))
+		self.port = self.listen_socket.getsockname()[1]
+		self.running = False
+
+	def create_target(self, private_key_file, **settings):
+		""" Create a client key which the server accepts, and return a target description for connecting to the server """
+		key = paramiko.RSAKey.generate(1024)
+		key.write_private_key_file(private_key_file)
+		self.authorized_keys.add(key.get_base64())
+		target = { 'name' : 'SSH test server',
+			'user' : 'test',
+			'host' : '127.0.0.1',
+			'port' : str(self.port),
+			'private_key_file' : private_key_file }
+		target.update(settings)
+		return target
+
+	def start(self):
+		self.running = True
+		self.listen_socket.listen(100)
+		thread = threading.Thread(target=self.accept_thread)
+		thread.daemon = True
+		thread.start()
+
+	def accept_thread(self):
+		while self.running:
+			try:
+				client_socket, address = self.listen_socket.accept()
+			except socket.error:
+				return
+			transport = paramiko.Transport(client_socket)
+			transport.add_server_key(self.host_key)
+			transport.use_compression(True)
+			transport.set_subsystem_handler('sftp', paramiko.SFTPServer, LocalSftpServerInterface, self.root_path)
+			try:
+				transport.start_server(server=SshTestServerInterface(self))
+				self.connections.append(transport)
+			except (paramiko.SSHException, EOFError, socket.error):
+				transport.close()
+
+	def run_command(self, channel, command):
+		try:
+			process = subprocess.Popen(command, shell=True, cwd=self.root_path, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+			input_thread = threading.Thread(target=self.forward_input, args=(channel, process.stdin))
+			input_thread.daemon = True
+			input_thread.start()
+			errors = []
+			errors_thread = threading.Thread(target=lambda: errors.append(process.stderr.read()))
+			errors_thread.daemon = True
+			errors_thread.start()
+			output = process.stdout.read()
+			errors_thread.join()
+			process.wait()
+			channel.sendall(output)
+			channel.sendall_stderr(errors[0])
+			channel.send_exit_status(process.returncode)
+		except (socket.error, EOFError):
+			pass
+		finally:
+			channel.close()
+
+	def forward_input(self, channel, process_input):
+		try:
+			while True:
+				data = channel.recv(65536)
+				if not data:
+					break
+				process_input.write(data)
+		except (socket.error, EOFError, IOError):
+			pass
+		finally:
+			try:
+				process_input.close()
+			except IOError:
+				pass
+
+	def disconnect_all(self):
+		for transport in self.connections:
+			transport.close()
+		self.connections = []
+
+	def stop(self):
+		self.running = False
+		try:
+			self.listen_socket.shutdown(socket.SHUT_RDWR)
+		except socket.error:
+			pass
+		self.listen_socket.close()
+		self.disconnect_all()
+
+class LatencyProxy(object):
+	""" Forwards TCP connections to a local port, delaying the data in each direction by a fixed latency
+		Used for measuring how transfers behave on links with a long round trip time
+		"""
+
+	def __init__(self, target_port, latency_seconds):
+		self.target_port = target_port
+		self.latency_seconds = latency_seconds
+		self.sockets = []
+		self.listen_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+		self.listen_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+		self.listen_socket.bind(('127.0.0.1', 0))
+		self.port = self.listen_socket.getsockname()[1]
+		self.running = False
+
+	def start(self):
+		self.running = True
+		self.listen_socket.listen(100)
+		thread = threading.Thread(target=self.accept_thread)
+		thread.daemon = True
+		thread.start()
+
+	def accept_thread(self):
+		while self.running:
+			try:
+				client_socket, address = self.listen_socket.accept()
+				target_socket = socket.create_connection(('127.0.0.1', self.target_port))
+			except socket.error:
+				return
+			for connection_socket in [client_socket, target_socket]:
+				connection_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+				self.sockets.append(connection_socket)
+			for source, destination in [(client_socket, target_socket), (target_socket, client_socket)]:
+				thread = threading.Thread(target=self.receive_thread, args=(source, destination))
+				thread.daemon = True
+				thread.start()
+
+	def receive_thread(self, source, destination):
+		pending = Queue.Queue()
+		thread = threading.Thread(target=self.deliver_thread, args=(pending, destination))
+		thread.daemon = True
+		thread.start()
+		while True:
+			try:
+				data = source.recv(65536)
+			except socket.error:
+				data = ''
+			pending.put((time.time() + self.latency_seconds, data))
+			if not data:
+				return
+
+	def deliver_thread(self, pending, destination):
+		while True:
+			delivery_time, data = pending.get()
+			delay = delivery_time - time.time()
+			if delay > 0:
+				time.sleep(delay)
+			try:
+				if not data:
+					destination.shutdown(socket.SHUT_WR)
+					return
+				destination.sendall(data)
+			except socket.error:
+				return
+
+	def stop(self):
+		self.running = False
+		try:
+			self.listen_socket.shutdown(socket.SHUT_RDWR)
+		except socket.error:
+			pass
+		self.listen_socket.close()
+		for connection_socket in self.sockets:
+			try:
+				connection_socket.shutdown(socket.SHUT_RDWR)
+			except socket.error:
+				pass
+			connection_socket.close()
+		self.sockets = []
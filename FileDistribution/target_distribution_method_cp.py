@@ -7,6 +7,6 @@ from actions import CopyFileAction
 
 def create_actions(source, filename, sha1sum, size, target):	
 	target_filename = os.path.join(target['directory'], filename)
-	return [CopyFileAction(source, sha1sum, size, target_filename)]
+	return [CopyFileAction(source, sha1sum, size, target_filename, target.get('copy_mode', 'copy'), target.get('max_bandwidth'))]
 
 target_distribution_methods.register('cp', create_actions)
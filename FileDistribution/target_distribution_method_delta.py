@@ -0,0 +1,11 @@
+import os.path
+
+import target_distribution_methods
+
+from actions import TestIfFileUpToDateOnTargetAction, DeltaSendFileAction
+
+def create_actions(source, filename, sha1sum, size, target):	
+	return [TestIfFileUpToDateOnTargetAction(filename, sha1sum, target),
+		DeltaSendFileAction(source, filename, sha1sum, size, target)]
+
+target_distribution_methods.register('delta', create_actions)
@@ -0,0 +1,181 @@
+import errno
+import hashlib
+import json
+import logging
+import os
+import os.path
+import shutil
+import tempfile
+import time
+import unittest
+
+logger = logging.getLogger('target_inventory')
+
+def target_key(target):
+	return target['user'] + '@' + target['host'] + ':' + str(target['port'])
+
+class TargetInventoryEntry(object):
+	""" The contents of a file on a target, as of the last time that it was distributed or hashed
+		size and mtime are as reported by the target, so that the target can cheaply tell whether the file has changed since
+		"""
+
+	def __init__(self, target, target_name, filename, sha1sum, size, mtime, recorded_time):
+		self.target = target
+		self.target_name = target_name
+		self.filename = filename
+		self.sha1sum = sha1sum
+		self.size = size
+		self.mtime = mtime
+		self.recorded_time = recorded_time
+
+	def matches(self, size, mtime):
+		return self.size == size and self.mtime == mtime
+
+	def to_json(self):
+		return { 'target' : self.target,
+			'target_name' : self.target_name,
+			'filename' : self.filename,
+			'sha1sum' : self.sha1sum,
+			'size' : self.size,
+			'mtime' : self.mtime,
+			'recorded_time' : self.recorded_time }
+
+class TargetInventory(object):
+	""" Remembers which contents have been placed on which targets, so that repeat distributions can be decided
+		by comparing the size and modification time of the remote file instead of computing its sha1sum
+		Entries are kept as one file each below root_path, so that all worker processes share them; without a
+		root path, the inventory keeps nothing. Entries that are older than max_entry_age_seconds are not used
+		"""
+
+	def __init__(self, root_path=None, max_entry_age_seconds=24 * 3600):
+		self.root_path = root_path
+		self.max_entry_age_seconds = max_entry_age_seconds
+
+	def entry_path(self, target, filename):
+		if not self.root_path:
+			return None
+		key = target_key(target) + '\n' + filename
+		return os.path.join(self.root_path, hashlib.sha1(key).hexdigest() + '.json')
+
+	def read_entry(self, path):
+		try:
+			with open(path) as entry_file:
+				record = json.load(entry_file)
+		except IOError:
+			return None
+		except ValueError:
+			logger.warning("Ignoring unreadable inventory entry " + path)
+			return None
+		return TargetInventoryEntry(record['target'], record['target_name'], record['filename'], record['sha1sum'], record['size'], record['mtime'], record['recorded_time'])
+
+	def is_expired(self, entry):
+		return entry.recorded_time < time.time() - self.max_entry_age_seconds
+
+	def get(self, target, filename):
+		""" Return the entry for a file on a target, or None if there is no entry or the entry has expired """
+		path = self.entry_path(target, filename)
+		if not path:
+			return None
+		entry = self.read_entry(path)
+		if not entry or self.is_expired(entry):
+			return None
+		return entry
+
+	def record(self, target, filename, sha1sum, size, mtime):
+		path = self.entry_path(target, filename)
+		if not path:
+			return
+		if not os.path.exists(self.root_path):
+			try:
+				os.makedirs(self.root_path)
+			except OSError, e:
+				if e.errno != errno.EEXIST:
+					raise
+		entry = TargetInventoryEntry(target_key(target), target.get('name'), filename, sha1sum, size, mtime, time.time())
+		temp_file_handle, temp_filename = tempfile.mkstemp(dir=self.root_path)
+		with os.fdopen(temp_file_handle, 'w') as temp_file:
+			json.dump(entry.to_json(), temp_file)
+		os.rename(temp_filename, path)
+
+	def remove(self, target, filename):
+		path = self.entry_path(target, filename)
+		if not path:
+			return
+		try:
+			os.remove(path)
+		except OSError, e:
+			if e.errno != errno.ENOENT:
+				raise
+
+	def list(self, target=None):
+		""" Return all entries that have not expired, optionally only those for one target
+			Expired entries are removed along the way
+			"""
+		if not self.root_path or not os.path.exists(self.root_path):
+			return []
+		entries = []
+		for filename in sorted(os.listdir(self.root_path)):
+			if not filename.endswith('.json'):
+				continue
+			path = os.path.join(self.root_path, filename)
+			entry = self.read_entry(path)
+			if not entry:
+				continue
+			if self.is_expired(entry):
+				try:
+					os.remove(path)
+				except OSError:
+					pass
+				continue
+			if target is None or entry.target == target_key(target):
+				entries.append(entry)
+		return entries
+
+# The inventory that is used by all actions within a process
+target_inventory = TargetInventory()
+
+class TargetInventoryUnitTest(unittest.TestCase):
+
+	root_path = 'unittest'
+	target = { 'name' : 'target', 'user' : 'user', 'host' : 'host', 'port' : '22' }
+	other_target = { 'name' : 'other target', 'user' : 'user', 'host' : 'other_host', 'port' : '22' }
+
+	def setUp(self):
+		os.mkdir(self.root_path)
+		self.target_inventory = TargetInventory(self.root_path + '/inventory')
+
+	def test_inventory(self):
+
+		self.assertEquals(self.target_inventory.get(self.target, 'file'), None)
+		self.assertEquals(self.target_inventory.list(), [])
+		self.target_inventory.record(self.target, 'file', '1234', 25, 1000)
+		self.target_inventory.record(self.other_target, 'file', '5678', 30, 2000)
+
+		entry = self.target_inventory.get(self.target, 'file')
+		self.assertEquals((entry.sha1sum, entry.size, entry.mtime), ('1234', 25, 1000))
+		self.assertTrue(entry.matches(25, 1000))
+		self.assertFalse(entry.matches(25, 1001))
+		self.assertEquals(self.target_inventory.get(self.target, 'other_file'), None)
+
+		self.assertEquals(len(self.target_inventory.list()), 2)
+		self.assertEquals([entry.to_json()['target_name'] for entry in self.target_inventory.list(self.other_target)], ['other target'])
+
+		self.target_inventory.remove(self.target, 'file')
+		self.target_inventory.remove(self.target, 'file')
+		self.assertEquals(self.target_inventory.get(self.target, 'file'), None)
+
+		# Expired entries should neither be used nor listed
+		self.target_inventory.max_entry_age_seconds = -1
+		self.assertEquals(self.target_inventory.get(self.other_target, 'file'), None)
+		self.assertEquals(self.target_inventory.list(), [])
+
+		# Without a root path, nothing should be kept
+		target_inventory = TargetInventory()
+		target_inventory.record(self.target, 'file', '1234', 25, 1000)
+		self.assertEquals(target_inventory.get(self.target, 'file'), None)
+
+	def tearDown(self):
+		shutil.rmtree(self.root_path)
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,13 @@
+import datetime
+
+# Points in time are stored as integer microseconds since the epoch in records that exist in large numbers,
+#  since an integer takes up a fraction of the memory of a datetime object
+
+epoch = datetime.datetime(1970, 1, 1)
+
+def datetime_to_microseconds(time):
+	delta = time - epoch
+	return (delta.days * 86400 + delta.seconds) * 1000000 + delta.microseconds
+
+def microseconds_to_datetime(microseconds):
+	return epoch + datetime.timedelta(microseconds=microseconds)
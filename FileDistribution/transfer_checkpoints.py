@@ -0,0 +1,177 @@
+import errno
+import hashlib
+import json
+import logging
+import os
+import os.path
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+logger = logging.getLogger('transfer_checkpoints')
+
+class TransferCheckpoint(object):
+	""" Records which chunks of a file have been written to a target, along with the sha1sum of each chunk
+		The record is rewritten after each completed chunk, so that an interrupted transfer can be resumed
+		"""
+
+	def __init__(self, path, sha1sum, size, chunks, completed_chunks=None):
+		self.path = path
+		self.sha1sum = sha1sum
+		self.size = size
+		self.chunks = chunks
+		self.completed_chunks = completed_chunks or {}
+		self.lock = threading.Lock()
+
+	def complete(self, index, chunk_sha1sum):
+		with self.lock:
+			self.completed_chunks[index] = chunk_sha1sum
+			self.save()
+
+	def discard(self, index):
+		with self.lock:
+			self.completed_chunks.pop(index, None)
+			self.save()
+
+	def pending_chunks(self):
+		with self.lock:
+			return [index for index in range(len(self.chunks)) if index not in self.completed_chunks]
+
+	def completed_size(self):
+		with self.lock:
+			return sum([self.chunks[index][1] for index in self.completed_chunks])
+
+	def save(self):
+		if not self.path:
+			return
+		directory = os.path.dirname(self.path)
+		if not os.path.exists(directory):
+			os.makedirs(directory)
+		record = { 'sha1sum' : self.sha1sum,
+			'size' : self.size,
+			'chunks' : self.chunks,
+			'completed_chunks' : dict([(str(index), chunk_sha1sum) for index, chunk_sha1sum in self.completed_chunks.items()]) }
+		temp_file_handle, temp_filename = tempfile.mkstemp(dir=directory)
+		with os.fdopen(temp_file_handle, 'w') as temp_file:
+			json.dump(record, temp_file)
+		os.rename(temp_filename, self.path)
+
+	def remove(self):
+		if not self.path:
+			return
+		try:
+			os.remove(self.path)
+		except OSError, e:
+			if e.errno != errno.ENOENT:
+				raise
+
+class TransferCheckpoints(object):
+	""" Keeps a checkpoint for each transfer of a file to a target that has not yet completed
+		Checkpoints are only kept on disk when root_path is set; checkpoints that have not been touched
+		for max_checkpoint_age_days are removed when new checkpoints are created
+		"""
+
+	def __init__(self, root_path=None, max_checkpoint_age_days=7):
+		self.root_path = root_path
+		self.max_checkpoint_age_days = max_checkpoint_age_days
+
+	def checkpoint_path(self, sha1sum, target, filename):
+		if not self.root_path:
+			return None
+		key = '\n'.join([sha1sum, target['user'], target['host'], str(target['port']), filename])
+		return os.path.join(self.root_path, hashlib.sha1(key).hexdigest() + '.json')
+
+	def exists(self, sha1sum, target, filename):
+		path = self.checkpoint_path(sha1sum, target, filename)
+		return bool(path) and os.path.exists(path)
+
+	def load(self, sha1sum, size, target, filename, chunks):
+		""" Return the checkpoint of an interrupted transfer, or None if there is no usable checkpoint
+			A checkpoint is only usable if it was made for the same file contents and the same chunk layout
+			"""
+		path = self.checkpoint_path(sha1sum, target, filename)
+		if not path:
+			return None
+		try:
+			with open(path) as checkpoint_file:
+				record = json.load(checkpoint_file)
+		except IOError:
+			return None
+		except ValueError:
+			logger.warning("Ignoring unreadable transfer checkpoint " + path)
+			return None
+
+		if record['sha1sum'] != sha1sum or record['size'] != size or [tuple(chunk) for chunk in record['chunks']] != chunks:
+			return None
+		completed_chunks = dict([(int(index), chunk_sha1sum) for index, chunk_sha1sum in record['completed_chunks'].items()])
+		return TransferCheckpoint(path, sha1sum, size, chunks, completed_chunks)
+
+	def create(self, sha1sum, size, target, filename, chunks):
+		""" Start a new checkpoint, replacing any previous checkpoint for the same file and target """
+		self.remove_expired_checkpoints()
+		checkpoint = TransferCheckpoint(self.checkpoint_path(sha1sum, target, filename), sha1sum, size, chunks)
+		checkpoint.save()
+		return checkpoint
+
+	def remove_expired_checkpoints(self):
+		if not self.root_path or not os.path.exists(self.root_path):
+			return
+		expiry_time = time.time() - self.max_checkpoint_age_days * 24 * 3600
+		for filename in os.listdir(self.root_path):
+			path = os.path.join(self.root_path, filename)
+			try:
+				if os.path.getmtime(path) < expiry_time:
+					os.remove(path)
+			except OSError:
+				pass
+
+# The checkpoints that are used by all actions within a process
+transfer_checkpoints = TransferCheckpoints()
+
+class TransferCheckpointsUnitTest(unittest.TestCase):
+
+	root_path = 'unittest'
+	target = { 'user' : 'user', 'host' : 'host', 'port' : '22' }
+	chunks = [(0, 10), (10, 10), (20, 5)]
+
+	def setUp(self):
+		os.mkdir(self.root_path)
+		self.transfer_checkpoints = TransferCheckpoints(self.root_path + '/checkpoints')
+
+	def test_checkpoints(self):
+
+		self.assertEquals(self.transfer_checkpoints.load('1234', 25, self.target, 'file', self.chunks), None)
+		checkpoint = self.transfer_checkpoints.create('1234', 25, self.target, 'file', self.chunks)
+		checkpoint.complete(0, 'abcd')
+		checkpoint.complete(2, 'ef01')
+		self.assertTrue(self.transfer_checkpoints.exists('1234', self.target, 'file'))
+		self.assertFalse(self.transfer_checkpoints.exists('1234', self.target, 'other_file'))
+
+		# A checkpoint should be restored with the chunks that had completed
+		checkpoint = self.transfer_checkpoints.load('1234', 25, self.target, 'file', self.chunks)
+		self.assertEquals(checkpoint.completed_chunks, { 0 : 'abcd', 2 : 'ef01' })
+		self.assertEquals(checkpoint.pending_chunks(), [1])
+		self.assertEquals(checkpoint.completed_size(), 15)
+
+		# Checkpoints for other contents or another chunk layout should not be used
+		self.assertEquals(self.transfer_checkpoints.load('5678', 25, self.target, 'file', self.chunks), None)
+		self.assertEquals(self.transfer_checkpoints.load('1234', 25, self.target, 'file', [(0, 25)]), None)
+
+		checkpoint.discard(0)
+		self.assertEquals(self.transfer_checkpoints.load('1234', 25, self.target, 'file', self.chunks).pending_chunks(), [0, 1])
+		checkpoint.remove()
+		checkpoint.remove()
+		self.assertFalse(self.transfer_checkpoints.exists('1234', self.target, 'file'))
+
+		# Without a root path, checkpoints should only be kept in memory
+		checkpoint = TransferCheckpoints().create('1234', 25, self.target, 'file', self.chunks)
+		checkpoint.complete(1, 'abcd')
+		self.assertEquals(checkpoint.pending_chunks(), [0, 2])
+
+	def tearDown(self):
+		shutil.rmtree(self.root_path)
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,92 @@
+
+# Measures how well the file stash's chunk store deduplicates successive versions of a large file,
+#  where each version differs from the previous one in a small fraction of its bytes,
+#  and how fast files are ingested with and without chunking
+#  Files are split into the chunk store in the background after they have been added; the time until
+#  chunking has finished is measured separately from the time that adding takes
+
+import datetime
+import logging
+import os
+import os.path
+import random
+import shutil
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from FileDistribution.FileStash import FileStash
+
+benchmark_directory = 'benchmark_chunk_store'
+
+def create_versions(num_versions, file_size, modified_fraction):
+	""" Create a series of file versions; each version overwrites, inserts and deletes a few small regions of its predecessor """
+	rng = random.Random(0)
+	data = os.urandom(file_size)
+	versions = [data]
+	for i in range(num_versions - 1):
+		num_modifications = max(1, int(file_size * modified_fraction) // 4096)
+		for j in range(num_modifications):
+			offset = rng.randrange(len(data))
+			kind = rng.randrange(3)
+			if kind == 0:
+				data = data[:offset] + os.urandom(4096) + data[offset + 4096:]
+			elif kind == 1:
+				data = data[:offset] + os.urandom(4096) + data[offset:]
+			else:
+				data = data[:offset] + data[offset + 4096:]
+		versions.append(data)
+	return versions
+
+def measure_ingest(versions, chunk_files, average_chunk_size):
+	stash_path = os.path.join(benchmark_directory, 'file_stash')
+	shutil.rmtree(stash_path, True)
+	os.mkdir(stash_path)
+	file_stash = FileStash(stash_path, None, None, journal_sync_interval_seconds=None, chunk_files=chunk_files, average_chunk_size=average_chunk_size)
+
+	ingest_time = 0
+	start_chunking_time = time.time()
+	for i, data in enumerate(versions):
+		filename = 'version' + str(i)
+		with open(os.path.join(benchmark_directory, filename), 'wb') as file:
+			file.write(data)
+		start_time = time.time()
+		file_stash.add(benchmark_directory, filename, datetime.datetime.utcnow())
+		ingest_time += time.time() - start_time
+
+	if chunk_files:
+		file_stash.wait_for_chunking()
+		chunking_time = time.time() - start_chunking_time
+		stored_size = file_stash.chunk_store.stored_size()
+	else:
+		chunking_time = ingest_time
+		stored_size = file_stash.total_size
+	file_stash.journal.close()
+	return stored_size, ingest_time, chunking_time
+
+def main(num_versions, file_size_mb, modified_fraction, average_chunk_sizes):
+	logging.basicConfig(level=logging.ERROR)
+	shutil.rmtree(benchmark_directory, True)
+	os.mkdir(benchmark_directory)
+	try:
+		versions = create_versions(num_versions, file_size_mb * 1024 * 1024, modified_fraction)
+		logical_size = sum(len(data) for data in versions)
+		print "%d versions of a %d MB file, %.1f%% modified per version" % (num_versions, file_size_mb, modified_fraction * 100)
+		print "%20s %18s %18s %20s %20s" % ('average chunk size', 'stored (MB)', 'dedup ratio', 'ingest (MB/s)', 'chunked (MB/s)')
+
+		stored_size, ingest_time, chunking_time = measure_ingest(versions, False, None)
+		print "%20s %18.1f %18.2f %20.1f %20s" % ('whole files', stored_size / 1048576.0, float(logical_size) / stored_size, logical_size / 1048576.0 / ingest_time, '-')
+
+		for average_chunk_size in average_chunk_sizes:
+			stored_size, ingest_time, chunking_time = measure_ingest(versions, True, average_chunk_size)
+			print "%20d %18.1f %18.2f %20.1f %20.1f" % (average_chunk_size, stored_size / 1048576.0, float(logical_size) / stored_size,
+				logical_size / 1048576.0 / ingest_time, logical_size / 1048576.0 / chunking_time)
+	finally:
+		shutil.rmtree(benchmark_directory, True)
+
+if __name__ == '__main__':
+	num_versions = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+	file_size_mb = int(sys.argv[2]) if len(sys.argv) > 2 else 16
+	modified_fraction = float(sys.argv[3]) if len(sys.argv) > 3 else 0.02
+	main(num_versions, file_size_mb, modified_fraction, [16384, 65536, 262144])
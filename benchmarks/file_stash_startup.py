@@ -0,0 +1,74 @@
+
+# Measures how long it takes to construct a FileStash on top of an existing stash directory,
+#  for a range of index sizes, with and without trusting the persisted index
+#  A trusted index is added to the in-memory index in the background, and then reconciled; the time until
+#  each of those has finished is shown as well
+
+import datetime
+import hashlib
+import json
+import logging
+import os
+import os.path
+import shutil
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from FileDistribution.FileStash import FileStash
+
+benchmark_directory = 'benchmark_file_stash'
+
+def create_stash(root_path, num_files):
+	os.mkdir(root_path)
+	index = {}
+	timestamp = datetime.datetime.utcnow()
+	for i in range(num_files):
+		sha1sum = hashlib.sha1(str(i)).hexdigest()
+		with open(os.path.join(root_path, sha1sum), 'w') as file:
+			file.write(str(i))
+		index[str(i)] = { 'file_id' : str(i),
+			'original_filename' : 'file' + str(i),
+			'sha1sum' : sha1sum,
+			'timestamp' : str(timestamp),
+			'size' : str(len(str(i))),
+			'is_deletable' : True }
+	with open(os.path.join(root_path, 'index.json'), 'w') as index_file:
+		json.dump(index, index_file)
+
+def measure_startup(root_path, trust_index):
+	start_time = time.time()
+	file_stash = FileStash(root_path, None, None, journal_sync_interval_seconds=None, trust_index=trust_index)
+	startup_time = time.time() - start_time
+
+	population_time = None
+	reconciliation_time = None
+	if trust_index:
+		while file_stash.unpopulated_entries:
+			time.sleep(0.01)
+		population_time = time.time() - start_time
+		while file_stash.get_reconciliation_progress()['state'] != 'completed':
+			time.sleep(0.01)
+		reconciliation_time = time.time() - start_time
+
+	return startup_time, population_time, reconciliation_time
+
+def main(index_sizes):
+	logging.basicConfig(level=logging.ERROR)
+	print "%10s %22s %22s %26s %26s" % ('files', 'full startup (s)', 'trusted startup (s)', 'trusted populated (s)', 'trusted reconciled (s)')
+	for num_files in index_sizes:
+		shutil.rmtree(benchmark_directory, True)
+		create_stash(benchmark_directory, num_files)
+		try:
+			full_startup_time, _, _ = measure_startup(benchmark_directory, False)
+			trusted_startup_time, trusted_population_time, trusted_reconciliation_time = measure_startup(benchmark_directory, True)
+			print "%10d %22.3f %22.3f %26.3f %26.3f" % (num_files, full_startup_time, trusted_startup_time, trusted_population_time, trusted_reconciliation_time)
+		finally:
+			shutil.rmtree(benchmark_directory, True)
+
+if __name__ == '__main__':
+	if len(sys.argv) > 1:
+		main([int(arg) for arg in sys.argv[1:]])
+	else:
+		main([1000, 10000, 100000])
@@ -0,0 +1,197 @@
+
+# Measures how much memory the server spends per file stash entry, and per completed task
+#  Sizes are computed by walking the object graph, and adding up sys.getsizeof() of each object
+#  that is reachable from the records; objects that are shared between records are only counted once
+#  The compact records are compared with a baseline, which holds the same data the way the records used to:
+#  attributes in per-object dicts, timestamps as datetime objects, the log as a string that grows with every
+#  line, and the actions of finished tasks kept around
+
+import datetime
+import gc
+import hashlib
+import logging
+import os
+import os.path
+import shutil
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'FileDistribution'))
+
+from FileDistribution.FileStash import FileStash
+from FileDistribution.SendorTask import SendorTask
+from FileDistribution.actions import CopyFileAction
+
+benchmark_directory = 'benchmark_memory'
+
+def deep_sizeof(root):
+	seen = set()
+	pending = [root]
+	size = 0
+	while pending:
+		obj = pending.pop()
+		if id(obj) in seen or isinstance(obj, type):
+			continue
+		seen.add(id(obj))
+		size += sys.getsizeof(obj)
+
+		if isinstance(obj, dict):
+			pending.extend(obj.keys())
+			pending.extend(obj.values())
+		elif isinstance(obj, (list, tuple, set, frozenset)):
+			pending.extend(obj)
+		else:
+			if hasattr(obj, '__dict__'):
+				pending.append(obj.__dict__)
+			for cls in type(obj).__mro__:
+				for slot in cls.__dict__.get('__slots__', ()):
+					if hasattr(obj, slot):
+						pending.append(getattr(obj, slot))
+	return size
+
+class BaselinePhysicalFile(object):
+
+	def __init__(self, sha1sum, layout, size):
+		self.reference_count = 0
+		self.sha1sum = sha1sum
+		self.layout = layout
+		self.size = size
+		self.lock_count = 0
+
+class BaselineStashedFile(object):
+
+	def __init__(self, file_id, root_path, filename, physical_file, timestamp, size):
+		self.reference_count = 0
+		self.file_id = file_id
+		self.root_path = root_path
+		self.original_filename = filename
+		self.physical_file = physical_file
+		self.timestamp = timestamp
+		self.size = size
+		self.last_distribution_time = timestamp
+		self.distribution_count = 0
+
+def measure_baseline_file_stash(num_files):
+	root_path = os.path.join(benchmark_directory, 'file_stash')
+	timestamp = datetime.datetime.utcnow()
+	stashed_files = {}
+	physical_files = {}
+	timestamp_order = []
+	for i in range(num_files):
+		file_id = str(i)
+		sha1sum = hashlib.sha1(str(i)).hexdigest()
+		physical_file = physical_files.setdefault(sha1sum, BaselinePhysicalFile(sha1sum, None, i * 1024))
+		physical_file.reference_count += 1
+		stashed_file = BaselineStashedFile(file_id, root_path, 'build-artifact-' + str(i) + '.img', physical_file, timestamp + datetime.timedelta(seconds=i), i * 1024)
+		stashed_files[file_id] = stashed_file
+		timestamp_order.append((stashed_file.timestamp, file_id))
+	gc.collect()
+
+	return deep_sizeof([stashed_files, physical_files, timestamp_order])
+
+def measure_file_stash(num_files):
+	root_path = os.path.join(benchmark_directory, 'file_stash')
+	os.mkdir(root_path)
+	file_stash = FileStash(root_path, None, None, journal_sync_interval_seconds=None)
+
+	timestamp = datetime.datetime.utcnow()
+	index = {}
+	for i in range(num_files):
+		index[str(i)] = { 'file_id' : str(i),
+			'original_filename' : 'build-artifact-' + str(i) + '.img',
+			'sha1sum' : hashlib.sha1(str(i)).hexdigest(),
+			'timestamp' : str(timestamp + datetime.timedelta(seconds=i)),
+			'size' : str(i * 1024),
+			'is_deletable' : True }
+	file_stash.populate_index(index, {})
+	del index
+	gc.collect()
+
+	size = deep_sizeof([file_stash.stashed_files, file_stash.physical_files, file_stash.timestamp_order])
+	file_stash.journal.close()
+	return size
+
+class BenchmarkTask(SendorTask):
+
+	def string_description(self):
+		return "Benchmark task"
+
+class BaselineTask(object):
+
+	def __init__(self):
+		self.state = SendorTask.NOT_STARTED
+		self.actions = []
+		self.task_id = None
+		self.work_directory = None
+		self.enqueue_time = None
+		self.start_time = None
+		self.end_time = None
+		self.completion_ratio = 0
+		self.activity = ""
+		self.log = ""
+		self.is_cancelable = False
+		self.max_bandwidth = None
+		self.bandwidth_allocation = None
+
+	def enqueued(self, task_id, work_directory):
+		self.task_id = task_id
+		self.work_directory = work_directory
+		self.enqueue_time = datetime.datetime.utcnow()
+
+	def started(self):
+		self.state = SendorTask.STARTED
+		self.start_time = datetime.datetime.utcnow()
+
+	def completed(self):
+		self.state = SendorTask.COMPLETED
+		self.end_time = datetime.datetime.utcnow()
+
+	def set_activity(self, activity):
+		self.activity = activity
+
+	def set_completion_ratio(self, completion_ratio):
+		self.completion_ratio = completion_ratio
+
+	def append_log(self, log):
+		self.log = self.log + log + "\n"
+
+def measure_tasks(task_class, num_tasks, num_log_lines):
+	tasks = []
+	for i in range(num_tasks):
+		task = task_class()
+		task.actions.append(CopyFileAction('/stash/' + hashlib.sha1(str(i)).hexdigest(), None, None, '/target/build-artifact-' + str(i) + '.img'))
+		task.enqueued(i, os.path.join('/queue/active_tasks', str(i)))
+		task.started()
+		for line in range(num_log_lines):
+			task.append_log("Transferred " + str(line * 10) + "% of build-artifact-" + str(i) + ".img")
+		task.set_activity("Transfer complete")
+		task.set_completion_ratio(1.0)
+		task.completed()
+		tasks.append(task)
+	gc.collect()
+
+	return deep_sizeof(tasks)
+
+def main(num_records, num_log_lines):
+	logging.basicConfig(level=logging.ERROR)
+	shutil.rmtree(benchmark_directory, True)
+	os.mkdir(benchmark_directory)
+	try:
+		print "%10s %16s %24s %26s" % ('records', 'representation', 'bytes per stash entry', 'bytes per completed task')
+		for num in num_records:
+			shutil.rmtree(benchmark_directory, True)
+			os.mkdir(benchmark_directory)
+			stash_size = measure_baseline_file_stash(num)
+			task_size = measure_tasks(BaselineTask, num, num_log_lines)
+			print "%10d %16s %24.0f %26.0f" % (num, 'baseline', float(stash_size) / num, float(task_size) / num)
+			stash_size = measure_file_stash(num)
+			task_size = measure_tasks(BenchmarkTask, num, num_log_lines)
+			print "%10d %16s %24.0f %26.0f" % (num, 'compact', float(stash_size) / num, float(task_size) / num)
+	finally:
+		shutil.rmtree(benchmark_directory, True)
+
+if __name__ == '__main__':
+	if len(sys.argv) > 1:
+		main([int(arg) for arg in sys.argv[1:]], 10)
+	else:
+		main([10000, 100000], 10)
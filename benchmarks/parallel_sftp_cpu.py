@@ -0,0 +1,132 @@
+# Measures how many bytes per second, and per second of client CPU time, the parallel SFTP data path moves
+#  The old path reads each chunk into strings and updates the completion ratio under a lock, with a timestamp,
+#  for every block; the new path sends memoryview slices of one shared mapping of the file, and counts bytes
+#  per stream without locking. Each path is measured against a null sink, which shows the cost of the data
+#  path alone, and against a paramiko-based SSH server which runs in a separate process
+
+import datetime
+import hashlib
+import logging
+import multiprocessing
+import os
+import os.path
+import shutil
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'FileDistribution'))
+
+from ssh_connection_pool import SshConnectionPool
+from ssh_test_server import SshTestServer
+from sftp_transfer import MappedFile, SftpTransferSettings, hashed_blocks, read_file_range, send_blocks
+
+benchmark_directory = 'benchmark_parallel_sftp_cpu'
+chunk_size = 4 * 1024 * 1024
+
+def run_server(server, ports):
+	server.start()
+	ports.put(server.port)
+	while True:
+		time.sleep(60)
+
+def null_sink(connection, blocks, offset, settings, progress):
+	sha1 = hashlib.sha1()
+	for data in hashed_blocks(blocks, sha1):
+		progress(len(data))
+	return sha1.hexdigest()
+
+def sftp_sink(connection, blocks, offset, settings, progress):
+	return send_blocks(connection.sftp(), blocks, 'file', offset, settings, progress)
+
+def old_path(source, chunks, num_streams, sink, connections, settings):
+	""" Each chunk is read into strings; every block takes the completion ratio lock and the time """
+	lock = threading.Lock()
+	state = { 'transmitted_size' : 0, 'timestamp' : datetime.datetime.utcnow() }
+	interval = datetime.timedelta(seconds=1)
+
+	def progress(size):
+		with lock:
+			state['transmitted_size'] += size
+			now = datetime.datetime.utcnow()
+			if now - state['timestamp'] >= interval:
+				state['timestamp'] = now
+
+	def stream(stream_index):
+		for offset, length in chunks[stream_index::num_streams]:
+			sink(connections[stream_index], read_file_range(source, offset, length, settings.block_size), offset, settings, progress)
+
+	run_streams(stream, num_streams)
+
+def new_path(source, chunks, num_streams, sink, connections, settings):
+	""" Chunks are slices of one mapping; each stream counts its own bytes """
+	stream_sizes = [0] * num_streams
+
+	def stream(stream_index):
+		def progress(size):
+			stream_sizes[stream_index] += size
+		for offset, length in chunks[stream_index::num_streams]:
+			sink(connections[stream_index], mapped_file.blocks(offset, length, settings.block_size), offset, settings, progress)
+
+	with MappedFile(source) as mapped_file:
+		run_streams(stream, num_streams)
+
+def run_streams(stream, num_streams):
+	threads = [threading.Thread(target=stream, args=(i,)) for i in range(num_streams)]
+	for thread in threads:
+		thread.start()
+	for thread in threads:
+		thread.join()
+
+def measure(path, source, file_size, num_streams, sink, connections, settings):
+	chunks = [(offset, min(chunk_size, file_size - offset)) for offset in range(0, file_size, chunk_size)]
+	start_times = os.times()
+	start_time = time.time()
+	path(source, chunks, num_streams, sink, connections, settings)
+	elapsed_time = time.time() - start_time
+	end_times = os.times()
+	cpu_time = (end_times[0] - start_times[0]) + (end_times[1] - start_times[1])
+	return elapsed_time, cpu_time
+
+def main(file_size_mb, num_streams):
+	logging.basicConfig(level=logging.CRITICAL)
+	shutil.rmtree(benchmark_directory, True)
+	os.mkdir(benchmark_directory)
+	source = os.path.join(benchmark_directory, 'source')
+	with open(source, 'wb') as file:
+		for i in range(file_size_mb):
+			file.write(os.urandom(1024 * 1024))
+	file_size = file_size_mb * 1024 * 1024
+
+	server = SshTestServer(os.path.join(benchmark_directory, 'target'))
+	target = server.create_target(os.path.join(benchmark_directory, 'client_key'), sftp_request_size='261120')
+	ports = multiprocessing.Queue()
+	server_process = multiprocessing.Process(target=run_server, args=(server, ports))
+	server_process.daemon = True
+	server_process.start()
+	connection_pool = SshConnectionPool()
+	try:
+		target['port'] = str(ports.get())
+		settings = SftpTransferSettings(target)
+		connections = [connection_pool.acquire(target) for i in range(num_streams)]
+		connections[0].sftp().open('file', 'w').close()
+
+		print "%d MB, %d streams" % (file_size_mb, num_streams)
+		print "%-28s%16s%24s" % ('data path', 'throughput', 'per client CPU second')
+		for sink_description, sink in [("null sink", null_sink), ("SFTP", sftp_sink)]:
+			for path_description, path in [("read + lock", old_path), ("mmap + counters", new_path)]:
+				elapsed_time, cpu_time = measure(path, source, file_size, num_streams, sink, connections, settings)
+				print "%-28s%16s%24s" % (sink_description + ", " + path_description,
+					"%.1f MB/s" % (file_size_mb / elapsed_time),
+					"%.1f MB" % (file_size_mb / max(cpu_time, 0.01)))
+	finally:
+		connection_pool.close_all()
+		server_process.terminate()
+		shutil.rmtree(benchmark_directory, True)
+
+if __name__ == '__main__':
+	if len(sys.argv) > 1:
+		main(int(sys.argv[1]), int(sys.argv[2]) if len(sys.argv) > 2 else 4)
+	else:
+		main(64, 4)
@@ -0,0 +1,88 @@
+# Measures SFTP upload throughput for different target settings, over links with different latencies
+#  The target is a paramiko-based SSH server, which runs in a separate process behind a proxy that delays
+#  all data by a fixed amount in each direction; the round trip time is twice the latency
+
+import logging
+import multiprocessing
+import os
+import os.path
+import shutil
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'FileDistribution'))
+
+from ssh_connection_pool import SshConnectionPool
+from ssh_test_server import SshTestServer, LatencyProxy
+from sftp_transfer import SftpTransferSettings, send_file
+
+benchmark_directory = 'benchmark_sftp_throughput'
+
+configurations = [
+	("16 kB synchronous writes", { 'sftp_pipelined' : 'false', 'sftp_block_size' : '16384', 'sftp_request_size' : '16384' }),
+	("32 kB pipelined writes", { 'sftp_request_size' : '32768' }),
+	("255 kB pipelined writes", {}),
+	("255 kB, 16 MB window", { 'sftp_request_size' : '261120', 'ssh_window_size' : '16777216', 'ssh_max_packet_size' : '262144' }),
+	("255 kB, aes256-ctr", { 'sftp_request_size' : '261120', 'ssh_ciphers' : 'aes256-ctr' }),
+	("255 kB, aes128-cbc", { 'sftp_request_size' : '261120', 'ssh_ciphers' : 'aes128-cbc' }),
+]
+
+def run_server(server, latencies, ports):
+	server.start()
+	for latency in latencies:
+		proxy = LatencyProxy(server.port, latency)
+		proxy.start()
+		ports.put(proxy.port)
+	while True:
+		time.sleep(60)
+
+def measure(target, source, settings):
+	connection_pool = SshConnectionPool()
+	try:
+		with connection_pool.connection(target) as connection:
+			sftp = connection.sftp()
+			start_time = time.time()
+			send_file(sftp, source, 'file', settings)
+			elapsed_time = time.time() - start_time
+	finally:
+		connection_pool.close_all()
+	return elapsed_time
+
+def main(file_size_mb, latencies):
+	logging.basicConfig(level=logging.CRITICAL)
+	shutil.rmtree(benchmark_directory, True)
+	os.mkdir(benchmark_directory)
+	source = os.path.join(benchmark_directory, 'source')
+	with open(source, 'wb') as file:
+		for i in range(file_size_mb):
+			file.write(os.urandom(1024 * 1024))
+
+	server = SshTestServer(os.path.join(benchmark_directory, 'target'))
+	target = server.create_target(os.path.join(benchmark_directory, 'client_key'))
+	ports = multiprocessing.Queue()
+	server_process = multiprocessing.Process(target=run_server, args=(server, latencies, ports))
+	server_process.daemon = True
+	server_process.start()
+	try:
+		proxy_ports = [ports.get() for latency in latencies]
+
+		print "%-28s" % 'settings' + ''.join(["%14s" % ("%d ms RTT" % (latency * 2000)) for latency in latencies])
+		for description, configuration in configurations:
+			line = "%-28s" % description
+			for latency, proxy_port in zip(latencies, proxy_ports):
+				measured_target = dict(target)
+				measured_target.update(configuration)
+				measured_target['port'] = str(proxy_port)
+				elapsed_time = measure(measured_target, source, SftpTransferSettings(measured_target))
+				line += "%14s" % ("%.1f MB/s" % (file_size_mb / elapsed_time))
+			print line
+	finally:
+		server_process.terminate()
+		shutil.rmtree(benchmark_directory, True)
+
+if __name__ == '__main__':
+	if len(sys.argv) > 1:
+		main(int(sys.argv[1]), [float(arg) / 2000 for arg in sys.argv[2:]] or [0, 0.025])
+	else:
+		main(4, [0, 0.025])
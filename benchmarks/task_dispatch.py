@@ -0,0 +1,77 @@
+# Measures how long it takes to dispatch and complete tasks that do no work
+#  With max_tasks_per_process=0 the worker processes are long-lived, and tasks are handed to them over a pipe.
+#  With max_tasks_per_process=1 every task runs in a freshly forked process; this approximates how tasks used to
+#  be run, a fork per task, but the replacement process is forked while the previous task is finalized rather
+#  than when the next task is dispatched, so it understates the cost of the old path somewhat
+
+import logging
+import os
+import os.path
+import shutil
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'FileDistribution'))
+
+from FileDistribution.SendorQueue import SendorQueue
+from FileDistribution.SendorTask import SendorTask, SendorAction
+
+benchmark_directory = 'benchmark_task_dispatch'
+
+class NoOpAction(SendorAction):
+
+	def __init__(self):
+		super(NoOpAction, self).__init__(completion_weight=1)
+
+	def run(self, context):
+		context.activity("Nothing to do")
+
+class BenchmarkTask(SendorTask):
+
+	def string_description(self):
+		return "Benchmark task"
+
+def measure(num_tasks, num_processes, max_tasks_per_process):
+	shutil.rmtree(benchmark_directory, True)
+	os.mkdir(benchmark_directory)
+	sendor_queue = SendorQueue(num_processes, benchmark_directory, 60, 1, None, None, None, max_tasks_per_process)
+
+	# Let the pre-forked processes start up before measuring
+	warmup_task = BenchmarkTask()
+	sendor_queue.add(warmup_task)
+	sendor_queue.join(warmup_task)
+
+	start_time = time.time()
+	tasks = []
+	for i in range(num_tasks):
+		task = BenchmarkTask()
+		task.actions = [NoOpAction()]
+		sendor_queue.add(task)
+		tasks.append(task)
+	for task in tasks:
+		sendor_queue.join(task)
+	elapsed_time = time.time() - start_time
+
+	sendor_queue.stop()
+
+	for task in tasks:
+		assert task.state == SendorTask.COMPLETED
+	return elapsed_time
+
+def main(num_tasks):
+	logging.basicConfig(level=logging.ERROR)
+	try:
+		print "%10s %10s %32s %16s" % ('tasks', 'processes', 'tasks per process', 'ms per task')
+		for num_processes in [1, 4]:
+			for max_tasks_per_process, description in [(1, '1 (fork per task, approximate)'), (0, 'unlimited')]:
+				elapsed_time = measure(num_tasks, num_processes, max_tasks_per_process)
+				print "%10d %10d %32s %16.2f" % (num_tasks, num_processes, description, elapsed_time * 1000 / num_tasks)
+	finally:
+		shutil.rmtree(benchmark_directory, True)
+
+if __name__ == '__main__':
+	if len(sys.argv) > 1:
+		main(int(sys.argv[1]))
+	else:
+		main(500)
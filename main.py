@@ -1,5 +1,6 @@
 
 import logging
+import os
 import sys
 
 import tornado.wsgi
@@ -18,6 +19,11 @@ from FileDistribution.Targets import Targets
 
 import FileDistribution.rest_api
 import FileDistribution.backsync_api
+import FileDistribution.bandwidth
+import FileDistribution.ssh_connection_pool
+import FileDistribution.parallel_transfer
+import FileDistribution.target_inventory
+import FileDistribution.transfer_checkpoints
 import ui
 import application_config
 import application_logger
@@ -34,12 +40,29 @@ def main(host_config_filename, targets_config_filename):
 	
 	host = config['host']
 	port = int(config['port'])
-	upload_folder = config['upload_folder']
 	file_stash_folder = config['file_stash_folder']
 	queue_folder = config['queue_folder']
 	num_distribution_processes = int(config['num_distribution_processes'])
+	max_tasks_per_distribution_process = int(config.get('max_tasks_per_distribution_process', 100))
 	max_file_age_days = int(config['max_file_age_days'])
 	max_file_age_check_interval_seconds = int(config['max_file_age_check_interval_seconds'])
+	file_stash_journal_sync_interval_seconds = float(config.get('file_stash_journal_sync_interval_seconds', 1))
+	file_stash_journal_compaction_threshold = int(config.get('file_stash_journal_compaction_threshold', 10000))
+	file_stash_trust_index = config.get('file_stash_trust_index', 'false') == 'true'
+	file_stash_layout = config.get('file_stash_layout', 'flat')
+	file_stash_max_size_bytes = int(config.get('file_stash_max_size_bytes', 0)) or None
+	file_stash_eviction_policy = config.get('file_stash_eviction_policy', 'lru')
+	file_stash_chunk_files = config.get('file_stash_chunk_files', 'false') == 'true'
+	file_stash_average_chunk_size = int(config.get('file_stash_average_chunk_size', 65536))
+	ssh_connection_idle_timeout_seconds = int(config.get('ssh_connection_idle_timeout_seconds', 300))
+	ssh_connection_health_check_interval_seconds = int(config.get('ssh_connection_health_check_interval_seconds', 30))
+	ssh_max_sessions_per_target = int(config.get('ssh_max_sessions_per_target', 10))
+	transfer_checkpoint_folder = config.get('transfer_checkpoint_folder', os.path.join(queue_folder, 'transfer_checkpoints'))
+	target_inventory_folder = config.get('target_inventory_folder', os.path.join(queue_folder, 'target_inventory'))
+	target_inventory_max_entry_age_seconds = int(config.get('target_inventory_max_entry_age_seconds', 86400))
+	transfer_tuning_folder = config.get('transfer_tuning_folder', os.path.join(queue_folder, 'transfer_tuning'))
+	max_bandwidth_bytes_per_second = int(config.get('max_bandwidth_bytes_per_second', 0))
+	max_task_bandwidth_bytes_per_second = int(config.get('max_task_bandwidth_bytes_per_second', 0))
 	max_task_execution_time_seconds = int(config['max_task_execution_time_seconds'])
 	max_task_finalization_time_seconds = int(config['max_task_finalization_time_seconds'])
 	task_cleanup_interval_seconds = int(config['task_cleanup_interval_seconds'])
@@ -51,11 +74,22 @@ def main(host_config_filename, targets_config_filename):
 	root.config['host_description'] = config['host_description']
 	root.config['SEND_FILE_MAX_AGE_DEFAULT'] = 1
 
-	sendor_queue = SendorQueue(num_distribution_processes, queue_folder, max_task_execution_time_seconds, max_task_finalization_time_seconds, task_cleanup_interval_seconds, max_task_wait_seconds, max_task_exist_days)
-	file_stash = FileStash(file_stash_folder, max_file_age_days, max_file_age_check_interval_seconds)
+	connection_pool = FileDistribution.ssh_connection_pool.connection_pool
+	connection_pool.idle_timeout_seconds = ssh_connection_idle_timeout_seconds
+	connection_pool.health_check_interval_seconds = ssh_connection_health_check_interval_seconds
+	connection_pool.max_sessions_per_target = ssh_max_sessions_per_target
+	FileDistribution.transfer_checkpoints.transfer_checkpoints.root_path = transfer_checkpoint_folder
+	FileDistribution.target_inventory.target_inventory.root_path = target_inventory_folder
+	FileDistribution.target_inventory.target_inventory.max_entry_age_seconds = target_inventory_max_entry_age_seconds
+	FileDistribution.parallel_transfer.transfer_tuning.root_path = transfer_tuning_folder
+	FileDistribution.bandwidth.bandwidth_manager.global_limit = max_bandwidth_bytes_per_second
+	FileDistribution.bandwidth.bandwidth_manager.task_limit = max_task_bandwidth_bytes_per_second
+
+	sendor_queue = SendorQueue(num_distribution_processes, queue_folder, max_task_execution_time_seconds, max_task_finalization_time_seconds, task_cleanup_interval_seconds, max_task_wait_seconds, max_task_exist_days, max_tasks_per_distribution_process)
+	file_stash = FileStash(file_stash_folder, max_file_age_days, max_file_age_check_interval_seconds, file_stash_journal_sync_interval_seconds, file_stash_journal_compaction_threshold, file_stash_trust_index, file_stash_layout, file_stash_max_size_bytes, file_stash_eviction_policy, file_stash_chunk_files, file_stash_average_chunk_size)
 	targets = Targets(config['targets'])
 
-	ui_app = ui.create_ui(file_stash, upload_folder)
+	ui_app = ui.create_ui(file_stash)
 	root.register_blueprint(url_prefix = '/ui', blueprint = ui_app)
 	rest_api_app = FileDistribution.rest_api.create_rest_api(sendor_queue, targets, file_stash)
 	root.register_blueprint(url_prefix = '/api', blueprint = rest_api_app)
@@ -80,7 +114,10 @@ def main(host_config_filename, targets_config_filename):
 	application = tornado.web.Application(handlers)
 	
 	application.listen(port)
-	tornado.ioloop.IOLoop.instance().start()
+	try:
+		tornado.ioloop.IOLoop.instance().start()
+	finally:
+		sendor_queue.stop()
 
 if __name__ == '__main__':
 	
@@ -0,0 +1,66 @@
+
+# Upload files to a Sendor server
+#  Files are hashed locally first, and their contents are only transferred if the server's file stash does not already hold them
+#
+# Usage: python sendor_client.py http://server:5000 file [file ...]
+
+import hashlib
+import httplib
+import json
+import os
+import os.path
+import sys
+import urlparse
+
+block_size = 1024 * 1024
+
+def sha1_of_file(filename):
+	sha1 = hashlib.sha1()
+	with open(filename, 'rb') as file:
+		while True:
+			data = file.read(block_size)
+			if not data:
+				break
+			sha1.update(data)
+	return sha1.hexdigest()
+
+def request(server_url, method, path, body, headers):
+	url = urlparse.urlparse(urlparse.urljoin(server_url, path))
+	if url.scheme == 'https':
+		connection = httplib.HTTPSConnection(url.netloc)
+	else:
+		connection = httplib.HTTPConnection(url.netloc)
+	try:
+		connection.request(method, url.path + ('?' + url.query if url.query else ''), body, headers)
+		response = connection.getresponse()
+		response_body = response.read()
+		if response.status >= 400:
+			raise Exception(method + " " + path + " failed with status " + str(response.status) + ": " + response_body)
+		return json.loads(response_body)
+	finally:
+		connection.close()
+
+def upload_file(server_url, filename):
+	""" Add a file to the server's file stash
+		Returns the stashed file's description, and whether the contents had to be transferred
+		"""
+
+	size = os.stat(filename).st_size
+	declaration = { 'filename' : os.path.basename(filename), 'size' : size, 'sha1sum' : sha1_of_file(filename) }
+	response = request(server_url, 'POST', '/api/file_stash/negotiate', json.dumps(declaration), { 'Content-Type' : 'application/json' })
+	if not response['upload_required']:
+		return response['file'], False
+
+	# The file object is streamed by httplib, so the contents are never held in memory at once
+	with open(filename, 'rb') as file:
+		response = request(server_url, 'PUT', response['upload_url'], file, { 'Content-Type' : 'application/octet-stream', 'Content-Length' : str(size) })
+	return response['file'], True
+
+if __name__ == '__main__':
+	if len(sys.argv) < 3:
+		print "Usage: " + sys.argv[0] + " <server url> <file> [file ...]"
+		sys.exit(1)
+
+	for filename in sys.argv[2:]:
+		stashed_file, transferred = upload_file(sys.argv[1], filename)
+		print filename + ": " + ("uploaded" if transferred else "already in stash") + " as file " + stashed_file['file_id']
@@ -5,10 +5,11 @@ import os.path
 
 from flask import Blueprint, Response, render_template, redirect, request
 from werkzeug import secure_filename
+from werkzeug.formparser import parse_form_data
 
 logger = logging.getLogger('main.ui')
 
-def create_ui(file_stash, upload_folder):
+def create_ui(file_stash):
 
 	ui_app = Blueprint('ui', __name__)
 
@@ -28,12 +29,23 @@ def create_ui(file_stash, upload_folder):
 
 		elif request.method == 'POST':
 
-			file = request.files['file']
-			filename = secure_filename(file.filename)
-			upload_file_full_path = os.path.join(upload_folder, filename)
-			file.save(upload_file_full_path)
-
-			file_stash.add(upload_folder, filename, datetime.datetime.utcnow())
+			# Stream uploaded files straight into the stash, hashing them on the way
+			ingests = []
+
+			def stream_factory(total_content_length, filename, content_type, content_length=None):
+				ingest = file_stash.begin_ingest()
+				ingests.append(ingest)
+				return ingest
+
+			try:
+				stream, form, files = parse_form_data(request.environ, stream_factory=stream_factory)
+				file = files['file']
+				filename = secure_filename(file.filename)
+				file.stream.commit(filename, datetime.datetime.utcnow())
+				ingests.remove(file.stream)
+			finally:
+				for ingest in ingests:
+					ingest.abort()
 
 			return redirect('index.html')
 